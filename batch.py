@@ -0,0 +1,365 @@
+import csv
+import json
+import time
+import logging
+import argparse
+import functools
+from pathlib import Path
+from contextlib import ExitStack
+from typing import Iterable, Iterator, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from main import (
+    DEFAULT_PRESCORE_TOLERANCE,
+    analyse_pack,
+    compact_output,
+    configure_logging,
+    get_settings,
+    predict_slate_health,
+    structure_response,
+)
+from metrics import start_metrics_server
+from packing import PackSizer
+from scheduler import BATCH, priority
+
+# Order of the positional arguments of predict_slate_health
+SLATE_FIELDS = [
+    "urm",
+    "minority",
+    "female",
+    "ea",
+    "so",
+    "ce",
+    "we",
+    "fo",
+    "prof",
+    "aprof",
+    "assisprof",
+    "workflow",
+]
+
+# Order of the list returned by structure_response
+OUTPUT_FIELDS = [
+    "overall_rating",
+    "summary",
+    "demographic_average",
+    "urm_rating",
+    "urm_reason",
+    "minority_rating",
+    "minority_reason",
+    "female_rating",
+    "female_reason",
+    "geographic_average",
+    "ea_rating",
+    "ea_reason",
+    "so_rating",
+    "so_reason",
+    "ce_rating",
+    "ce_reason",
+    "we_rating",
+    "we_reason",
+    "fo_rating",
+    "fo_reason",
+    "seniority_average",
+    "prof_rating",
+    "prof_reason",
+    "aprof_rating",
+    "aprof_reason",
+    "assisprof_rating",
+    "assisprof_reason",
+]
+
+
+def read_slates(path: str) -> Iterator[dict]:
+    """Reads slates from a JSONL or CSV file. Every record must provide the 11 percentages
+    and the workflow text using the names in SLATE_FIELDS, and may provide a "slate_id".
+
+    Args:
+        path (str): Path to a .jsonl or .csv file
+
+    Yields:
+        dict: One slate per record, with "slate_id" defaulting to the record number
+    """
+    path = Path(path)
+
+    with path.open(newline="", encoding="utf-8") as f:
+        if path.suffix.lower() == ".csv":
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+
+        for number, record in enumerate(records, start=1):
+            missing = [field for field in SLATE_FIELDS if field not in record]
+            if missing:
+                raise ValueError(f"Slate {number} in {path} is missing {missing}")
+            slate = {field: str(record[field]) for field in SLATE_FIELDS}
+            slate["slate_id"] = str(record.get("slate_id") or number)
+            yield slate
+
+
+def load_checkpoint(checkpoint_path: Optional[str]) -> set:
+    """Reads the ids of slates that were already scored by a previous run.
+
+    Args:
+        checkpoint_path (Optional[str]): Checkpoint file, one slate id per line
+
+    Returns:
+        set: Completed slate ids
+    """
+    if not checkpoint_path or not Path(checkpoint_path).exists():
+        return set()
+
+    with open(checkpoint_path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def prioritize_slates(slates: Iterable[dict]) -> tuple[list, list]:
+    """Orders slates by how far their percentages deviate from the ideal values, most
+    deviant first, and sets apart the slates with every criterion within
+    PRESCORE_TOLERANCE as they are rated locally. Every slate is read into memory to
+    rank them.
+
+    Args:
+        slates (Iterable[dict]): Slates as returned by read_slates
+
+    Returns:
+        tuple[list, list]: Slates that need the model, in the order they should be
+            scored, and the compliant slates
+    """
+    # numpy is only loaded for prioritized runs
+    from cohort import Cohort
+
+    slates = list(slates)
+    cohort = Cohort.from_rows(
+        (slate["slate_id"], [slate[field] for field in SLATE_FIELDS[:-1]])
+        for slate in slates
+    )
+    tolerance = float(
+        get_settings().get("PRESCORE_TOLERANCE") or DEFAULT_PRESCORE_TOLERANCE
+    )
+    ranking = cohort.ranking(tolerance)
+    compliant = cohort.compliant(tolerance)
+    logging.info(f"Rating {int(compliant.sum())} compliant slates locally")
+    return [slates[row] for row in ranking], [
+        slate for slate, local in zip(slates, compliant) if local
+    ]
+
+
+def score_slate(slate: dict) -> dict:
+    """Scores a single slate and times it.
+
+    Args:
+        slate (dict): Slate as returned by read_slates
+
+    Returns:
+        dict: Slate id, status, elapsed seconds and either the result or the error
+    """
+    start = time.perf_counter()
+    try:
+        # Batch slates yield to interactive requests when the rate limits are reached
+        with priority(BATCH):
+            output = predict_slate_health(
+                *(slate[field] for field in SLATE_FIELDS), slate_id=slate["slate_id"]
+            )
+        record = {"status": "ok", "result": dict(zip(OUTPUT_FIELDS, output))}
+    except Exception as e:
+        logging.error(f"Failed to score slate {slate['slate_id']}", exc_info=True)
+        record = {"status": "error", "error": str(e)}
+
+    return {
+        "slate_id": slate["slate_id"],
+        "elapsed": round(time.perf_counter() - start, 3),
+        **record,
+    }
+
+
+def score_pack(slates: list, sizer: PackSizer) -> list:
+    """Scores several slates with one shared model call. Slates whose answer in the pack
+    was missing or invalid are scored alone afterwards.
+
+    Args:
+        slates (list): Slates as returned by read_slates
+        sizer (PackSizer): Sizer told how the pack went
+
+    Returns:
+        list: Result of each slate as returned by score_slate
+    """
+    start = time.perf_counter()
+    try:
+        with priority(BATCH):
+            responses = analyse_pack(
+                [
+                    {
+                        "percentages": [slate[field] for field in SLATE_FIELDS[:-1]],
+                        "workflow": slate["workflow"],
+                        "slate_id": slate["slate_id"],
+                    }
+                    for slate in slates
+                ]
+            )
+    except Exception:
+        logging.error("Failed to score pack, scoring its slates alone", exc_info=True)
+        responses = [None] * len(slates)
+    sizer.record(len(slates), responses.count(None))
+    elapsed = round(time.perf_counter() - start, 3)
+
+    results = []
+    for slate, response in zip(slates, responses):
+        if response is None:
+            results.append(score_slate(slate))
+            continue
+        output = structure_response(response)
+        results.append(
+            {
+                "slate_id": slate["slate_id"],
+                "elapsed": elapsed,
+                "status": "ok",
+                "result": dict(zip(OUTPUT_FIELDS, output)),
+            }
+        )
+    return results
+
+
+def pack_sizer(max_size: int) -> PackSizer:
+    """Creates the sizer of a batch run, with the token budgets of a pack from
+    PACK_PROMPT_BUDGET and PACK_COMPLETION_BUDGET in .env.
+
+    Args:
+        max_size (int): Most slates sharing one call
+
+    Returns:
+        PackSizer: Sizer starting at max_size
+    """
+    settings = get_settings()
+    return PackSizer(
+        max_size,
+        prompt_budget=int(settings.get("PACK_PROMPT_BUDGET") or 12000),
+        completion_budget=int(settings.get("PACK_COMPLETION_BUDGET") or 4000),
+        completion_tokens=400 if compact_output() else 900,
+    )
+
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    checkpoint_path: Optional[str] = None,
+    workers: int = 8,
+    pack: int = 1,
+    prioritize: bool = False,
+) -> Iterator[dict]:
+    """Scores every slate of the input file over a bounded worker pool. Results are
+    appended to the output file as they finish, and the ids of successful slates are
+    appended to the checkpoint file so an interrupted run can be resumed.
+
+    Args:
+        input_path (str): JSONL or CSV file with the slates
+        output_path (str): JSONL file the results are appended to
+        checkpoint_path (Optional[str]): File with the ids of completed slates
+        workers (int): Number of slates or packs scored concurrently
+        pack (int): Most slates sharing one model call, 1 to score every slate alone
+        prioritize (bool): Rate compliant slates locally first, then score the most
+            deviant slates first, see prioritize_slates
+
+    Yields:
+        dict: Result of each slate, in completion order
+    """
+    done = load_checkpoint(checkpoint_path)
+    slates = (s for s in read_slates(input_path) if s["slate_id"] not in done)
+    compliant = []
+    if prioritize:
+        slates, compliant = prioritize_slates(slates)
+        slates = iter(slates)
+    if pack > 1:
+        sizer = pack_sizer(pack)
+        groups = sizer.packs(slates)
+        score = functools.partial(score_pack, sizer=sizer)
+    else:
+        groups = ([slate] for slate in slates)
+
+        def score(group: list) -> list:
+            return [score_slate(group[0])]
+
+    with ExitStack() as stack:
+        pool = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        out = stack.enter_context(open(output_path, "a", encoding="utf-8"))
+        ckpt = None
+        if checkpoint_path:
+            ckpt = stack.enter_context(open(checkpoint_path, "a", encoding="utf-8"))
+
+        def save(result: dict):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if result["status"] == "ok" and ckpt:
+                ckpt.write(result["slate_id"] + "\n")
+                ckpt.flush()
+
+        # Compliant slates are settled without a model call, so they don't need a worker
+        for slate in compliant:
+            result = score_slate(slate)
+            save(result)
+            yield result
+
+        pending = set()
+        exhausted = False
+
+        while pending or not exhausted:
+            # Keep at most two slates or packs per worker queued so huge inputs are read
+            # lazily
+            while not exhausted and len(pending) < workers * 2:
+                group = next(groups, None)
+                if group is None:
+                    exhausted = True
+                else:
+                    pending.add(pool.submit(score, group))
+
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for result in (r for future in finished for r in future.result()):
+                save(result)
+                yield result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a batch of slates")
+    parser.add_argument("input", help="JSONL or CSV file with the slates")
+    parser.add_argument("output", help="JSONL file the results are appended to")
+    parser.add_argument("--checkpoint", help="Checkpoint file used to resume a run")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--pack", type=int, default=1, help="Most slates analysed in one model call"
+    )
+    parser.add_argument(
+        "--prioritize",
+        action="store_true",
+        help="Rate compliant slates locally first, then the most deviant first",
+    )
+    parser.add_argument("--metrics-port", type=int, help="Serve metrics on this port")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    start = time.perf_counter()
+    scored = failed = 0
+    for result in run_batch(
+        args.input,
+        args.output,
+        args.checkpoint,
+        args.workers,
+        args.pack,
+        args.prioritize,
+    ):
+        scored += 1
+        failed += result["status"] != "ok"
+        print(f"{result['slate_id']}\t{result['status']}\t{result['elapsed']}s")
+
+    print(
+        f"Scored {scored} slates ({failed} failed) in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main
+import metrics
+from batch import SLATE_FIELDS, run_batch
+
+
+class MockAzureOpenAI(ThreadingHTTPServer):
+    """Local stand-in for the Azure OpenAI chat completions API. Responses are valid slate
+    analyses, delayed by a lognormal latency, with configurable shares of malformed json
+    and 429 responses to exercise the repair, re-ask and rate limit handling.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        latency_median: float = 0.5,
+        latency_sigma: float = 0.5,
+        malformed_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        port: int = 0,
+    ):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.malformed_rate = malformed_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.counts = {"requests": 0, "malformed": 0, "rate_limited": 0, "cancelled": 0}
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def latency(self) -> float:
+        return random.lognormvariate(0, self.latency_sigma) * self.latency_median
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server: MockAzureOpenAI
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.count("requests")
+
+        if random.random() < self.server.rate_limit_rate:
+            self.server.count("rate_limited")
+            self._send_json(429, {"error": {"code": "429", "message": "Rate limit"}})
+            return
+
+        # A streamed response starts halfway through and trickles in, like a completion
+        # being generated
+        latency = self.server.latency()
+        time.sleep(latency / 2 if body.get("stream") else latency)
+        content = self._content(body["messages"])
+        prompt = "".join(m["content"] for m in body["messages"])
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (len(prompt) + len(content)) // 4,
+            "prompt_tokens_details": {
+                "cached_tokens": min(len(main.PROMPT_PREFIX), len(prompt)) // 4
+            },
+        }
+
+        try:
+            if body.get("stream"):
+                self._send_stream(body["model"], content, usage, latency / 2)
+            else:
+                self._send_json(200, completion(body["model"], content, usage))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the request, e.g. a hedged call that lost
+            self.server.count("cancelled")
+
+    def _content(self, messages: list) -> str:
+        prompt = messages[-1]["content"]
+        if "<excerpt>" in prompt:
+            return json.dumps({criterion: [] for criterion in main.CRITERIA})
+
+        compact = "Do not give any ratings" in messages[1]["content"]
+        ids = re.findall(r'<slate id="(\d+)">', prompt)
+        if not ids:
+            response = self._response(compact)
+            if isinstance(response, str):
+                return response[: random.randint(10, 200)]
+            return json.dumps(response, indent=2)
+
+        # Packed prompt, a truncated answer cuts off the answers after it as well
+        answers = {number: self._response(compact) for number in ids}
+        content = json.dumps(
+            {k: v for k, v in answers.items() if isinstance(v, dict)}, indent=2
+        )
+        if any(isinstance(v, str) for v in answers.values()):
+            content = content[: random.randint(10, len(content))]
+        return content
+
+    def _response(self, compact: bool):
+        # Analysis of one slate, the json text of it if it is to be truncated
+        response = sample_response()
+        if compact:
+            response = {
+                criterion: {k: v for k, v in entry.items() if k != "rating"}
+                for category in main.IDEAL_VALUES
+                for criterion, entry in response.pop(category).items()
+                if criterion != "Average Rating"
+            }
+            response["Summary"] = "Mock summary of the slate."
+        if random.random() < self.server.malformed_rate:
+            self.server.count("malformed")
+            if random.random() < 0.5:
+                return json.dumps(response)
+            del response[random.choice(list(response))]
+        return response
+
+    def _send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, model: str, content: str, usage: dict, duration: float):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        starts = range(0, len(content), 40)
+        for start in starts:
+            chunk = completion(model, content[start : start + 40], None, stream=True)
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            time.sleep(duration / len(starts))
+        final = {**completion(model, "", usage, stream=True), "choices": []}
+        self.wfile.write(
+            f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8")
+        )
+
+
+def completion(model: str, content: str, usage, stream: bool = False) -> dict:
+    """Builds a chat completion (or completion chunk) in the API's format."""
+    choice = {"index": 0, "finish_reason": None if stream else "stop"}
+    if stream:
+        choice["delta"] = {"role": "assistant", "content": content}
+    else:
+        choice["message"] = {"role": "assistant", "content": content}
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk" if stream else "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [choice],
+        "usage": usage,
+    }
+
+
+def sample_response() -> dict:
+    """Returns a valid analysis with random sentiments."""
+    response = {}
+    for category, values in main.IDEAL_VALUES.items():
+        response[category] = {}
+        for criterion in values:
+            sentiment = random.choice(list(main.SENTIMENT_RATINGS))
+            response[category][criterion] = {
+                "plan of action": f"Mock plan of action for {criterion}",
+                "sentiment": sentiment,
+                "rating": main.SENTIMENT_RATINGS[sentiment],
+            }
+    response["Summary"] = "Mock summary of the slate."
+    return main.compute_averages(response)
+
+
+def sample_slates(count: int, workflow_length: int = 2000) -> list:
+    """Generates slates that deviate from the ideal percentages, so each needs the model."""
+    slates = []
+    for number in range(count):
+        slate = {field: str(random.randint(0, 100)) for field in SLATE_FIELDS[:-1]}
+        slate["workflow"] = (
+            f"Slate {number}. "
+            + "The committee discussed the slate. " * (workflow_length // 35)
+        )
+        slate["slate_id"] = str(number)
+        slates.append(slate)
+    return slates
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else 0.0
+
+
+def run(args) -> dict:
+    """Runs the benchmark against mock servers and returns the report."""
+    servers = []
+    for _ in range(args.deployments):
+        server = MockAzureOpenAI(
+            args.latency_median,
+            args.latency_sigma,
+            args.malformed_rate,
+            args.rate_limit_rate,
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    workdir = Path(tempfile.mkdtemp(prefix="slate-benchmark-"))
+
+    # Point the pipeline at the mock servers, with a cache that never hits
+    env_file = workdir / ".env"
+    settings = [
+        f"RESPONSE_CACHE_PATH={workdir / 'cache.sqlite3'}",
+        "RESPONSE_CACHE_TTL=0",
+        f"RESULTS_STORE_PATH={workdir / 'results.sqlite3'}",
+    ]
+    for number, server in enumerate(servers, 1):
+        suffix = "" if number == 1 else f"_{number}"
+        settings += [
+            f"AZURE_OPENAI_KEY{suffix}=mock",
+            f"AZURE_OPENAI_ENDPOINT{suffix}={server.endpoint}",
+            f"DEPLOYMENT{suffix}=mock",
+        ]
+    if args.fast_latency_median:
+        # Cheaper tier of the cascade, faster but less reliable
+        fast = MockAzureOpenAI(
+            args.fast_latency_median,
+            args.latency_sigma,
+            args.fast_malformed_rate,
+            args.rate_limit_rate,
+        )
+        threading.Thread(target=fast.serve_forever, daemon=True).start()
+        servers.append(fast)
+        settings += [
+            f"FAST_AZURE_OPENAI_ENDPOINT={fast.endpoint}",
+            "FAST_DEPLOYMENT=mock-fast",
+        ]
+    env_file.write_text("\n".join(settings + args.setting) + "\n")
+    main.ENV_FILE = str(env_file)
+    main.reset_client()
+
+    slates = sample_slates(args.slates, args.workflow_length)
+    usage_before = main.get_usage_stats()
+    retries_before = metrics.RETRIES.value()
+    latencies = []
+    failures = 0
+    start = time.perf_counter()
+
+    if args.mode == "sequential":
+        for slate in slates:
+            begin = time.perf_counter()
+            try:
+                main.predict_slate_health(*(slate[field] for field in SLATE_FIELDS))
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - begin)
+    elif args.mode == "batch":
+        input_path = workdir / "slates.jsonl"
+        input_path.write_text("".join(json.dumps(slate) + "\n" for slate in slates))
+        for result in run_batch(
+            str(input_path),
+            str(workdir / "results.jsonl"),
+            workers=args.workers,
+            pack=args.pack,
+        ):
+            latencies.append(result["elapsed"])
+            failures += result["status"] != "ok"
+    else:
+
+        async def score(slate: dict, semaphore: asyncio.Semaphore):
+            async with semaphore:
+                begin = time.perf_counter()
+                try:
+                    await main.apredict_slate_health(
+                        *(slate[field] for field in SLATE_FIELDS)
+                    )
+                    failed = 0
+                except Exception:
+                    failed = 1
+                return time.perf_counter() - begin, failed
+
+        async def score_all():
+            semaphore = asyncio.Semaphore(args.workers)
+            return await asyncio.gather(*(score(slate, semaphore) for slate in slates))
+
+        for latency, failed in asyncio.run(score_all()):
+            latencies.append(latency)
+            failures += failed
+
+    elapsed = time.perf_counter() - start
+    for server in servers:
+        server.shutdown()
+    counts = {
+        name: sum(server.counts[name] for server in servers)
+        for name in ("requests", "malformed", "rate_limited", "cancelled")
+    }
+
+    usage = main.get_usage_stats()
+    tokens = sum(
+        usage[k] - usage_before[k] for k in ("prompt_tokens", "completion_tokens")
+    )
+    return {
+        "mode": args.mode,
+        "slates": len(slates),
+        "failures": failures,
+        "seconds": round(elapsed, 2),
+        "slates_per_second": round(len(slates) / elapsed, 2),
+        "p50": round(percentile(latencies, 0.50), 3),
+        "p95": round(percentile(latencies, 0.95), 3),
+        "p99": round(percentile(latencies, 0.99), 3),
+        "api_requests": counts["requests"],
+        "retries": int(metrics.RETRIES.value() - retries_before),
+        "slates_per_request": round(len(slates) / max(counts["requests"], 1), 2),
+        "malformed_responses": counts["malformed"],
+        "rate_limited_responses": counts["rate_limited"],
+        "cancelled_requests": counts["cancelled"],
+        "tokens_per_slate": round(tokens / len(slates), 1),
+        "deployments": main.get_deployment_stats(),
+        "hedging": main.get_hedge_stats(),
+        "cascade": main.get_cascade_stats(),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the slate pipeline against a local mock Azure OpenAI server"
+    )
+    parser.add_argument(
+        "--mode", choices=["sequential", "batch", "async"], default="batch"
+    )
+    parser.add_argument("--slates", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--workflow-length", type=int, default=2000)
+    parser.add_argument("--latency-median", type=float, default=0.5)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--malformed-rate", type=float, default=0.05)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--deployments", type=int, default=1)
+    parser.add_argument(
+        "--pack", type=int, default=1, help="Most slates per call in batch mode"
+    )
+    parser.add_argument(
+        "--fast-latency-median",
+        type=float,
+        help="Start a fast deployment with this latency to cascade from",
+    )
+    parser.add_argument("--fast-malformed-rate", type=float, default=0.1)
+    parser.add_argument(
+        "--setting",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Extra .env setting for the run, e.g. COMPACT_OUTPUT=true",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main.configure_logging()
+    random.seed(args.seed)
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,186 @@
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Callable, Optional
+from collections import OrderedDict
+
+
+def make_key(
+    percentages: list,
+    workflow: str,
+    deployment: str,
+    prompt_version: str,
+    tolerance: float = 0.0,
+) -> str:
+    """Builds the cache key of a slate. Percentages are compared as numbers and the
+    workflow ignoring differences in whitespace, so trivially different inputs share a key.
+
+    Args:
+        percentages (list): The 11 percentages as parsed numbers, or text if unparseable
+        workflow (str): Workflow Comment
+        deployment (str): Azure OpenAI Deployment Name
+        prompt_version (str): Version of the prompt template
+        tolerance (float): Pre-scoring tolerance, which decides what the model is asked
+
+    Returns:
+        str: Hex digest identifying the request
+    """
+    normalized = {
+        "percentages": percentages,
+        "workflow": re.sub(r"\s+", " ", workflow).strip(),
+        "deployment": deployment,
+        "prompt_version": prompt_version,
+        "tolerance": tolerance,
+    }
+    return hashlib.sha256(json.dumps(normalized).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache of validated responses: an in-process LRU in front of a SQLite file.
+    Entries expire after ttl seconds, and each tier evicts its least recently used entries
+    once it holds more than its maximum size. on_evict is called with the keys of the
+    entries that expired or were evicted from disk.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 7 * 24 * 3600,
+        max_memory_entries: int = 256,
+        max_disk_entries: int = 10000,
+        on_evict: Optional[Callable[[list], None]] = None,
+    ):
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.on_evict = on_evict
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )"""
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        """Looks up a response, first in memory and then on disk.
+
+        Args:
+            key (str): Key from make_key
+
+        Returns:
+            Optional[str]: Cached response, None if missing or expired
+        """
+        now = time.time()
+
+        with self._lock:
+            if key in self._memory:
+                value, created = self._memory[key]
+                if now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+            row = self._db.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] < self.ttl:
+                self._db.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                )
+                self._db.commit()
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                return row[0]
+
+            self.misses += 1
+            if not row:
+                return None
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+
+        self._evicted([key])
+        return None
+
+    def set(self, key: str, value: str):
+        """Stores a response in both tiers.
+
+        Args:
+            key (str): Key from make_key
+            value (str): Validated response
+        """
+        now = time.time()
+
+        with self._lock:
+            self._remember(key, value, now)
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            evicted = [
+                row[0]
+                for row in self._db.execute(
+                    "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?",
+                    (self.max_disk_entries,),
+                )
+            ]
+            self._db.executemany(
+                "DELETE FROM responses WHERE key = ?", [(k,) for k in evicted]
+            )
+            self._db.commit()
+
+        self._evicted(evicted)
+
+    def clear(self):
+        """Removes every entry from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            evicted = [row[0] for row in self._db.execute("SELECT key FROM responses")]
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+        self._evicted(evicted)
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters.
+
+        Returns:
+            dict: Hits, memory hits, disk hits, misses and hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.hits - self.memory_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    def _evicted(self, keys: list):
+        # Called outside the lock, the callback may take locks of its own
+        if keys and self.on_evict is not None:
+            self.on_evict(keys)
+
+    def _remember(self, key: str, value: str, created: float):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
@@ -0,0 +1,247 @@
+import json
+import argparse
+import warnings
+from typing import Iterable, Optional
+
+import numpy as np
+
+from main import (
+    CRITERIA,
+    DEFAULT_PRESCORE_TOLERANCE,
+    IDEAL_VALUES,
+    get_settings,
+    parse_percentage,
+)
+
+# Ideal percentage of each criterion, in the order of CRITERIA
+IDEAL = np.array(
+    [ideal for values in IDEAL_VALUES.values() for ideal in values.values()],
+    dtype=np.float64,
+)
+
+# Columns of each category, in the order of CRITERIA
+_bounds = np.cumsum([0] + [len(values) for values in IDEAL_VALUES.values()]).tolist()
+CATEGORY_SLICES = {
+    category: slice(start, end)
+    for category, start, end in zip(IDEAL_VALUES, _bounds, _bounds[1:])
+}
+
+# Deviation assumed for a percentage that can't be parsed, the model has to look at it
+UNKNOWN_DEVIATION = 100.0
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class Cohort:
+    """Percentages of the slates of a review cycle in one float array, one row per slate
+    and one column per criterion in the order of CRITERIA. Percentages that can't be
+    parsed are NaN. Every statistic is computed over the whole array at once.
+    """
+
+    def __init__(self, slate_ids: list, percentages: np.ndarray):
+        self.slate_ids = list(slate_ids)
+        self.percentages = percentages.reshape(len(self.slate_ids), len(CRITERIA))
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple]) -> "Cohort":
+        """Loads a cohort from (slate id, percentages) pairs.
+
+        Args:
+            rows (Iterable[tuple]): Slate id and the 11 percentages as text, in the order
+                of CRITERIA
+
+        Returns:
+            Cohort: Cohort of the slates
+        """
+        slate_ids, values = [], []
+        for slate_id, percentages in rows:
+            slate_ids.append(slate_id)
+            values.extend(parse_percentage(value) for value in percentages)
+        array = np.array(
+            [np.nan if value is None else value for value in values], dtype=np.float64
+        )
+        return cls(slate_ids, array)
+
+    def __len__(self) -> int:
+        return len(self.slate_ids)
+
+    def deviations(self) -> np.ndarray:
+        """Returns how far each percentage is from its ideal value, in percentage points.
+        Positive values are above the ideal, NaN marks percentages that can't be parsed.
+        """
+        return self.percentages - IDEAL
+
+    def excess(self, tolerance: float = 0.0) -> np.ndarray:
+        """Returns the absolute deviation beyond the tolerance of each percentage, with
+        UNKNOWN_DEVIATION for percentages that can't be parsed.
+
+        Args:
+            tolerance (float): Allowed deviation in percentage points
+        """
+        excess = np.maximum(np.abs(self.deviations()) - tolerance, 0.0)
+        return np.where(np.isnan(excess), UNKNOWN_DEVIATION, excess)
+
+    def category_scores(self, tolerance: float = 0.0) -> np.ndarray:
+        """Returns the mean excess deviation of each category, one column per category in
+        the order of IDEAL_VALUES.
+
+        Args:
+            tolerance (float): Allowed deviation in percentage points
+        """
+        excess = self.excess(tolerance)
+        return np.stack(
+            [excess[:, columns].mean(axis=1) for columns in CATEGORY_SLICES.values()],
+            axis=1,
+        )
+
+    def expected_deviation(self, tolerance: float = 0.0) -> np.ndarray:
+        """Returns the deviation score of each slate, the mean of its category scores, so
+        each category weighs the same whatever its number of criteria.
+
+        Args:
+            tolerance (float): Allowed deviation in percentage points
+        """
+        return self.category_scores(tolerance).mean(axis=1)
+
+    def compliant(self, tolerance: float = 0.0) -> np.ndarray:
+        """Returns which slates have every criterion within tolerance. Those are rated
+        locally without calling the model.
+
+        Args:
+            tolerance (float): Allowed deviation in percentage points
+        """
+        return ~(self.excess(tolerance) > 0).any(axis=1)
+
+    def ranking(self, tolerance: float = 0.0) -> np.ndarray:
+        """Returns the row of each slate that is not compliant, highest deviation score
+        first. Ties keep the input order.
+
+        Args:
+            tolerance (float): Allowed deviation in percentage points
+        """
+        scores = self.expected_deviation(tolerance)
+        order = np.argsort(-scores, kind="stable")
+        return order[~self.compliant(tolerance)[order]]
+
+    def outliers(self, threshold: float = 3.5) -> list:
+        """Finds percentages far from the rest of the cycle, by their modified z-score
+        against the median and the median absolute deviation of their criterion.
+
+        Args:
+            threshold (float): Modified z-score above which a percentage is an outlier
+
+        Returns:
+            list: Slate id, criterion, percentage and z-score of each outlier, largest
+                z-score first
+        """
+        if not len(self):
+            return []
+        with warnings.catch_warnings():
+            # Criteria without a single parsed percentage have a NaN median
+            warnings.simplefilter("ignore", RuntimeWarning)
+            median = np.nanmedian(self.percentages, axis=0)
+            spread = np.nanmedian(np.abs(self.percentages - median), axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = 0.6745 * np.abs(self.percentages - median) / spread
+        scores = np.where(spread > 0, scores, 0.0)
+        rows, columns = np.nonzero(np.nan_to_num(scores) > threshold)
+        found = [
+            {
+                "slate_id": self.slate_ids[row],
+                "criterion": CRITERIA[column],
+                "percentage": float(self.percentages[row, column]),
+                "z_score": round(float(scores[row, column]), 2),
+            }
+            for row, column in zip(rows, columns)
+        ]
+        return sorted(found, key=lambda outlier: -outlier["z_score"])
+
+    def summary(self, tolerance: float = 0.0, top: int = 10) -> dict:
+        """Describes the cycle: the distribution of every criterion and category score,
+        how many slates are compliant, the outliers and the most deviant slates.
+
+        Args:
+            tolerance (float): Allowed deviation in percentage points
+            top (int): Number of most deviant slates listed
+
+        Returns:
+            dict: Summary of the cohort, json serializable
+        """
+        deviations = self.deviations()
+        scores = self.category_scores(tolerance)
+        expected = self.expected_deviation(tolerance)
+        compliant = self.compliant(tolerance)
+
+        criteria = {}
+        if len(self):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                quantiles = np.nanpercentile(self.percentages, PERCENTILES, axis=0)
+                means = np.nanmean(deviations, axis=0)
+            beyond = (self.excess(tolerance) > 0).mean(axis=0)
+            for column, criterion in enumerate(CRITERIA):
+                criteria[criterion] = {
+                    "ideal": float(IDEAL[column]),
+                    "mean_deviation": _round(means[column]),
+                    "deviant_share": _round(beyond[column]),
+                    "unparsed": int(np.isnan(self.percentages[:, column]).sum()),
+                    "percentiles": {
+                        str(p): _round(quantiles[i, column])
+                        for i, p in enumerate(PERCENTILES)
+                    },
+                }
+
+        categories = {}
+        for column, category in enumerate(CATEGORY_SLICES):
+            values = scores[:, column]
+            categories[category] = {
+                "mean_score": _round(values.mean()) if len(self) else None,
+                "max_score": _round(values.max()) if len(self) else None,
+            }
+
+        return {
+            "slates": len(self),
+            "tolerance": tolerance,
+            "compliant": int(compliant.sum()),
+            "criteria": criteria,
+            "categories": categories,
+            "outliers": self.outliers(),
+            "most_deviant": [
+                {"slate_id": self.slate_ids[row], "score": _round(expected[row])}
+                for row in self.ranking(tolerance)[:top]
+            ],
+        }
+
+
+def _round(value) -> Optional[float]:
+    value = float(value)
+    return None if np.isnan(value) else round(value, 3)
+
+
+def main():
+    from batch import SLATE_FIELDS, read_slates
+
+    parser = argparse.ArgumentParser(
+        description="Summarise the diversity percentages of a review cycle"
+    )
+    parser.add_argument("input", help="JSONL or CSV file with the slates")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=float(
+            get_settings().get("PRESCORE_TOLERANCE") or DEFAULT_PRESCORE_TOLERANCE
+        ),
+        help="Allowed deviation in percentage points",
+    )
+    parser.add_argument("--top", type=int, default=10, help="Most deviant slates shown")
+    args = parser.parse_args()
+
+    cohort = Cohort.from_rows(
+        (slate["slate_id"], [slate[field] for field in SLATE_FIELDS[:-1]])
+        for slate in read_slates(args.input)
+    )
+    print(json.dumps(cohort.summary(args.tolerance, args.top), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import time
+import random
+import logging
+import threading
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import urlparse
+from contextlib import contextmanager
+
+import metrics
+from scheduler import DeadlineExceeded, remaining, retry_after
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncAzureOpenAI, AzureOpenAI
+
+# Consecutive failures after which a deployment is taken out of rotation
+DEFAULT_EJECT_AFTER = 3
+DEFAULT_EJECT_SECONDS = 30.0
+MAX_EJECT_SECONDS = 300.0
+
+
+class Deployment:
+    """One Azure OpenAI endpoint/deployment pair with its clients and health statistics."""
+
+    def __init__(
+        self,
+        name: str,
+        endpoint: str,
+        key: str,
+        api_version: str,
+        weight: float = 1.0,
+        limits: Optional["httpx.Limits"] = None,
+    ):
+        self.name = name
+        self.endpoint = endpoint
+        self.key = key
+        self.api_version = api_version
+        self.weight = weight
+        self.limits = limits
+        self.label = f"{urlparse(endpoint).hostname}/{name}"
+
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def client(self) -> "AzureOpenAI":
+        """Returns the deployment's AzureOpenAI client, creating it on first use.
+
+        Returns:
+            AzureOpenAI: Client for the endpoint
+        """
+        from openai import AzureOpenAI, DefaultHttpxClient
+
+        with self._lock:
+            if self._client is None:
+                self._client = AzureOpenAI(
+                    api_key=self.key,
+                    api_version=self.api_version,
+                    azure_endpoint=self.endpoint,
+                    http_client=DefaultHttpxClient(limits=self.limits),
+                    # Rate limits and transient errors are retried by the scheduler
+                    max_retries=0,
+                )
+                logging.info(f"Created AzureOpenAI client for {self.label}")
+            return self._client
+
+    def async_client(self) -> "AsyncAzureOpenAI":
+        """Returns the deployment's AsyncAzureOpenAI client, creating it on first use.
+
+        Returns:
+            AsyncAzureOpenAI: Async client for the endpoint
+        """
+        from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+
+        with self._lock:
+            if self._async_client is None:
+                self._async_client = AsyncAzureOpenAI(
+                    api_key=self.key,
+                    api_version=self.api_version,
+                    azure_endpoint=self.endpoint,
+                    http_client=DefaultAsyncHttpxClient(limits=self.limits),
+                    max_retries=0,
+                )
+                logging.info(f"Created AsyncAzureOpenAI client for {self.label}")
+            return self._async_client
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "deployment": self.name,
+                "endpoint": self.endpoint,
+                "weight": self.weight,
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "error_rate": (
+                    round(self.errors / self.requests, 3) if self.requests else 0.0
+                ),
+                "mean_seconds": (
+                    round(self.total_seconds / (self.requests - self.errors), 3)
+                    if self.requests > self.errors
+                    else 0.0
+                ),
+                "ejections": self.ejections,
+                "ejected": not self.healthy(time.monotonic()),
+            }
+
+
+class DeploymentPool:
+    """Routes calls to the least loaded healthy deployment, relative to its weight.
+    Deployments that keep failing are ejected for a while, longer each time, and rate
+    limited ones until their Retry-After time.
+    """
+
+    def __init__(
+        self,
+        deployments: list,
+        eject_after: int = DEFAULT_EJECT_AFTER,
+        eject_seconds: float = DEFAULT_EJECT_SECONDS,
+    ):
+        if not deployments:
+            raise ValueError("At least one deployment is required")
+        self.deployments = deployments
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+
+    def choose(self, exclude: tuple = ()) -> Deployment:
+        """Picks the deployment for the next call.
+
+        Args:
+            exclude (tuple): Deployments that already failed this call
+
+        Returns:
+            Deployment: Least loaded healthy deployment, or the one returning soonest if
+                every deployment is ejected
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                d
+                for d in self.deployments
+                if d not in exclude and d.healthy(now) and d.weight > 0
+            ]
+            if not candidates:
+                candidates = [d for d in self.deployments if d not in exclude] or list(
+                    self.deployments
+                )
+                return min(candidates, key=lambda d: d.ejected_until)
+
+            load = min(d.in_flight / d.weight for d in candidates)
+            # Ties are broken by weight, so idle pools still split traffic by weight
+            least_loaded = [d for d in candidates if d.in_flight / d.weight == load]
+            return random.choices(
+                least_loaded, weights=[d.weight for d in least_loaded]
+            )[0]
+
+    def has_alternative(self, exclude: tuple) -> bool:
+        """Whether a healthy deployment that hasn't failed this call is left."""
+        now = time.monotonic()
+        return any(
+            d not in exclude and d.healthy(now) and d.weight > 0
+            for d in self.deployments
+        )
+
+    @contextmanager
+    def track(self, deployment: Deployment, dropped: Optional[threading.Event] = None):
+        """Counts a call as in flight on a deployment and records its latency and outcome.
+
+        Args:
+            deployment (Deployment): Deployment handling the call
+            dropped (Optional[threading.Event]): Set once the result is no longer needed,
+                e.g. the losing copy of a hedged call. Its failure is not held against
+                the deployment
+        """
+        with deployment._lock:
+            deployment.in_flight += 1
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if dropped is not None and dropped.is_set():
+                metrics.DEPLOYMENT_REQUESTS.inc(
+                    deployment=deployment.label, outcome="dropped"
+                )
+                raise
+            if self._deadline_expired(e):
+                # The caller ran out of time, that says nothing about the deployment
+                metrics.DEPLOYMENT_REQUESTS.inc(
+                    deployment=deployment.label, outcome="deadline"
+                )
+                if isinstance(e, DeadlineExceeded):
+                    raise
+                raise DeadlineExceeded(
+                    "The request did not finish before its deadline"
+                ) from e
+            self._record_failure(deployment, e)
+            raise
+        else:
+            elapsed = time.perf_counter() - start
+            with deployment._lock:
+                deployment.requests += 1
+                deployment.total_seconds += elapsed
+                deployment.consecutive_failures = 0
+            metrics.DEPLOYMENT_SECONDS.observe(elapsed, deployment=deployment.label)
+            metrics.DEPLOYMENT_REQUESTS.inc(deployment=deployment.label, outcome="ok")
+        finally:
+            with deployment._lock:
+                deployment.in_flight -= 1
+
+    def stats(self) -> list:
+        """Returns the latency and error statistics of every deployment.
+
+        Returns:
+            list: Statistics of each deployment
+        """
+        return [deployment.stats() for deployment in self.deployments]
+
+    def _deadline_expired(self, error: Exception) -> bool:
+        # Calls only get the time left of their request's deadline as timeout, so a
+        # timeout once that time is up is the caller's deadline, not a slow deployment
+        if isinstance(error, DeadlineExceeded):
+            return True
+        from openai import APITimeoutError
+
+        left = remaining()
+        return isinstance(error, APITimeoutError) and left is not None and left < 0.01
+
+    def _record_failure(self, deployment: Deployment, error: Exception):
+        # Errors about the request itself say nothing about the deployment's health
+        status = getattr(error, "status_code", None)
+        if (
+            status is not None
+            and 400 <= status < 500
+            and status not in (401, 403, 404, 429)
+        ):
+            metrics.DEPLOYMENT_REQUESTS.inc(
+                deployment=deployment.label, outcome="rejected"
+            )
+            return
+
+        metrics.DEPLOYMENT_REQUESTS.inc(deployment=deployment.label, outcome="error")
+        with deployment._lock:
+            deployment.requests += 1
+            deployment.errors += 1
+            deployment.consecutive_failures += 1
+
+            if status == 429:
+                seconds = retry_after(error) or self.eject_seconds
+            elif deployment.consecutive_failures >= self.eject_after:
+                seconds = min(
+                    MAX_EJECT_SECONDS, self.eject_seconds * 2**deployment.ejections
+                )
+            else:
+                return
+            deployment.ejections += 1
+            deployment.ejected_until = time.monotonic() + seconds
+
+        metrics.DEPLOYMENT_EJECTIONS.inc(deployment=deployment.label)
+        logging.warning(
+            f"Ejected deployment {deployment.label} for {seconds:.0f}s after "
+            f"{type(error).__name__}"
+        )
+
+
+def load_deployments(
+    settings: dict, api_version: str, limits: "httpx.Limits", prefix: str = ""
+) -> list:
+    """Reads the deployments from the settings. The first one is AZURE_OPENAI_ENDPOINT,
+    AZURE_OPENAI_KEY and DEPLOYMENT, further ones add a suffix _2, _3, ... to each name
+    and use the endpoint and key of the first one unless they have their own.
+    DEPLOYMENT_WEIGHT(_n) and AZURE_OPENAI_API_VERSION(_n) are optional.
+
+    Args:
+        settings (dict): Settings from the .env file
+        api_version (str): API version used when none is set
+        limits (httpx.Limits): Connection pool limits of each client
+        prefix (str): Prefix of the names, e.g. "FAST_" for FAST_DEPLOYMENT. Endpoint,
+            key and API version fall back to the unprefixed settings
+
+    Returns:
+        list: Configured deployments
+
+    Raises:
+        ValueError: If a deployment has no endpoint
+    """
+
+    def setting(name: str, suffix: str) -> Optional[str]:
+        names = [f"{prefix}{name}{suffix}", f"{name}{suffix}"]
+        if suffix:
+            names += [f"{prefix}{name}", name]
+        return next((settings[n] for n in names if settings.get(n)), None)
+
+    deployments = []
+    number = 1
+    while True:
+        suffix = "" if number == 1 else f"_{number}"
+        if not settings.get(f"{prefix}DEPLOYMENT{suffix}"):
+            break
+        endpoint = setting("AZURE_OPENAI_ENDPOINT", suffix)
+        if not endpoint:
+            raise ValueError(
+                f"{prefix}DEPLOYMENT{suffix} has no endpoint, set "
+                f"{prefix}AZURE_OPENAI_ENDPOINT{suffix}"
+            )
+        deployments.append(
+            Deployment(
+                name=settings[f"{prefix}DEPLOYMENT{suffix}"],
+                endpoint=endpoint,
+                key=setting("AZURE_OPENAI_KEY", suffix),
+                api_version=setting("AZURE_OPENAI_API_VERSION", suffix) or api_version,
+                weight=float(settings.get(f"{prefix}DEPLOYMENT_WEIGHT{suffix}") or 1.0),
+                limits=limits,
+            )
+        )
+        number += 1
+    return deployments
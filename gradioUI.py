@@ -1,5 +1,19 @@
 import gradio as gr
-from main import predict_slate_health, add_key
+from datetime import datetime
+from main import (
+    astream_slate_health,
+    add_key,
+    configure_logging,
+    get_settings,
+    get_results_store,
+)
+from batch import OUTPUT_FIELDS
+from metrics import start_metrics_server
+from preflight import TokenBudgetExceeded
+from scheduler import DeadlineExceeded
+from results import CATEGORY_COLUMNS
+
+configure_logging()
 
 # Adding custom CSS styles
 custom_css = """
@@ -24,6 +38,20 @@ custom_css = """
 }
 """
 
+
+async def analyse(*inputs):
+    # Show why an analysis was rejected or timed out instead of a bare "Error"
+    try:
+        async for outputs in astream_slate_health(*inputs):
+            yield outputs
+    except TokenBudgetExceeded as e:
+        raise gr.Error(str(e))
+    except DeadlineExceeded:
+        raise gr.Error(
+            "The analysis took too long and was stopped, please try again later"
+        )
+
+
 with gr.Blocks(css=custom_css) as demo:
     gr.Label("eSlates Classification", elem_id="heading", elem_classes=["label-bg"])
     with gr.Row():
@@ -55,7 +83,9 @@ with gr.Blocks(css=custom_css) as demo:
                 assoc_prof = gr.Textbox(label="Associate Professor", value="20")
                 ass_prof = gr.Textbox(label="Assistant Professor", value="10")
             workflow = gr.TextArea(label="Workflow")
-            sub_button = gr.Button("Submit")
+            with gr.Row():
+                sub_button = gr.Button("Submit")
+                stop_button = gr.Button("Stop")
         with gr.Column():
             with gr.Row():
                 gr.Label("Average Rating", elem_classes=["label-bg"])
@@ -103,8 +133,8 @@ with gr.Blocks(css=custom_css) as demo:
                     ass_prof_rating = gr.Textbox(label="Rating")
                     ass_prof_reason = gr.Textbox(label="Reason")
 
-    sub_button.click(
-        fn=predict_slate_health,
+    submitted = sub_button.click(
+        fn=analyse,
         inputs=[
             urm,
             minority,
@@ -150,6 +180,13 @@ with gr.Blocks(css=custom_css) as demo:
         ],
         scroll_to_output=True,
     )
+    # Cancelling the event cancels the task streaming the analysis and closes its call
+    stop_button.click(fn=None, cancels=[submitted])
+
+
+def save_key(key, deployment, endpoint):
+    gr.Info(add_key(key, deployment, endpoint))
+
 
 with gr.Blocks(css=custom_css) as tab2:
     gr.Label("Add OpenAI Key", elem_id="heading", elem_classes=["label-bg"])
@@ -165,11 +202,103 @@ with gr.Blocks(css=custom_css) as tab2:
             sub_button2 = gr.Button("Submit")
             gr.ClearButton(key, deployment, endpoint)
 
-    sub_button2.click(fn=add_key, inputs=[key, deployment, endpoint])
+    sub_button2.click(fn=save_key, inputs=[key, deployment, endpoint])
+
+
+def search_history(
+    slate_id, min_overall, max_overall, category, min_rating, max_rating, limit
+):
+    """Looks up stored analyses for the history tab.
+
+    Returns:
+        tuple: Table rows of the matching results, and the full output of the newest one
+    """
+    results = get_results_store().search(
+        slate_id=slate_id.strip() or None,
+        min_overall=min_overall,
+        max_overall=max_overall,
+        category=category or None,
+        min_rating=min_rating,
+        max_rating=max_rating,
+        limit=int(limit or 100),
+    )
+    rows = [
+        [
+            r["slate_id"],
+            datetime.fromtimestamp(r["created"]).strftime("%Y-%m-%d %H:%M:%S"),
+            r["overall"],
+            r["demographic"],
+            r["geographic"],
+            r["seniority"],
+            r["output"][1],
+            r["model"],
+            r["seconds"],
+            (r["prompt_tokens"] or 0) + (r["completion_tokens"] or 0),
+        ]
+        for r in results
+    ]
+    latest = dict(zip(OUTPUT_FIELDS, results[0]["output"])) if results else {}
+    return rows, latest
+
+
+with gr.Blocks(css=custom_css) as tab3:
+    gr.Label("History", elem_id="heading", elem_classes=["label-bg"])
+
+    with gr.Row():
+        history_slate_id = gr.Textbox(label="Slate ID")
+        min_overall = gr.Number(label="Min Overall Rating", value=None)
+        max_overall = gr.Number(label="Max Overall Rating", value=None)
+    with gr.Row():
+        category = gr.Dropdown(
+            choices=[""] + list(CATEGORY_COLUMNS), value="", label="Category"
+        )
+        min_rating = gr.Number(label="Min Category Rating", value=None)
+        max_rating = gr.Number(label="Max Category Rating", value=None)
+        limit = gr.Number(label="Results", value=100, precision=0)
+    search_button = gr.Button("Search")
+    history = gr.Dataframe(
+        headers=[
+            "Slate ID",
+            "Time",
+            "Overall",
+            "Demographic",
+            "Geographic",
+            "Seniority",
+            "Summary",
+            "Model",
+            "Seconds",
+            "Tokens",
+        ],
+        wrap=True,
+    )
+    latest_output = gr.JSON(label="Newest Result")
+
+    search_button.click(
+        fn=search_history,
+        inputs=[
+            history_slate_id,
+            min_overall,
+            max_overall,
+            category,
+            min_rating,
+            max_rating,
+            limit,
+        ],
+        outputs=[history, latest_output],
+    )
+
 tabs = gr.TabbedInterface(
-    [tab2, demo], ["Add Key", "eSlate-classification"], css=custom_css
+    [tab2, demo, tab3], ["Add Key", "eSlate-classification", "History"], css=custom_css
+)
+
+# Analyses run as coroutines on one event loop, so the limit is not tied to a thread pool
+tabs.queue(
+    default_concurrency_limit=int(get_settings().get("GRADIO_CONCURRENCY_LIMIT") or 32),
+    max_size=int(get_settings().get("GRADIO_QUEUE_SIZE") or 256),
 )
 
 if __name__ == "__main__":
+    if get_settings().get("METRICS_PORT"):
+        start_metrics_server(int(get_settings()["METRICS_PORT"]))
     tabs.launch()
 # demo.launch(share=True)
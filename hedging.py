@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from typing import Awaitable, Callable, Optional
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+import metrics
+
+
+class Hedger:
+    """Sends a second copy of a call that is slower than a percentile of recent calls,
+    and returns whichever copy answers first. Calls use temperature 0, so both copies give
+    an equivalent answer. Hedges are capped at a share of all calls so a slow deployment
+    doesn't double the load on it.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        max_share: float = 0.1,
+        min_samples: int = 20,
+        window: int = 500,
+    ):
+        self.percentile = percentile
+        self.max_share = max_share
+        self.min_samples = min_samples
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        """Adds the latency of a completed call to the window the trigger is taken from.
+
+        Args:
+            seconds (float): Time the API took to answer
+        """
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self) -> Optional[float]:
+        """Returns after how many seconds a call is hedged, None until enough calls have
+        been observed.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+
+    def call(self, primary: Callable, backup: Callable):
+        """Runs primary, and backup as well if primary is slower than the trigger. A
+        thread can't be interrupted, so the copies have to stop on their own once the
+        other one answered, the caller returns without waiting for them.
+
+        Args:
+            primary (Callable): Function making the call
+            backup (Callable): Function making the hedge
+
+        Returns:
+            The result of the first copy to succeed
+        """
+        delay = self._start()
+        if delay is None:
+            return primary()
+
+        first = self._submit(primary)
+        done, _ = wait([first], timeout=delay)
+        if done or not self._allow_hedge():
+            return first.result()
+
+        logging.info(f"Hedging a call slower than {delay:.2f}s")
+        second = self._submit(backup)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._record_winner(future is second)
+                    return future.result()
+                error = error or future.exception()
+        metrics.HEDGES.inc(outcome="failed")
+        raise error
+
+    async def acall(
+        self, primary: Callable[[], Awaitable], backup: Callable[[], Awaitable]
+    ):
+        """Async version of call. The losing copy is cancelled, which closes its request.
+
+        Args:
+            primary (Callable[[], Awaitable]): Function returning the call coroutine
+            backup (Callable[[], Awaitable]): Function returning the hedge coroutine
+
+        Returns:
+            The result of the first copy to succeed
+        """
+        delay = self._start()
+        if delay is None:
+            return await primary()
+
+        first = asyncio.ensure_future(primary())
+        try:
+            done, _ = await asyncio.wait([first], timeout=delay)
+            if done or not self._allow_hedge():
+                return await first
+        except BaseException:
+            first.cancel()
+            raise
+
+        logging.info(f"Hedging a call slower than {delay:.2f}s")
+        second = asyncio.ensure_future(backup())
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        self._record_winner(task is second)
+                        return task.result()
+                    error = error or task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        metrics.HEDGES.inc(outcome="failed")
+        raise error
+
+    def stats(self) -> dict:
+        """Returns how often calls were hedged and which copy won.
+
+        Returns:
+            dict: Calls, hedges, hedge share, wins of each copy and the current trigger
+        """
+        delay = self.delay()
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_share": (
+                    round(self.hedges / self.calls, 3) if self.calls else 0.0
+                ),
+                "hedge_wins": self.hedge_wins,
+                "primary_wins": self.primary_wins,
+                "trigger_seconds": round(delay, 3) if delay is not None else None,
+            }
+
+    def _start(self) -> Optional[float]:
+        with self._lock:
+            self.calls += 1
+        return self.delay()
+
+    def _allow_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.max_share * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def _record_winner(self, hedge: bool):
+        with self._lock:
+            if hedge:
+                self.hedge_wins += 1
+            else:
+                self.primary_wins += 1
+        metrics.HEDGES.inc(outcome="hedge_won" if hedge else "primary_won")
+
+    def _submit(self, function: Callable) -> Future:
+        # Each copy gets a thread of its own, a fixed pool would cap the concurrent calls
+        # and a copy waiting for a worker would count as slow. Copies run in the caller's
+        # context, keeping its priority and metrics
+        future = Future()
+        context = contextvars.copy_context()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(context.run(function))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="hedge", daemon=True).start()
+        return future
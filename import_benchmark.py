@@ -0,0 +1,73 @@
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+# Modules that are only needed once a request is made or the UI is shown
+HEAVY_MODULES = ("gradio", "openai", "pydantic", "httpx", "httpx2", "numpy", "tiktoken")
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module: str, repeat: int = 5) -> dict:
+    """Imports a module in fresh interpreters and times the import.
+
+    Args:
+        module (str): Module to import, e.g. "main"
+        repeat (int): Number of interpreters to start
+
+    Returns:
+        dict: Median and slowest import time and the heavy modules it loaded
+    """
+    timings = []
+    loaded = set()
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        probe = json.loads(output.strip().splitlines()[-1])
+        timings.append(probe["seconds"])
+        loaded.update(probe["loaded"])
+
+    return {
+        "module": module,
+        "median_seconds": round(statistics.median(timings), 4),
+        "max_seconds": round(max(timings), 4),
+        "heavy_modules": sorted(loaded),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Guard the cold start time of the scoring core"
+    )
+    parser.add_argument("modules", nargs="*", default=["main", "batch"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--budget", type=float, default=0.5, help="Maximum median import seconds"
+    )
+    args = parser.parse_args()
+
+    reports = [measure(module, args.repeat) for module in args.modules]
+    print(json.dumps(reports, indent=2))
+
+    failed = [
+        r for r in reports if r["median_seconds"] > args.budget or r["heavy_modules"]
+    ]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,214 @@
+import re
+import json
+import asyncio
+import logging
+import contextvars
+from typing import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+
+# Workflows longer than this many characters are condensed before they are rated
+DEFAULT_THRESHOLD = 12000
+DEFAULT_CHUNK_SIZE = 6000
+DEFAULT_OVERLAP = 300
+DEFAULT_WORKERS = 4
+
+EXTRACTION_PROMPT = """Below is an excerpt of the comments about a slate by the evaluating committee, given in <excerpt> and </excerpt>.
+For each criterion listed after the excerpt, copy every sentence of the excerpt that states a plan of action
+or a justification for how the slate deals with that criterion. Copy the sentences word for word.
+Use "General" for plans of action about the diversity of the slate as a whole.
+Answer immediately without preamble with a json object mapping each criterion to a list of sentences,
+using an empty list when the excerpt says nothing about a criterion.
+"""
+
+
+def split_workflow(
+    workflow: str, chunk_size: int = DEFAULT_CHUNK_SIZE, overlap: int = DEFAULT_OVERLAP
+) -> list:
+    """Splits a workflow into chunks at paragraph boundaries. Paragraphs longer than a
+    chunk are cut into overlapping pieces so no sentence is lost at the cut.
+
+    Args:
+        workflow (str): Workflow Comment
+        chunk_size (int): Maximum number of characters of a chunk
+        overlap (int): Characters repeated between the pieces of a long paragraph
+
+    Returns:
+        list: Chunks of the workflow
+    """
+    paragraphs = []
+    for paragraph in re.split(r"\n\s*\n", workflow):
+        paragraph = paragraph.strip()
+        while len(paragraph) > chunk_size:
+            paragraphs.append(paragraph[:chunk_size])
+            paragraph = paragraph[chunk_size - overlap :]
+        if paragraph:
+            paragraphs.append(paragraph)
+
+    chunks = []
+    current = ""
+    for paragraph in paragraphs:
+        if current and len(current) + len(paragraph) + 2 > chunk_size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+def build_extraction_messages(chunk: str, criteria: list) -> list:
+    """Builds the prompt that extracts the plans of action from one chunk.
+
+    Args:
+        chunk (str): Part of the workflow
+        criteria (list): Names of the criteria to extract plans of action for
+
+    Returns:
+        list: List of message objects
+    """
+    names = ", ".join(list(criteria) + ["General"])
+    return [
+        {
+            "role": "system",
+            "content": "You are an analyst for the Center for Scientific Review committee.",
+        },
+        {
+            "role": "user",
+            "content": f"{EXTRACTION_PROMPT}\n<excerpt>{chunk}</excerpt>\n\nCriteria: {names}",
+        },
+    ]
+
+
+def parse_extraction(response: str, chunk: str) -> dict:
+    """Reads the sentences extracted from a chunk.
+
+    Args:
+        response (str): Response to the extraction prompt
+        chunk (str): The chunk the response is about, kept whole if the response is unusable
+
+    Returns:
+        dict: Extracted sentences of each criterion
+    """
+    start, end = response.find("{"), response.rfind("}")
+    try:
+        extracted = json.loads(response[start : end + 1])
+    except ValueError:
+        extracted = None
+
+    if not isinstance(extracted, dict):
+        logging.error("Failed to parse extracted plans of action, keeping the excerpt")
+        return {"General": [chunk]}
+
+    return {
+        criterion: [str(s) for s in sentences]
+        for criterion, sentences in extracted.items()
+        if isinstance(sentences, list)
+    }
+
+
+def combine_extractions(extractions: list, criteria: list) -> str:
+    """Combines the sentences extracted from every chunk into the condensed evidence.
+
+    Args:
+        extractions (list): Extracted sentences of each chunk, in document order
+        criteria (list): Names of the criteria
+
+    Returns:
+        str: Condensed workflow, listing the evidence of each criterion
+    """
+    lines = [
+        "The workflow was too long to include in full. Below are the statements about "
+        "each criterion extracted from it."
+    ]
+
+    for criterion in list(criteria) + ["General"]:
+        sentences = []
+        for extracted in extractions:
+            for sentence in extracted.get(criterion, []):
+                if sentence not in sentences:
+                    sentences.append(sentence)
+
+        lines.append(f"\n{criterion}:")
+        lines.extend(f"- {sentence}" for sentence in sentences)
+        if not sentences:
+            lines.append("- No statements found")
+
+    return "\n".join(lines)
+
+
+def condense_workflow(
+    workflow: str,
+    criteria: list,
+    analyse: Callable[[list], str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = DEFAULT_WORKERS,
+) -> str:
+    """Extracts the plans of action from every chunk of a long workflow in parallel and
+    returns them as condensed evidence to rate the slate on.
+
+    Args:
+        workflow (str): Workflow Comment
+        criteria (list): Names of the criteria to extract plans of action for
+        analyse (Callable[[list], str]): Function sending messages to the model
+        chunk_size (int): Maximum number of characters of a chunk
+        workers (int): Number of chunks processed concurrently
+
+    Returns:
+        str: Condensed workflow
+    """
+    chunks = split_workflow(workflow, chunk_size)
+    logging.info(
+        f"Condensing workflow of {len(workflow)} characters in {len(chunks)} chunks"
+    )
+
+    def extract(chunk: str) -> dict:
+        return parse_extraction(
+            analyse(build_extraction_messages(chunk, criteria)), chunk
+        )
+
+    # Each chunk runs in a copy of the caller's context, keeping its priority and metrics
+    contexts = [contextvars.copy_context() for _ in chunks]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        extractions = list(
+            pool.map(
+                lambda context, chunk: context.run(extract, chunk), contexts, chunks
+            )
+        )
+
+    return combine_extractions(extractions, criteria)
+
+
+async def acondense_workflow(
+    workflow: str,
+    criteria: list,
+    analyse: Callable[[list], Awaitable[str]],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = DEFAULT_WORKERS,
+) -> str:
+    """Async version of condense_workflow.
+
+    Args:
+        workflow (str): Workflow Comment
+        criteria (list): Names of the criteria to extract plans of action for
+        analyse (Callable[[list], Awaitable[str]]): Coroutine sending messages to the model
+        chunk_size (int): Maximum number of characters of a chunk
+        workers (int): Number of chunks processed concurrently
+
+    Returns:
+        str: Condensed workflow
+    """
+    chunks = split_workflow(workflow, chunk_size)
+    logging.info(
+        f"Condensing workflow of {len(workflow)} characters in {len(chunks)} chunks"
+    )
+    semaphore = asyncio.Semaphore(workers)
+
+    async def extract(chunk: str) -> dict:
+        async with semaphore:
+            response = await analyse(build_extraction_messages(chunk, criteria))
+        return parse_extraction(response, chunk)
+
+    extractions = await asyncio.gather(*(extract(chunk) for chunk in chunks))
+
+    return combine_extractions(extractions, criteria)
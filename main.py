@@ -1,20 +1,67 @@
 import json
 import re
+import functools
 import logging
-import gradio as gr
-from typing import Optional
+import copy
+import contextlib
+import time
+import sqlite3
+import threading
+import asyncio
+from typing import AsyncIterator, Iterator, Optional
 
 from dotenv import dotenv_values, set_key
-from openai import AzureOpenAI
-from pydantic import BaseModel, Field, ValidationError
 
-
-logging.basicConfig(
-    filename="app.log",
-    filemode="a",
-    format="%(asctime)s - %(message)s",
-    level=logging.INFO,
-)
+import longdoc
+import metrics
+import scheduler
+from cache import ResponseCache, make_key
+from deployments import DeploymentPool, load_deployments
+from hedging import Hedger
+from neardup import NearDuplicateIndex
+from preflight import MESSAGE_TOKENS, TokenBudgetExceeded, count_tokens, plan_request
+from results import ResultsStore
+
+ENV_FILE = ".env"
+LOG_FILE = "app.log"
+# Prompt caching and cached token counts need 2024-10-01-preview or later,
+# overridable with AZURE_OPENAI_API_VERSION in .env
+API_VERSION = "2024-10-21"
+
+# Connection pool defaults, overridable with HTTP_POOL_SIZE / HTTP_KEEPALIVE_EXPIRY in .env
+DEFAULT_POOL_SIZE = 20
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+
+# Context window of the deployment, overridable with CONTEXT_TOKENS in .env
+DEFAULT_CONTEXT_TOKENS = 128000
+# Workflows longer than this go straight to the main deployment when a fast deployment is
+# configured, overridable with CASCADE_MAX_WORKFLOW_TOKENS in .env
+DEFAULT_CASCADE_MAX_WORKFLOW_TOKENS = 1500
+# Largest difference between an average given by the model and the one of its ratings
+AVERAGE_TOLERANCE = 0.05
+
+# Time budget of a slate analysis in seconds, overridable with REQUEST_DEADLINE in .env
+DEFAULT_REQUEST_DEADLINE = 120.0
+# Expected length of a full and of a compact response
+COMPLETION_TOKENS = 1000
+COMPACT_COMPLETION_TOKENS = 500
+
+_client_lock = threading.RLock()
+_pool: Optional[DeploymentPool] = None
+_fast_pool: Optional[DeploymentPool] = None
+_settings: Optional[dict] = None
+_cache: Optional[ResponseCache] = None
+_results: Optional[ResultsStore] = None
+_near_duplicates: Optional[NearDuplicateIndex] = None
+_hedger: Optional[Hedger] = None
+_scheduler: Optional[scheduler.RequestScheduler] = None
+_structured_output_supported = True
+
+_usage_lock = threading.Lock()
+_usage = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+# Bump whenever the prompt changes so cached responses of the old prompt are not reused
+PROMPT_VERSION = "2"
 
 CONTEXT = """I'm going to give you a document that contains comments about a slate by the evaluating committee.
 A slate is the list of nominees and the supporting documentation for proposed new members 
@@ -49,6 +96,36 @@ IDEAL_PARAMETERS = """The ideal percentage of data for each criterion is given i
 	"assistant professor": "10%"
 }\n"""
 
+# Same ideal values as IDEAL_PARAMETERS, grouped by the categories of the response
+IDEAL_VALUES = {
+    "Demographic Diversity": {"URM": 20.0, "Minority": 50.0, "Female": 10.0},
+    "Geographic Diversity": {
+        "EA": 30.0,
+        "SO": 30.0,
+        "CE": 15.0,
+        "WE": 25.0,
+        "FO": 5.0,
+    },
+    "Seniority/Career Phase": {
+        "professor": 70.0,
+        "associate professor": 20.0,
+        "assistant professor": 10.0,
+    },
+}
+
+# Criteria in the order of the percentage arguments of predict_slate_health
+CRITERIA = [criterion for values in IDEAL_VALUES.values() for criterion in values]
+
+SATISFIED = {
+    "plan of action": "Criterion satisfied",
+    "sentiment": "Healthy",
+    "rating": 3,
+}
+
+# Allowed deviation in percentage points for a criterion to be settled locally,
+# overridable with PRESCORE_TOLERANCE in .env
+DEFAULT_PRESCORE_TOLERANCE = 0.0
+
 TASK = """The deviation from the ideal values should be considered to see whether the criterion is satisfied or not.	
 
 The demographic diversity criteria include URM, Minority and Female,
@@ -138,11 +215,175 @@ Answer immediately without preamble, do not include anything other than the json
     "Summary" : ""
   }
 </example>
+"""
+
+COMPACT_TASK = (
+    """The deviation from the ideal values should be considered to see whether the criterion is satisfied or not.
+
+For each of the criterion given in the json format,do the following two operations:
+1. Check whether any plan of action is stated in the workflow data given in <document> and <\\document> if the actual and ideal values are deviated.
+2. Find the sentiment for the plan of action as "Positive" or "Negative".
+If actual and ideal data are same, give: Plan of action as "Criterion satisfied" and sentiment as "Healthy". In case there is a plan of action given in workflow, provide that information. Also,
+If there is no plan of action provided for a deviant criterion, give plan of action as "No information provided", sentiment:"Negative".
+3. Based on the Plan of action of each criterion, Summarise your analysis.
+Do not give any ratings or averages, they are calculated from the sentiments.
+
+The format of your overall response should look like what's shown between the <example> tags.
+Answer immediately without preamble, do not include anything other than the json in your final response.
+
+<example>
+"""
+    + json.dumps(
+        {
+            **{c: {"plan of action": "", "sentiment": ""} for c in CRITERIA},
+            "Summary": "",
+        },
+        indent=2,
+    )
+    + """
+</example>
+"""
+)
+
+SYSTEM_PROMPT = "You are an analyst for the Center for Scientific Review committee."
+
+# Everything that is the same for every slate comes first, so the provider can reuse the
+# processed prefix across requests. Slate specific data only follows after it.
+PROMPT_PREFIX = f"""
+{CONTEXT}
+{IDEAL_PARAMETERS}
+{TASK}
+"""
 
+COMPACT_PROMPT_PREFIX = f"""
+{CONTEXT}
+{IDEAL_PARAMETERS}
+{COMPACT_TASK}
+"""
+
+
+# Top level sections of a response, in the order of the example
+SECTIONS = list(IDEAL_VALUES) + ["Overall Rating", "Summary"]
+
+SENTIMENT_RATINGS = {"Healthy": 3, "Positive": 2, "Negative": 1}
+
+# Most follow-up requests for the invalid sections of a response
+MAX_REASKS = 3
+
+REASK = """The sections {sections} of your response are missing or not formatted like the example.
+Reply with a json object containing only these sections, formatted exactly like the example."""
+
+PACKED_TASK = """Several slates are given below, each between <slate id="..."> and </slate> with its own percentages and workflow.
+Analyse every slate on its own as described above, the notes inside a slate only apply to that slate.
+Answer with one json object that maps the id of every slate to its analysis, each analysis formatted exactly like the example."""
+
+
+def _strict_schema(schema: dict) -> dict:
+    # Strict mode needs every property required and no extra properties or defaults
+    if isinstance(schema, dict):
+        schema.pop("default", None)
+        if "properties" in schema:
+            schema["required"] = list(schema["properties"])
+            schema["additionalProperties"] = False
+        for value in schema.values():
+            _strict_schema(value)
+    elif isinstance(schema, list):
+        for value in schema:
+            _strict_schema(value)
+    return schema
+
+
+@functools.lru_cache(maxsize=None)
+def response_model() -> type:
+    """Returns the pydantic model of a response. pydantic is imported on first use, so
+    importing this module stays cheap for scripts that never validate a response.
+
+    Returns:
+        type: ResponseModel
+    """
+    from models import ResponseModel
+
+    return ResponseModel
+
+
+@functools.lru_cache(maxsize=None)
+def _full_response_schema() -> dict:
+    # JSON schema of the response, derived from the models validate_response checks.
+    # The models accept nulls, which a complete answer never has, so the fields are
+    # narrowed to the types and sentiments the model has to give
+    schema = _strict_schema(response_model().model_json_schema(by_alias=True))
+    entry = schema["$defs"]["ActionRating"]["properties"]
+    entry["plan of action"] = {"type": "string"}
+    entry["sentiment"] = {"type": "string", "enum": list(SENTIMENT_RATINGS)}
+    entry["rating"] = {"type": "number"}
+    for category in schema["properties"].values():
+        if "$ref" in category:
+            ref = category["$ref"].split("/")[-1]
+            schema["$defs"][ref]["properties"]["Average Rating"] = {"type": "number"}
+    schema["properties"]["Overall Rating"] = {"type": "number"}
+    schema["properties"]["Summary"] = {"type": "string"}
+    return schema
+
+
+@functools.lru_cache(maxsize=None)
+def response_schema(deviant: tuple) -> dict:
+    """Returns the JSON schema of a response that only covers the given criteria, for the
+    structured output mode of the API.
 
-The workflow is given below in <document> and <\document> \n"""
+    Args:
+        deviant (tuple): Names of the criteria the model has to analyse
+
+    Returns:
+        dict: Strict JSON schema
+    """
+    schema = copy.deepcopy(_full_response_schema())
+
+    for category, values in IDEAL_VALUES.items():
+        ref = schema["properties"][category]["$ref"].split("/")[-1]
+        if not set(values) & set(deviant):
+            del schema["properties"][category]
+            del schema["$defs"][ref]
+            continue
+        properties = schema["$defs"][ref]["properties"]
+        for criterion in values:
+            if criterion not in deviant:
+                del properties[criterion]
+        schema["$defs"][ref]["required"] = list(properties)
+
+    schema["required"] = list(schema["properties"])
+    return schema
+
+
+@functools.lru_cache(maxsize=None)
+def compact_response_schema(deviant: tuple) -> dict:
+    """Returns the JSON schema of a compact response covering the given criteria.
 
+    Args:
+        deviant (tuple): Names of the criteria the model has to analyse
 
+    Returns:
+        dict: Strict JSON schema
+    """
+    entry = {
+        "type": "object",
+        "properties": {
+            "plan of action": {"type": "string"},
+            "sentiment": {"type": "string", "enum": list(SENTIMENT_RATINGS)},
+        },
+        "required": ["plan of action", "sentiment"],
+        "additionalProperties": False,
+    }
+    properties = {criterion: entry for criterion in CRITERIA if criterion in deviant}
+    properties["Summary"] = {"type": "string"}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+@metrics.timed("flatten")
 def structure_response(response_dict: dict) -> list:
     """Structure the response from OpenAI to display in gradio
 
@@ -261,6 +502,123 @@ def structure_response(response_dict: dict) -> list:
     return out_list
 
 
+def structure_partial(partial_dict: dict, settled: dict) -> list:
+    """Structures a response that is still being generated to display in gradio
+
+    Args:
+        partial_dict (dict): Top level sections of the response received so far
+        settled (dict): Ratings of the criteria settled locally
+
+    Returns:
+        list: List structured in order to display in gradio, empty where not known yet
+    """
+    empty = {"plan of action": "", "sentiment": "", "rating": ""}
+    response_dict = {"Overall Rating": "", "Summary": ""}
+
+    for category, values in IDEAL_VALUES.items():
+        section = partial_dict.get(category)
+        if not isinstance(section, dict):
+            section = {}
+        response_dict[category] = {"Average Rating": ""}
+        for criterion in values:
+            entry = settled.get(criterion) or section.get(criterion)
+            response_dict[category][criterion] = {**empty, **(entry or {})}
+        if not (settled.keys() & values.keys()):
+            response_dict[category]["Average Rating"] = section.get(
+                "Average Rating", ""
+            )
+
+    for key in ("Overall Rating", "Summary"):
+        if key in partial_dict:
+            response_dict[key] = partial_dict[key]
+
+    return structure_response(response_dict)
+
+
+class IncrementalJSONParser:
+    """Parses the top level members of a json object while its text is still arriving,
+    scanning every character once however the text is split into chunks.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member_start = None
+
+    def feed(self, chunk: str) -> dict:
+        """Adds the next piece of text.
+
+        Args:
+            chunk (str): Text following the previously fed text
+
+        Returns:
+            dict: Top level members completed by this chunk
+        """
+        completed = {}
+        self._buffer += chunk
+
+        while self._pos < len(self._buffer):
+            char = self._buffer[self._pos]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = self._depth > 0
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._member_start = self._pos + 1
+            elif char in "}]" or (char == "," and self._depth == 1):
+                if self._depth == 1 and self._member_start is not None:
+                    member = self._buffer[self._member_start : self._pos].strip()
+                    if member:
+                        try:
+                            completed.update(json.loads("{" + member + "}"))
+                        except ValueError:
+                            pass
+                    self._member_start = self._pos + 1
+                if char != ",":
+                    self._depth -= 1
+
+            self._pos += 1
+
+        return completed
+
+
+def invalid_sections(response_str: str) -> list:
+    """Finds the top level sections of a response that are missing or invalid.
+
+    Args:
+        response_str (str): Response from OpenAI
+
+    Returns:
+        list: Names of the invalid sections, every section if the response isn't json
+    """
+    from pydantic import ValidationError
+
+    try:
+        with metrics.timer("validation"):
+            response_model().model_validate_json(response_str)
+        return []
+    except ValidationError as e:
+        logging.error(e)
+        for error in e.errors():
+            section = error["loc"][0] if error["loc"] else "response"
+            metrics.record_validation_failure(section, error["type"])
+        sections = {error["loc"][0] for error in e.errors() if error["loc"]}
+        if not sections or any(error["type"] == "json_invalid" for error in e.errors()):
+            return list(SECTIONS)
+        return [section for section in SECTIONS if section in sections]
+
+
 def validate_response(response_str: str) -> bool:
     """function to validate json response from OpenAI, Returns True if AI response was structured correctly.
 
@@ -270,181 +628,2200 @@ def validate_response(response_str: str) -> bool:
     Returns:
         bool: True/False
     """
+    if invalid_sections(response_str):
+        logging.error("Failed to validate response from OpenAI")
+        return False
+    return True
 
-    class ActionRating(BaseModel):
-        plan_of_action: Optional[str] = Field("plan of action", alias="plan of action")
-        sentiment: Optional[str] = Field("sentiment", alias="sentiment")
-        rating: float | None = Field("rating", alias="rating")
-
-    class DemographicDiversity(BaseModel):
-        URM: ActionRating
-        Minority: ActionRating
-        Female: ActionRating
-        Average_Rating: float | None = Field("Average Rating", alias="Average Rating")
-
-    class GeographicDiversity(BaseModel):
-        EA: ActionRating
-        SO: ActionRating
-        CE: ActionRating
-        WE: ActionRating
-        FO: ActionRating
-        Average_Rating: float | None = Field("Average Rating", alias="Average Rating")
-
-    class SeniorityCareerPhase(BaseModel):
-        professor: ActionRating = Field("Professor", alias="professor")
-        associate_professor: ActionRating = Field(
-            "Associate Professor", alias="associate professor"
-        )
-        assistant_professor: ActionRating = Field(
-            "Assistant Professor", alias="assistant professor"
-        )
-        Average_Rating: float | None = Field("Average Rating", alias="Average Rating")
 
-    class ResponseModel(BaseModel):
-        Demographic_Diversity: DemographicDiversity = Field(
-            "Demographic Diversity", alias="Demographic Diversity"
-        )
-        Geographic_Diversity: GeographicDiversity = Field(
-            "Geographic Diversity", alias="Geographic Diversity"
-        )
-        Seniority_Career_Phase: SeniorityCareerPhase = Field(
-            "Seniority/Career Phase", alias="Seniority/Career Phase"
-        )
-        Overall_Rating: float | None = Field("Overall Rating", alias="Overall Rating")
-        Summary: Optional[str] = Field("Summary", alias="Summary")
+def repair_response(response_str: str) -> str:
+    """Fixes the common defects of a response locally: code fences or text around the json,
+    trailing commas, ratings given as text or left empty, and missing averages.
+
+    Args:
+        response_str (str): Response from OpenAI
+
+    Returns:
+        str: Repaired response, or the original one if it isn't json
+    """
+    response_dict = _load_json(response_str)
+    if response_dict is None:
+        return response_str
+
+    averages = []
+    for category, values in IDEAL_VALUES.items():
+        section = response_dict.get(category)
+        if not isinstance(section, dict):
+            continue
+
+        ratings = []
+        for criterion in values:
+            entry = section.get(criterion)
+            if not isinstance(entry, dict):
+                continue
+            rating = _as_rating(entry.get("rating"))
+            if rating is None:
+                rating = SENTIMENT_RATINGS.get(str(entry.get("sentiment")).strip())
+            entry["rating"] = rating if rating is not None else entry.get("rating")
+            ratings.append(rating)
+
+        if _as_rating(section.get("Average Rating")) is None:
+            if len(ratings) == len(values) and None not in ratings:
+                section["Average Rating"] = round(sum(ratings) / len(ratings), 2)
+        else:
+            section["Average Rating"] = _as_rating(section["Average Rating"])
+        averages.append(_as_rating(section.get("Average Rating")))
+
+    if _as_rating(response_dict.get("Overall Rating")) is None:
+        if len(averages) == len(IDEAL_VALUES) and None not in averages:
+            response_dict["Overall Rating"] = round(sum(averages) / len(averages), 2)
+    else:
+        response_dict["Overall Rating"] = _as_rating(response_dict["Overall Rating"])
+
+    return json.dumps(response_dict)
+
+
+def merge_sections(response_str: str, sections_str: str) -> str:
+    """Replaces sections of a response, or criteria within them, with the ones given in a
+    follow-up response.
+
+    Args:
+        response_str (str): Response with invalid sections
+        sections_str (str): Response containing only the re-requested sections
 
+    Returns:
+        str: Merged response, or the follow-up response if the first one isn't json
+    """
     try:
-        ResponseModel.model_validate_json(response_str)
-        return True
-    except ValidationError as e:
-        logging.error("Failed to validate response from OpenAI", exc_info=True)
-        logging.error(e)
-        return False
+        response_dict = json.loads(response_str)
+        sections = json.loads(sections_str)
+    except ValueError:
+        return sections_str
+    if not isinstance(response_dict, dict) or not isinstance(sections, dict):
+        return sections_str
+
+    for section, value in sections.items():
+        if section not in SECTIONS:
+            continue
+        if isinstance(value, dict) and isinstance(response_dict.get(section), dict):
+            response_dict[section].update(value)
+        else:
+            response_dict[section] = value
+    return json.dumps(response_dict)
+
+
+def expand_compact_response(response_str: str) -> str:
+    """Turns a compact response, holding only the plan of action and sentiment of each
+    criterion plus the summary, into the full response format. Ratings and averages are
+    left to repair_response, which computes them from the sentiments.
 
+    Args:
+        response_str (str): Compact response from OpenAI
 
-def get_analysis(messages: list) -> str:
-    """Calls the OpenAI Completions API, takes a list of message objects as input and returns AI response.
+    Returns:
+        str: Response in the full format, or the original one if it isn't json
+    """
+    compact = _load_json(response_str)
+    if compact is None:
+        return response_str
+    return json.dumps(expand_compact(compact))
+
+
+def expand_compact(compact: dict) -> dict:
+    """Nests the criteria of a (possibly partial) compact response under their categories.
 
     Args:
-        messages (list): List of message objects
+        compact (dict): Compact response
 
     Returns:
-        str: response from OpenAI model
+        dict: Response in the full format, holding the criteria present in the compact one
+    """
+    response_dict = {}
+
+    for category, values in IDEAL_VALUES.items():
+        for criterion in values:
+            entry = compact.get(criterion)
+            if isinstance(entry, dict):
+                entry = dict(entry)
+                entry["rating"] = SENTIMENT_RATINGS.get(
+                    str(entry.get("sentiment")).strip(), ""
+                )
+                response_dict.setdefault(category, {})[criterion] = entry
+
+    if "Summary" in compact:
+        response_dict["Summary"] = compact["Summary"]
+
+    return response_dict
+
+
+def _load_json(response_str: str) -> Optional[dict]:
+    # Strips code fences and text around the json object, and only drops trailing
+    # commas if the object isn't valid as it is, as the pattern also matches in strings
+    text = re.sub(r"```(?:json)?", "", response_str)
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return None
+    text = text[start : end + 1]
+
+    try:
+        response_dict = json.loads(text)
+    except ValueError:
+        try:
+            response_dict = json.loads(re.sub(r",\s*([}\]])", r"\1", text))
+        except ValueError:
+            return None
+    return response_dict if isinstance(response_dict, dict) else None
+
+
+def _as_rating(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_percentage(value: str) -> Optional[float]:
+    """Parses a percentage typed in the UI, such as "20", "20%" or " 20.0 ".
+
+    Args:
+        value (str): Percentage as text
+
+    Returns:
+        Optional[float]: Percentage as a number, None if it can't be parsed
+    """
+    try:
+        return float(str(value).strip().rstrip("%").strip())
+    except ValueError:
+        return None
+
+
+def prescore_slate(actual: dict, tolerance: float) -> tuple[dict, list]:
+    """Settles every criterion whose actual percentage is within tolerance of the ideal one,
+    so only the deviant criteria need to be analysed by the model.
+
+    Args:
+        actual (dict): Actual percentage of each criterion, as text
+        tolerance (float): Allowed deviation in percentage points
+
+    Returns:
+        tuple[dict, list]: Ratings of the settled criteria and names of the deviant ones
+    """
+    settled = {}
+    deviant = []
+
+    for values in IDEAL_VALUES.values():
+        for criterion, ideal in values.items():
+            value = parse_percentage(actual[criterion])
+            if value is not None and abs(value - ideal) <= tolerance:
+                settled[criterion] = dict(SATISFIED)
+            else:
+                deviant.append(criterion)
+
+    return settled, deviant
+
+
+def compute_averages(response_dict: dict) -> dict:
+    """Fills in the average rating of every category and the overall rating from the
+    ratings of the criteria.
+
+    Args:
+        response_dict (dict): Response with a rating for every criterion
+
+    Returns:
+        dict: The same response with the averages filled in
+    """
+    averages = []
+
+    for category, values in IDEAL_VALUES.items():
+        ratings = [float(response_dict[category][c]["rating"]) for c in values]
+        average = round(sum(ratings) / len(ratings), 2)
+        response_dict[category]["Average Rating"] = average
+        averages.append(average)
+
+    response_dict["Overall Rating"] = round(sum(averages) / len(averages), 2)
+
+    return response_dict
+
+
+def merge_prescored(response_str: str, settled: dict) -> str:
+    """Adds the locally settled criteria to a response that only covers the deviant ones
+    and recomputes the averages over all criteria.
+
+    Args:
+        response_str (str): Response from OpenAI
+        settled (dict): Ratings of the settled criteria
+
+    Returns:
+        str: Complete response, the original one if it isn't a json object, or one
+            without the averages that can't be computed, which invalid_sections rejects
+    """
+    if not settled:
+        return response_str
+
+    try:
+        response_dict = json.loads(response_str)
+        for category, values in IDEAL_VALUES.items():
+            response_dict.setdefault(category, {})
+            for criterion in values:
+                if criterion in settled:
+                    response_dict[category][criterion] = settled[criterion]
+    except (ValueError, TypeError, AttributeError):
+        return response_str
+
+    try:
+        return json.dumps(compute_averages(response_dict))
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        logging.warning(f"Failed to compute the averages of the response: {e!r}")
+
+    # The categories with a missing or invalid rating are left without an average, so
+    # they are asked for again instead of passing as complete
+    for category, values in IDEAL_VALUES.items():
+        section = response_dict[category]
+        try:
+            ratings = [float(section[criterion]["rating"]) for criterion in values]
+            section["Average Rating"] = round(sum(ratings) / len(ratings), 2)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            if isinstance(section, dict):
+                section.pop("Average Rating", None)
+    response_dict.pop("Overall Rating", None)
+    return json.dumps(response_dict)
+
+
+def inconsistencies(response_str: str) -> list:
+    """Finds numbers of a response that contradict each other: ratings that don't match
+    their sentiment, and averages that don't match the ratings they are taken from.
+
+    Args:
+        response_str (str): Repaired response, before the averages are recomputed
+
+    Returns:
+        list: Names of the criteria and sections that are inconsistent
+    """
+    response_dict = _load_json(response_str)
+    if response_dict is None:
+        return []
+
+    found = []
+    averages = []
+    for category, values in IDEAL_VALUES.items():
+        section = response_dict.get(category)
+        if not isinstance(section, dict):
+            continue
+
+        ratings = []
+        for criterion in values:
+            entry = section.get(criterion)
+            if not isinstance(entry, dict):
+                continue
+            rating = _as_rating(entry.get("rating"))
+            expected = SENTIMENT_RATINGS.get(str(entry.get("sentiment")).strip())
+            if rating is not None and expected is not None and rating != expected:
+                found.append(criterion)
+            if rating is not None:
+                ratings.append(rating)
+
+        average = _as_rating(section.get("Average Rating"))
+        if average is not None and ratings:
+            if abs(average - sum(ratings) / len(ratings)) > AVERAGE_TOLERANCE:
+                found.append(category)
+        averages.append(average)
+
+    overall = _as_rating(response_dict.get("Overall Rating"))
+    complete = len(averages) == len(IDEAL_VALUES) and None not in averages
+    if overall is not None and complete:
+        if abs(overall - sum(averages) / len(averages)) > AVERAGE_TOLERANCE:
+            found.append("Overall Rating")
+
+    return found
+
+
+def configure_logging(filename: str = LOG_FILE):
+    """Appends the log to a file. Called by the app and the command line tools, code
+    importing this module as a library keeps its own logging configuration.
+
+    Args:
+        filename (str): Log file
+    """
+    logging.basicConfig(
+        filename=filename,
+        filemode="a",
+        format="%(asctime)s - %(message)s",
+        level=logging.INFO,
+    )
+
+
+def get_settings() -> dict:
+    """Returns the settings from the .env file, reading the file only once.
+
+    Returns:
+        dict: Settings from the .env file
+    """
+    global _settings
+
+    if _settings is None:
+        with _client_lock:
+            if _settings is None:
+                _settings = dotenv_values(ENV_FILE)
+    return _settings
+
+
+def get_pool() -> DeploymentPool:
+    """Returns the shared pool of deployments, creating it on first use. Each deployment
+    has its own clients, which keep a pool of keep-alive connections and are safe to use
+    from several threads. Deployments after the first are configured with numbered
+    settings, see load_deployments.
+
+    Returns:
+        DeploymentPool: Pool of the configured deployments
     """
+    global _pool
+
+    if _pool is None:
+        with _client_lock:
+            if _pool is None:
+                secrets = get_settings()
+                _pool = DeploymentPool(
+                    load_deployments(
+                        secrets,
+                        secrets.get("AZURE_OPENAI_API_VERSION") or API_VERSION,
+                        _pool_limits(secrets),
+                    ),
+                    eject_after=int(secrets.get("DEPLOYMENT_EJECT_AFTER") or 3),
+                    eject_seconds=float(secrets.get("DEPLOYMENT_EJECT_SECONDS") or 30),
+                )
+                logging.info(
+                    f"Routing to deployments {[d.label for d in _pool.deployments]}"
+                )
+    return _pool
+
+
+def get_fast_pool() -> Optional[DeploymentPool]:
+    """Returns the pool of fast deployments if FAST_DEPLOYMENT is set in .env, creating it
+    on first use. Slates are analysed there first and escalated to the deployments of
+    get_pool when needed, see cascade_analysis. Further fast deployments and their
+    endpoints and keys use the names of load_deployments with a FAST_ prefix, falling
+    back to the main endpoint and key.
 
-    secrets = dotenv_values(".env")
-    API_KEY = secrets["AZURE_OPENAI_KEY"]
-    DEPLOYMENT = secrets["DEPLOYMENT"]
-    ENDPOINT = secrets["AZURE_OPENAI_ENDPOINT"]
+    Returns:
+        Optional[DeploymentPool]: Pool of the fast deployments, None if there are none
+    """
+    global _fast_pool
+
+    secrets = get_settings()
+    if not secrets.get("FAST_DEPLOYMENT"):
+        return None
+
+    if _fast_pool is None:
+        with _client_lock:
+            if _fast_pool is None:
+                _fast_pool = DeploymentPool(
+                    load_deployments(
+                        secrets,
+                        secrets.get("AZURE_OPENAI_API_VERSION") or API_VERSION,
+                        _pool_limits(secrets),
+                        prefix="FAST_",
+                    ),
+                    eject_after=int(secrets.get("DEPLOYMENT_EJECT_AFTER") or 3),
+                    eject_seconds=float(secrets.get("DEPLOYMENT_EJECT_SECONDS") or 30),
+                )
+                logging.info(
+                    f"Cascading from deployments "
+                    f"{[d.label for d in _fast_pool.deployments]}"
+                )
+    return _fast_pool
+
+
+def _pool_limits(secrets: dict) -> "httpx.Limits":
+    # The limits come from the HTTP library the openai client is built on, httpx or
+    # its successor depending on the openai version, which requirements.txt doesn't pin
+    try:
+        import httpx as http
+    except ImportError:
+        import httpx2 as http
 
-    client = AzureOpenAI(
-        api_key=API_KEY, api_version="2023-12-01-preview", azure_endpoint=ENDPOINT
+    pool_size = int(secrets.get("HTTP_POOL_SIZE") or DEFAULT_POOL_SIZE)
+    keepalive_expiry = float(
+        secrets.get("HTTP_KEEPALIVE_EXPIRY") or DEFAULT_KEEPALIVE_EXPIRY
     )
-    res = client.chat.completions.create(
-        model=DEPLOYMENT,
-        messages=messages,
-        temperature=0,
+    return http.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=keepalive_expiry,
     )
-    response_content = res.choices[0].message.content
-    match = re.search(r"```json\n(.*?)```", response_content, re.DOTALL)
 
-    if match:
-        response_content = match.group(1).strip()
 
-    logging.info(f"Response from OpenAI {response_content}")
+def get_results_store() -> ResultsStore:
+    """Returns the shared results store, opening it on first use. Its location comes from
+    RESULTS_STORE_PATH in .env.
 
-    return response_content
+    Returns:
+        ResultsStore: Store of every analysis
+    """
+    global _results
 
+    if _results is None:
+        with _client_lock:
+            if _results is None:
+                _results = ResultsStore(
+                    get_settings().get("RESULTS_STORE_PATH") or "results.sqlite3"
+                )
+    return _results
 
-def predict_slate_health(
-    urm: str,
-    minority: str,
-    female: str,
-    ea: str,
-    so: str,
-    ce: str,
-    we: str,
-    fo: str,
-    prof: str,
-    aprof: str,
-    assisprof: str,
-    workflow: str,
-) -> list:
-    """Analyses the Slate Workflow comments and compares the diversity ratios using OpenAI
 
-    Args:
-        urm (str): URM %
-        minority (str): Minority %
-        female (str): Female %
-        ea (str): EA %
-        so (str): SO %
-        ce (str): CE %
-        we (str): WE %
-        fo (str): FO %
-        prof (str): Professor %
-        aprof (str): Associate Professor %
-        assisprof (str): Assistant Professor %
-        workflow (str): Workflow Comment
+def get_near_duplicate_index() -> Optional[NearDuplicateIndex]:
+    """Returns the shared near duplicate index if NEAR_DUPLICATE_THRESHOLD is set in .env,
+    opening it on first use. It is kept in the response cache file unless
+    NEAR_DUPLICATE_INDEX_PATH is set.
 
     Returns:
-        list: list of rating and analysis for each criteria of a given slate
+        Optional[NearDuplicateIndex]: Index of analysed workflows, None if disabled
     """
-    diversity_demographics = f"""The percentage of data for each criterion are given in json format below.
-{{
-	"URM" : "{urm}&",
-	"Minority": "{minority}%",
-	"Female": "{female}%",
+    global _near_duplicates
 
-	"EA": "{ea}%",
-	"SO": "{so}%",
-	"CE": "{ce}%",
-	"WE": "{we}%",
-	"FO": "{fo}%",
+    secrets = get_settings()
+    if not secrets.get("NEAR_DUPLICATE_THRESHOLD"):
+        return None
 
-	"professor": "{prof}%",
-	"associate professor": "{aprof}%",
-	"assistant professor": "{assisprof}%"
-}}\n"""
+    if _near_duplicates is None:
+        with _client_lock:
+            if _near_duplicates is None:
+                _near_duplicates = NearDuplicateIndex(
+                    secrets.get("NEAR_DUPLICATE_INDEX_PATH")
+                    or secrets.get("RESPONSE_CACHE_PATH")
+                    or "response_cache.sqlite3",
+                    threshold=float(secrets["NEAR_DUPLICATE_THRESHOLD"]),
+                )
+    return _near_duplicates
 
-    document = f"""<document>{workflow}</document>"""
 
-    prompt = f"""
-{CONTEXT}
-{IDEAL_PARAMETERS}
-{diversity_demographics}
-{TASK}
-{document}
-"""
-    messages = [
-        {
-            "role": "system",
-            "content": "You are an analyst for the Center for Scientific Review committee.",
-        },
-        {"role": "user", "content": prompt},
-    ]
+def get_hedger() -> Optional[Hedger]:
+    """Returns the shared hedger if HEDGE_PERCENTILE is set in .env, e.g. 0.95 to hedge
+    calls slower than the 95th percentile of recent calls. HEDGE_MAX_SHARE caps the share
+    of calls that are hedged (default 0.1).
 
-    response = get_analysis(messages)
+    Returns:
+        Optional[Hedger]: Hedger of non-streaming calls, None if hedging is off
+    """
+    global _hedger
 
-    retries = 0
+    secrets = get_settings()
+    if not secrets.get("HEDGE_PERCENTILE"):
+        return None
 
-    while (not validate_response(response)) and retries < 3:
-        logging.info("AI response was not properly structured")
-        retries += 1
-        messages.append({"role": "assistant", "content": response})
-        messages.append(
-            {
-                "role": "user",
-                "content": "Looks like the output you gave is not properly formatted. Can you modify your response to match the example I gave",
-            }
-        )
-        response = get_analysis(messages)
+    if _hedger is None:
+        with _client_lock:
+            if _hedger is None:
+                _hedger = Hedger(
+                    percentile=float(secrets["HEDGE_PERCENTILE"]),
+                    max_share=float(secrets.get("HEDGE_MAX_SHARE") or 0.1),
+                    min_samples=int(secrets.get("HEDGE_MIN_SAMPLES") or 20),
+                )
+    return _hedger
 
-    response_dict = json.loads(response)
 
-    return structure_response(response_dict)
+def get_hedge_stats() -> dict:
+    """Returns how many calls were hedged and how often the hedge answered first.
+
+    Returns:
+        dict: Calls, hedges, hedge share, hedge and primary wins and the current trigger
+    """
+    hedger = get_hedger()
+    return hedger.stats() if hedger is not None else {}
+
+
+def get_scheduler() -> scheduler.RequestScheduler:
+    """Returns the shared request scheduler, creating it on first use. Budgets come from
+    RATE_LIMIT_RPM and RATE_LIMIT_TPM in .env (unset or 0 for no pacing), and
+    RATE_LIMIT_RETRIES caps the retries of rate limited and failed calls.
+
+    Returns:
+        scheduler.RequestScheduler: Scheduler pacing every call to the API
+    """
+    global _scheduler
+
+    if _scheduler is None:
+        with _client_lock:
+            if _scheduler is None:
+                secrets = get_settings()
+                _scheduler = scheduler.RequestScheduler(
+                    requests_per_minute=float(secrets.get("RATE_LIMIT_RPM") or 0),
+                    tokens_per_minute=float(secrets.get("RATE_LIMIT_TPM") or 0),
+                    max_retries=int(secrets.get("RATE_LIMIT_RETRIES") or 5),
+                )
+    return _scheduler
+
+
+def request_deadline():
+    """Returns the deadline of a slate analysis, REQUEST_DEADLINE seconds in .env. Every
+    call and retry of the analysis only gets the time that is left, 0 disables it.
+
+    Returns:
+        ContextManager: Block the deadline applies to
+    """
+    seconds = float(get_settings().get("REQUEST_DEADLINE") or DEFAULT_REQUEST_DEADLINE)
+    return scheduler.deadline(seconds or None)
+
+
+def get_cache() -> ResponseCache:
+    """Returns the shared response cache, opening it on first use. Location, lifetime and
+    size come from RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MEMORY_SIZE and
+    RESPONSE_CACHE_DISK_SIZE in .env.
+
+    Returns:
+        ResponseCache: Cache of validated responses
+    """
+    global _cache
+
+    if _cache is None:
+        with _client_lock:
+            if _cache is None:
+                secrets = get_settings()
+                _cache = ResponseCache(
+                    secrets.get("RESPONSE_CACHE_PATH") or "response_cache.sqlite3",
+                    ttl=float(secrets.get("RESPONSE_CACHE_TTL") or 7 * 24 * 3600),
+                    max_memory_entries=int(
+                        secrets.get("RESPONSE_CACHE_MEMORY_SIZE") or 256
+                    ),
+                    max_disk_entries=int(
+                        secrets.get("RESPONSE_CACHE_DISK_SIZE") or 10000
+                    ),
+                    on_evict=forget_near_duplicates,
+                )
+    return _cache
+
+
+def forget_near_duplicates(keys: list):
+    """Drops workflows from the near duplicate index once their responses expired or were
+    evicted from the response cache, so the index doesn't outgrow the cache.
+
+    Args:
+        keys (list): Cache keys of the responses
+    """
+    index = get_near_duplicate_index()
+    if index is not None:
+        index.remove(keys)
+
+
+def structured_output_schema(deviant: list) -> Optional[dict]:
+    """Returns the schema to request structured output with, if STRUCTURED_OUTPUT is
+    enabled in .env and the deployment hasn't rejected it.
+
+    Args:
+        deviant (list): Names of the criteria the model has to analyse
+
+    Returns:
+        Optional[dict]: Strict JSON schema, None to use the prompt only
+    """
+    if not setting_enabled("STRUCTURED_OUTPUT") or not _structured_output_supported:
+        return None
+    if compact_output():
+        return compact_response_schema(tuple(deviant))
+    return response_schema(tuple(deviant))
+
+
+def compact_output() -> bool:
+    """Whether the model is asked for the compact response format, holding only the plan
+    of action and sentiment of each criterion plus the summary (COMPACT_OUTPUT in .env).
+
+    Returns:
+        bool: True/False
+    """
+    return setting_enabled("COMPACT_OUTPUT")
+
+
+def setting_enabled(name: str) -> bool:
+    """Reads a true/false flag from the .env file.
+
+    Args:
+        name (str): Name of the setting
+
+    Returns:
+        bool: True if the setting is 1, true or yes
+    """
+    return str(get_settings().get(name) or "").strip().lower() in ("1", "true", "yes")
+
+
+def completion_request(
+    messages: list,
+    schema: Optional[dict] = None,
+    stream: bool = False,
+    model: Optional[str] = None,
+) -> dict:
+    """Builds the arguments of a chat completion request.
+
+    Args:
+        messages (list): List of message objects
+        schema (Optional[dict]): Strict JSON schema the response has to follow
+        stream (bool): Whether to stream the response
+        model (Optional[str]): Deployment to send the request to, DEPLOYMENT by default
+
+    Returns:
+        dict: Keyword arguments for chat.completions.create
+    """
+    request = {
+        "model": model or get_settings()["DEPLOYMENT"],
+        "messages": messages,
+        "temperature": 0,
+    }
+    if schema:
+        request["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "slate_analysis", "strict": True, "schema": schema},
+        }
+    if stream:
+        request["stream"] = True
+        request["stream_options"] = {"include_usage": True}
+    left = scheduler.remaining()
+    if left is not None:
+        # The call only gets the time left of the request's deadline
+        request["timeout"] = max(left, 0.001)
+    return request
+
+
+def _schema_rejected(error: Exception) -> bool:
+    # Deployments without structured output support reject the request up front,
+    # fall back to the prompt only path for the rest of the process
+    global _structured_output_supported
+
+    if "response_format" not in str(error) and "json_schema" not in str(error):
+        return False
+    logging.warning("Structured output is not supported, using the prompt only")
+    _structured_output_supported = False
+    return True
+
+
+def _create(
+    messages: list,
+    schema: Optional[dict] = None,
+    stream: bool = False,
+    pool: Optional[DeploymentPool] = None,
+):
+    # Sends one request through the scheduler, failing over to the other deployments
+    # of the pool and dropping the schema if it is rejected
+    from openai import BadRequestError
+
+    pool = pool or get_pool()
+    hedger = None if stream else get_hedger()
+    used = []
+    # The losing copy of a hedged call can't be interrupted in its thread, once the
+    # other copy answered it closes its response, makes no further attempt and its
+    # failure is ignored
+    dropped = threading.Event()
+
+    def send(deployment):
+        client = deployment.client()
+        # Hedged calls are streamed, so the losing copy can close its request as soon
+        # as it sees that the other one answered, instead of waiting for the whole
+        # completion it no longer needs
+        streamed = stream or hedger is not None
+        try:
+            response = client.chat.completions.create(
+                **completion_request(messages, schema, streamed, deployment.name)
+            )
+        except BadRequestError as e:
+            if not schema or not _schema_rejected(e):
+                raise
+            response = client.chat.completions.create(
+                **completion_request(messages, stream=streamed, model=deployment.name)
+            )
+        return response if stream or hedger is None else _collect(response, dropped)
+
+    def request(avoid: tuple = ()):
+        failed = avoid
+        while True:
+            scheduler.check_deadline()
+            deployment = pool.choose(failed)
+            used.append(deployment)
+            start = time.perf_counter()
+            try:
+                with pool.track(deployment, dropped):
+                    response = send(deployment)
+            except scheduler.retryable_errors():
+                failed += (deployment,)
+                if dropped.is_set() or not pool.has_alternative(failed):
+                    raise
+                logging.warning(f"Failing over from deployment {deployment.label}")
+                continue
+            if hedger is not None:
+                hedger.observe(time.perf_counter() - start)
+            return response, deployment
+
+    tokens = scheduler.estimate_tokens(messages)
+    if hedger is None:
+        response, deployment = get_scheduler().call(request, tokens)
+    else:
+        # The hedge avoids the deployment the first copy went to, if there is another
+        try:
+            response, deployment = hedger.call(
+                lambda: get_scheduler().call(request, tokens, dropped),
+                lambda: get_scheduler().call(
+                    lambda: request(tuple(used[:1])), tokens, dropped
+                ),
+            )
+        finally:
+            dropped.set()
+    metrics.record_deployment(deployment.name)
+    return response
+
+
+def _collect(stream, dropped: threading.Event):
+    # Reads a streamed completion into a regular one, closing the stream once dropped
+    from concurrent.futures import CancelledError
+
+    from openai.types.chat import ChatCompletion
+
+    content, usage, finish_reason, last = [], None, None, None
+    with contextlib.closing(stream):
+        for chunk in stream:
+            if dropped.is_set():
+                raise CancelledError("The call was dropped")
+            last = chunk
+            usage = chunk.usage or usage
+            if chunk.choices:
+                content.append(chunk.choices[0].delta.content or "")
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+    if last is None:
+        raise ValueError("The streamed completion was empty")
+    return ChatCompletion(
+        id=last.id,
+        created=last.created,
+        model=last.model,
+        object="chat.completion",
+        usage=usage,
+        choices=[
+            {
+                "index": 0,
+                "finish_reason": finish_reason or "stop",
+                "message": {"role": "assistant", "content": "".join(content)},
+            }
+        ],
+    )
+
+
+async def _acreate(
+    messages: list,
+    schema: Optional[dict] = None,
+    stream: bool = False,
+    pool: Optional[DeploymentPool] = None,
+):
+    from openai import BadRequestError
+
+    pool = pool or get_pool()
+
+    async def send(deployment):
+        client = deployment.async_client()
+        try:
+            return await client.chat.completions.create(
+                **completion_request(messages, schema, stream, deployment.name)
+            )
+        except BadRequestError as e:
+            if not schema or not _schema_rejected(e):
+                raise
+            return await client.chat.completions.create(
+                **completion_request(messages, stream=stream, model=deployment.name)
+            )
+
+    hedger = None if stream else get_hedger()
+    used = []
+
+    async def request(avoid: tuple = ()):
+        failed = avoid
+        while True:
+            scheduler.check_deadline()
+            deployment = pool.choose(failed)
+            used.append(deployment)
+            start = time.perf_counter()
+            try:
+                with pool.track(deployment):
+                    response = await send(deployment)
+            except scheduler.retryable_errors():
+                failed += (deployment,)
+                if not pool.has_alternative(failed):
+                    raise
+                logging.warning(f"Failing over from deployment {deployment.label}")
+                continue
+            if hedger is not None:
+                hedger.observe(time.perf_counter() - start)
+            return response, deployment
+
+    tokens = scheduler.estimate_tokens(messages)
+    if hedger is None:
+        response, deployment = await get_scheduler().acall(request, tokens)
+    else:
+        response, deployment = await hedger.acall(
+            lambda: get_scheduler().acall(request, tokens),
+            lambda: get_scheduler().acall(lambda: request(tuple(used[:1])), tokens),
+        )
+    metrics.record_deployment(deployment.name)
+    return response
+
+
+def stream_analysis(messages: list, schema: Optional[dict] = None) -> Iterator[str]:
+    """Calls the OpenAI Completions API with streaming, yielding the response as it is generated.
+
+    Args:
+        messages (list): List of message objects
+        schema (Optional[dict]): Strict JSON schema the response has to follow
+
+    Yields:
+        str: Next piece of the response from OpenAI model
+    """
+    stream = _create(messages, schema, stream=True)
+    with metrics.timer("api_stream"), contextlib.closing(stream):
+        for chunk in stream:
+            scheduler.check_deadline()
+            if chunk.usage:
+                record_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+async def astream_analysis(
+    messages: list, schema: Optional[dict] = None
+) -> AsyncIterator[str]:
+    """Async version of stream_analysis.
+
+    Args:
+        messages (list): List of message objects
+        schema (Optional[dict]): Strict JSON schema the response has to follow
+
+    Yields:
+        str: Next piece of the response from OpenAI model
+    """
+    stream = await _acreate(messages, schema, stream=True)
+    with metrics.timer("api_stream"):
+        try:
+            async for chunk in stream:
+                scheduler.check_deadline()
+                if chunk.usage:
+                    record_usage(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+
+def record_usage(usage) -> dict:
+    """Records the token usage of one call, splitting the prompt tokens into the ones served
+    from the provider's prompt cache and the ones processed from scratch.
+
+    Args:
+        usage: Usage from the completion response
+
+    Returns:
+        dict: Token counts of the call
+    """
+    if usage is None:
+        return {}
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    counts = {
+        "prompt_tokens": usage.prompt_tokens,
+        "cached_tokens": cached,
+        "uncached_tokens": usage.prompt_tokens - cached,
+        "completion_tokens": usage.completion_tokens,
+    }
+    logging.info(f"Token usage {counts}")
+    metrics.record_tokens(counts)
+
+    with _usage_lock:
+        _usage["calls"] += 1
+        _usage["prompt_tokens"] += counts["prompt_tokens"]
+        _usage["cached_tokens"] += counts["cached_tokens"]
+        _usage["completion_tokens"] += counts["completion_tokens"]
+
+    return counts
+
+
+def get_usage_stats() -> dict:
+    """Returns the token usage of all calls made by this process.
+
+    Returns:
+        dict: Calls, prompt, cached, uncached and completion tokens, and cache hit rate
+    """
+    with _usage_lock:
+        stats = dict(_usage)
+
+    stats["uncached_tokens"] = stats["prompt_tokens"] - stats["cached_tokens"]
+    stats["cached_share"] = (
+        round(stats["cached_tokens"] / stats["prompt_tokens"], 3)
+        if stats["prompt_tokens"]
+        else 0.0
+    )
+    return stats
+
+
+def get_cascade_stats() -> dict:
+    """Returns how many slates each tier of the cascade answered and why slates were
+    escalated from the fast deployment.
+
+    Returns:
+        dict: Slates answered by the fast and main tiers, share of the fast tier and
+            escalations by reason
+    """
+    fast = int(metrics.CASCADE.value(tier="fast"))
+    main = int(metrics.CASCADE.value(tier="main"))
+    return {
+        "fast": fast,
+        "main": main,
+        "fast_share": round(fast / (fast + main), 3) if fast + main else 0.0,
+        "escalations": {
+            reason: int(metrics.ESCALATIONS.value(reason=reason))
+            for reason in ("complex", "error", "inconsistent", "invalid")
+        },
+    }
+
+
+def get_deployment_stats() -> list:
+    """Returns the latency and error statistics of each deployment.
+
+    Returns:
+        list: Requests, errors, mean latency, in flight calls and ejections per deployment
+    """
+    return get_pool().stats()
+
+
+def reset_client():
+    """Drops the cached settings, clients and everything built from them, so the next
+    call picks up new credentials and deployments. Requests still running on the old
+    clients finish on them before they are released.
+    """
+    global _pool, _fast_pool, _settings, _scheduler, _hedger
+    global _cache, _results, _near_duplicates, _structured_output_supported
+
+    with _client_lock:
+        _pool = None
+        _fast_pool = None
+        _settings = None
+        _scheduler = None
+        # Latencies and structured output support belong to the old deployments, the
+        # stores may have moved with the settings
+        _hedger = None
+        _cache = None
+        _results = None
+        _near_duplicates = None
+        _structured_output_supported = True
+
+
+def get_analysis(
+    messages: list,
+    schema: Optional[dict] = None,
+    pool: Optional[DeploymentPool] = None,
+) -> str:
+    """Calls the OpenAI Completions API, takes a list of message objects as input and returns AI response.
+
+    Args:
+        messages (list): List of message objects
+        schema (Optional[dict]): Strict JSON schema the response has to follow
+        pool (Optional[DeploymentPool]): Deployments to call, the ones of get_pool by
+            default
+
+    Returns:
+        str: response from OpenAI model
+    """
+
+    with metrics.timer("api_call"):
+        res = _create(messages, schema, pool=pool)
+    return _response_content(res)
+
+
+async def aget_analysis(
+    messages: list,
+    schema: Optional[dict] = None,
+    pool: Optional[DeploymentPool] = None,
+) -> str:
+    """Async version of get_analysis, waits for the response without blocking a thread.
+
+    Args:
+        messages (list): List of message objects
+        schema (Optional[dict]): Strict JSON schema the response has to follow
+        pool (Optional[DeploymentPool]): Deployments to call, the ones of get_pool by
+            default
+
+    Returns:
+        str: response from OpenAI model
+    """
+    with metrics.timer("api_call"):
+        res = await _acreate(messages, schema, pool=pool)
+    return _response_content(res)
+
+
+def _response_content(res) -> str:
+    record_usage(res.usage)
+    response_content = res.choices[0].message.content
+    match = re.search(r"```json\n(.*?)```", response_content, re.DOTALL)
+
+    if match:
+        response_content = match.group(1).strip()
+
+    logging.info(f"Response from OpenAI {response_content}")
+
+    return response_content
+
+
+def prepare_slate(
+    percentages: list, workflow: str, tolerance: Optional[float] = None
+) -> tuple[Optional[str], dict, list, str]:
+    """Pre-scores a slate and looks it up in the response cache.
+
+    Args:
+        percentages (list): The 11 percentages in the order of CRITERIA
+        workflow (str): Workflow Comment
+        tolerance (Optional[float]): Allowed deviation in percentage points, defaults to
+            PRESCORE_TOLERANCE from .env
+
+    Returns:
+        tuple[Optional[str], dict, list, str]: Response if no model call is needed, ratings of
+            the settled criteria, names of the deviant criteria and the cache key
+    """
+    if tolerance is None:
+        tolerance = float(
+            get_settings().get("PRESCORE_TOLERANCE") or DEFAULT_PRESCORE_TOLERANCE
+        )
+
+    actual = dict(zip(CRITERIA, percentages))
+    settled, deviant = prescore_slate(actual, tolerance)
+
+    cache_key = slate_key(percentages, workflow, tolerance)
+
+    if not deviant:
+        logging.info("All criteria are within tolerance, skipping OpenAI")
+        metrics.set_outcome("prescored")
+        response_dict = {
+            category: {criterion: dict(SATISFIED) for criterion in values}
+            for category, values in IDEAL_VALUES.items()
+        }
+        response_dict["Summary"] = "All criteria match the ideal percentages."
+        return json.dumps(compute_averages(response_dict)), settled, deviant, cache_key
+
+    cached = get_cache().get(cache_key)
+    if cached is not None:
+        logging.info("Using cached response")
+        metrics.set_outcome("cached")
+    elif get_near_duplicate_index() is not None:
+        # Everything but the workflow has to match for an analysis to be reused
+        group = slate_key(percentages, "", tolerance)
+        cached = find_near_duplicate(workflow, group, cache_key)
+
+    return cached, settled, deviant, cache_key
+
+
+def slate_key(percentages: list, workflow: str, tolerance: float) -> str:
+    """Builds the response cache key of a slate for the current deployment and prompt.
+
+    Args:
+        percentages (list): The 11 percentages in the order of CRITERIA
+        workflow (str): Workflow Comment
+        tolerance (float): Allowed deviation in percentage points
+
+    Returns:
+        str: Cache key of the slate
+    """
+    parsed = [parse_percentage(value) for value in percentages]
+    normalized = [p if p is not None else v for p, v in zip(parsed, percentages)]
+    version = PROMPT_VERSION + ("-compact" if compact_output() else "")
+    if get_settings().get("FAST_DEPLOYMENT"):
+        # Responses of a cascade may come from the fast deployment
+        version += "-cascade"
+    return make_key(
+        normalized, workflow, get_settings()["DEPLOYMENT"], version, tolerance
+    )
+
+
+def find_near_duplicate(workflow: str, group: str, cache_key: str) -> Optional[str]:
+    """Looks for the cached response of an almost identical workflow with the same
+    percentages, and indexes the workflow so later near duplicates can reuse its response.
+
+    Args:
+        workflow (str): Workflow Comment
+        group (str): Key of the request without the workflow
+        cache_key (str): Key the response of this workflow will be cached under
+
+    Returns:
+        Optional[str]: Cached response of a near duplicate, None if there is none
+    """
+    index = get_near_duplicate_index()
+    with metrics.timer("near_duplicate"):
+        signature = index.signature(workflow)
+        # Workflows without a cached response, expired or never cached, are dropped
+        stale = []
+        for similarity, key in index.find(group, signature):
+            cached = get_cache().get(key)
+            if cached is not None:
+                logging.info(
+                    f"Using the response of a near duplicate workflow, "
+                    f"similarity {similarity:.2f}"
+                )
+                metrics.set_outcome("near_duplicate")
+                break
+            stale.append(key)
+        else:
+            cached = None
+            index.add(cache_key, group, signature)
+        if stale:
+            index.remove(stale)
+    return cached
+
+
+def condense_long_workflow(workflow: str, deviant: list, force: bool = False) -> str:
+    """Condenses a workflow longer than LONG_DOCUMENT_THRESHOLD characters (.env) to the
+    statements about each deviant criterion, extracted from its chunks in parallel.
+
+    Args:
+        workflow (str): Workflow Comment
+        deviant (list): Names of the criteria the model has to analyse
+        force (bool): Condense the workflow whatever its length
+
+    Returns:
+        str: The workflow, condensed if it is long
+    """
+    secrets = get_settings()
+    threshold = int(secrets.get("LONG_DOCUMENT_THRESHOLD") or longdoc.DEFAULT_THRESHOLD)
+    if len(workflow) <= threshold and not force:
+        return workflow
+
+    return longdoc.condense_workflow(
+        workflow,
+        deviant,
+        get_analysis,
+        chunk_size=int(
+            secrets.get("LONG_DOCUMENT_CHUNK_SIZE") or longdoc.DEFAULT_CHUNK_SIZE
+        ),
+        workers=int(secrets.get("LONG_DOCUMENT_WORKERS") or longdoc.DEFAULT_WORKERS),
+    )
+
+
+async def acondense_long_workflow(
+    workflow: str, deviant: list, force: bool = False
+) -> str:
+    """Async version of condense_long_workflow.
+
+    Args:
+        workflow (str): Workflow Comment
+        deviant (list): Names of the criteria the model has to analyse
+        force (bool): Condense the workflow whatever its length
+
+    Returns:
+        str: The workflow, condensed if it is long
+    """
+    secrets = get_settings()
+    threshold = int(secrets.get("LONG_DOCUMENT_THRESHOLD") or longdoc.DEFAULT_THRESHOLD)
+    if len(workflow) <= threshold and not force:
+        return workflow
+
+    return await longdoc.acondense_workflow(
+        workflow,
+        deviant,
+        aget_analysis,
+        chunk_size=int(
+            secrets.get("LONG_DOCUMENT_CHUNK_SIZE") or longdoc.DEFAULT_CHUNK_SIZE
+        ),
+        workers=int(secrets.get("LONG_DOCUMENT_WORKERS") or longdoc.DEFAULT_WORKERS),
+    )
+
+
+def prepare_messages(
+    percentages: list, workflow: str, settled: dict, deviant: list
+) -> list:
+    """Builds the prompt of a slate, with its workflow condensed if it is long, and checks
+    it against the token budget before anything is sent. A prompt over the budget is
+    built again from the condensed workflow.
+
+    Args:
+        percentages (list): The 11 percentages in the order of CRITERIA
+        workflow (str): Workflow Comment
+        settled (dict): Ratings of the criteria settled locally
+        deviant (list): Names of the criteria the model has to analyse
+
+    Returns:
+        list: List of message objects
+
+    Raises:
+        TokenBudgetExceeded: If the prompt is over the budget even when condensed
+    """
+    document = condense_long_workflow(workflow, deviant)
+    messages = build_messages(percentages, document, settled, deviant)
+    problem = check_token_budget(messages)
+    if problem and document == workflow:
+        logging.info(f"Prompt {problem}, condensing the workflow")
+        document = condense_long_workflow(workflow, deviant, force=True)
+        messages = build_messages(percentages, document, settled, deviant)
+        problem = check_token_budget(messages)
+
+    if problem:
+        metrics.set_outcome("over_budget")
+        raise TokenBudgetExceeded(
+            f"The workflow is too long to analyse, the prompt {problem}"
+        )
+    return messages
+
+
+async def aprepare_messages(
+    percentages: list, workflow: str, settled: dict, deviant: list
+) -> list:
+    """Async version of prepare_messages.
+
+    Args:
+        percentages (list): The 11 percentages in the order of CRITERIA
+        workflow (str): Workflow Comment
+        settled (dict): Ratings of the criteria settled locally
+        deviant (list): Names of the criteria the model has to analyse
+
+    Returns:
+        list: List of message objects
+
+    Raises:
+        TokenBudgetExceeded: If the prompt is over the budget even when condensed
+    """
+    document = await acondense_long_workflow(workflow, deviant)
+    messages = build_messages(percentages, document, settled, deviant)
+    problem = check_token_budget(messages)
+    if problem and document == workflow:
+        logging.info(f"Prompt {problem}, condensing the workflow")
+        document = await acondense_long_workflow(workflow, deviant, force=True)
+        messages = build_messages(percentages, document, settled, deviant)
+        problem = check_token_budget(messages)
+
+    if problem:
+        metrics.set_outcome("over_budget")
+        raise TokenBudgetExceeded(
+            f"The workflow is too long to analyse, the prompt {problem}"
+        )
+    return messages
+
+
+def check_token_budget(
+    messages: list, slates: int = 1, retries: int = MAX_REASKS
+) -> Optional[str]:
+    """Counts the tokens of a request and of its possible follow-ups, and records them.
+    The largest call has to fit CONTEXT_TOKENS, and all calls together have to fit
+    REQUEST_TOKEN_BUDGET if it is set in .env.
+
+    Args:
+        messages (list): List of message objects
+        slates (int): Slates answered by the request, more than 1 for a pack
+        retries (int): Most follow-up requests
+
+    Returns:
+        Optional[str]: Why the request is over the budget, None if it fits
+    """
+    secrets = get_settings()
+    completion = slates * (
+        COMPACT_COMPLETION_TOKENS if compact_output() else COMPLETION_TOKENS
+    )
+    # A follow-up adds the response and the request for its invalid sections
+    plan = plan_request(
+        messages,
+        completion,
+        retries,
+        completion + count_tokens(REASK) + 2 * MESSAGE_TOKENS,
+    )
+    metrics.record_preflight(plan)
+
+    context = int(secrets.get("CONTEXT_TOKENS") or DEFAULT_CONTEXT_TOKENS)
+    budget = int(secrets.get("REQUEST_TOKEN_BUDGET") or 0)
+    if plan["largest_call_tokens"] > context:
+        return f"needs {plan['largest_call_tokens']} tokens of a {context} context"
+    if budget and plan["projected_tokens"] > budget:
+        return f"may use {plan['projected_tokens']} tokens, over the budget of {budget}"
+    return None
+
+
+@metrics.timed("prompt_build")
+def build_messages(
+    percentages: list, workflow: str, settled: dict, deviant: list
+) -> list:
+    """Builds the prompt for a slate.
+
+    Args:
+        percentages (list): The 11 percentages in the order of CRITERIA
+        workflow (str): Workflow Comment
+        settled (dict): Ratings of the criteria settled locally
+        deviant (list): Names of the criteria the model has to analyse
+
+    Returns:
+        list: List of message objects
+    """
+    prefix = COMPACT_PROMPT_PREFIX if compact_output() else PROMPT_PREFIX
+
+    prompt = f"""{prefix}
+{slate_prompt(percentages, workflow, settled, deviant)}"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def slate_prompt(percentages: list, workflow: str, settled: dict, deviant: list) -> str:
+    """Builds the part of the prompt that is specific to a slate: its percentages, its
+    workflow and which criteria are already rated.
+
+    Args:
+        percentages (list): The 11 percentages in the order of CRITERIA
+        workflow (str): Workflow Comment
+        settled (dict): Ratings of the criteria settled locally
+        deviant (list): Names of the criteria the model has to analyse
+
+    Returns:
+        str: Slate specific prompt
+    """
+    urm, minority, female, ea, so, ce, we, fo, prof, aprof, assisprof = percentages
+
+    diversity_demographics = f"""The percentage of data for each criterion are given in json format below.
+{{
+	"URM" : "{urm}%",
+	"Minority": "{minority}%",
+	"Female": "{female}%",
+
+	"EA": "{ea}%",
+	"SO": "{so}%",
+	"CE": "{ce}%",
+	"WE": "{we}%",
+	"FO": "{fo}%",
+
+	"professor": "{prof}%",
+	"associate professor": "{aprof}%",
+	"assistant professor": "{assisprof}%"
+}}\n"""
+
+    document = f"""<document>{workflow}</document>"""
+
+    prompt = f"""{diversity_demographics}
+The workflow is given below in <document> and <\\document>
+{document}
+"""
+    if settled:
+        prompt += f"""
+The criteria {", ".join(settled)} are within tolerance of the ideal values and are already rated.
+Only include the criteria {", ".join(deviant)} in your response, leave out the others.
+"""
+    return prompt
+
+
+def build_packed_messages(slates: list) -> list:
+    """Builds one prompt asking for the analysis of several slates. The shared prefix comes
+    first as in build_messages, followed by each slate tagged with its position as id.
+
+    Args:
+        slates (list): (percentages, workflow, settled, deviant) of each slate
+
+    Returns:
+        list: List of message objects
+    """
+    prefix = COMPACT_PROMPT_PREFIX if compact_output() else PROMPT_PREFIX
+
+    prompt = f"""{prefix}
+{PACKED_TASK}
+"""
+    for number, slate in enumerate(slates, start=1):
+        prompt += f"""
+<slate id="{number}">
+{slate_prompt(*slate)}</slate>
+"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def finish_response(
+    response: str, messages: list, settled: dict, cache_key: str
+) -> str:
+    """Repairs and validates a response, asks again for the sections that are still
+    invalid and caches the result once it is valid.
+
+    Args:
+        response (str): Response from OpenAI
+        messages (list): Messages the response was generated from
+        settled (dict): Ratings of the criteria settled locally
+        cache_key (str): Key the valid response is cached under
+
+    Returns:
+        str: Complete response
+    """
+    if compact_output():
+        response = expand_compact_response(response)
+    response = merge_prescored(repair_response(response), settled)
+
+    retries = 0
+
+    sections = invalid_sections(response)
+
+    while sections and retries < MAX_REASKS:
+        logging.info(f"AI response was not properly structured: {sections}")
+        retries += 1
+        metrics.record_retry()
+        with metrics.timer("retry"):
+            patch = get_analysis(reask_messages(messages, response, sections))
+            response = apply_patch(response, patch, settled)
+        sections = invalid_sections(response)
+
+    if sections:
+        metrics.set_outcome("invalid")
+    else:
+        get_cache().set(cache_key, response)
+
+    return response
+
+
+async def afinish_response(
+    response: str, messages: list, settled: dict, cache_key: str
+) -> str:
+    """Async version of finish_response.
+
+    Args:
+        response (str): Response from OpenAI
+        messages (list): Messages the response was generated from
+        settled (dict): Ratings of the criteria settled locally
+        cache_key (str): Key the valid response is cached under
+
+    Returns:
+        str: Complete response
+    """
+    if compact_output():
+        response = expand_compact_response(response)
+    response = merge_prescored(repair_response(response), settled)
+
+    retries = 0
+
+    sections = invalid_sections(response)
+
+    while sections and retries < MAX_REASKS:
+        logging.info(f"AI response was not properly structured: {sections}")
+        retries += 1
+        metrics.record_retry()
+        with metrics.timer("retry"):
+            patch = await aget_analysis(reask_messages(messages, response, sections))
+            response = apply_patch(response, patch, settled)
+        sections = invalid_sections(response)
+
+    if sections:
+        metrics.set_outcome("invalid")
+    else:
+        await asyncio.to_thread(get_cache().set, cache_key, response)
+
+    return response
+
+
+def cascade_analysis(
+    messages: list, workflow: str, settled: dict, deviant: list, cache_key: str
+) -> str:
+    """Gets the complete response of a slate. With FAST_DEPLOYMENT set in .env, the slate
+    is analysed on the fast deployment first and escalated to the main deployment if its
+    workflow is longer than CASCADE_MAX_WORKFLOW_TOKENS, or if the fast response is
+    invalid or inconsistent. Follow-up requests are only made on the main deployment.
+
+    Args:
+        messages (list): Messages of the slate
+        workflow (str): Workflow Comment as entered
+        settled (dict): Ratings of the criteria settled locally
+        deviant (list): Names of the criteria the model has to analyse
+        cache_key (str): Key the valid response is cached under
+
+    Returns:
+        str: Complete response
+    """
+    from openai import APIError
+
+    schema = structured_output_schema(deviant)
+    fast = get_fast_pool()
+    if fast is not None:
+        reason = cascade_complexity(workflow)
+        if reason is None:
+            try:
+                response = get_analysis(messages, schema, pool=fast)
+                response, reason = check_fast_response(response, settled)
+            except APIError:
+                # Any API error escalates, even from a misconfigured fast deployment.
+                # A request out of time raises DeadlineExceeded and fails instead
+                logging.warning("Fast deployment failed", exc_info=True)
+                reason = "error"
+        if reason is None:
+            metrics.record_tier("fast")
+            get_cache().set(cache_key, response)
+            return response
+        logging.info(f"Escalating to the main deployment, {reason}")
+        metrics.record_escalation(reason)
+
+    response = get_analysis(messages, schema)
+    response = finish_response(response, messages, settled, cache_key)
+    if fast is not None:
+        metrics.record_tier("main")
+    return response
+
+
+async def acascade_analysis(
+    messages: list, workflow: str, settled: dict, deviant: list, cache_key: str
+) -> str:
+    """Async version of cascade_analysis.
+
+    Args:
+        messages (list): Messages of the slate
+        workflow (str): Workflow Comment as entered
+        settled (dict): Ratings of the criteria settled locally
+        deviant (list): Names of the criteria the model has to analyse
+        cache_key (str): Key the valid response is cached under
+
+    Returns:
+        str: Complete response
+    """
+    from openai import APIError
+
+    schema = structured_output_schema(deviant)
+    fast = get_fast_pool()
+    if fast is not None:
+        reason = cascade_complexity(workflow)
+        if reason is None:
+            try:
+                response = await aget_analysis(messages, schema, pool=fast)
+                response, reason = check_fast_response(response, settled)
+            except APIError:
+                # Any API error escalates, even from a misconfigured fast deployment.
+                # A request out of time raises DeadlineExceeded and fails instead
+                logging.warning("Fast deployment failed", exc_info=True)
+                reason = "error"
+        if reason is None:
+            metrics.record_tier("fast")
+            await asyncio.to_thread(get_cache().set, cache_key, response)
+            return response
+        logging.info(f"Escalating to the main deployment, {reason}")
+        metrics.record_escalation(reason)
+
+    response = await aget_analysis(messages, schema)
+    response = await afinish_response(response, messages, settled, cache_key)
+    if fast is not None:
+        metrics.record_tier("main")
+    return response
+
+
+def cascade_complexity(workflow: str) -> Optional[str]:
+    """Returns "complex" if a workflow is too long to be left to the fast deployment.
+
+    Args:
+        workflow (str): Workflow Comment as entered
+
+    Returns:
+        Optional[str]: Reason to escalate, None if the fast deployment may try
+    """
+    limit = int(
+        get_settings().get("CASCADE_MAX_WORKFLOW_TOKENS")
+        or DEFAULT_CASCADE_MAX_WORKFLOW_TOKENS
+    )
+    return "complex" if count_tokens(workflow) > limit else None
+
+
+def check_fast_response(response: str, settled: dict) -> tuple[str, Optional[str]]:
+    """Repairs a response of the fast deployment and checks it can be used as is.
+
+    Args:
+        response (str): Response from the fast deployment
+        settled (dict): Ratings of the criteria settled locally
+
+    Returns:
+        tuple[str, Optional[str]]: Complete response, and "inconsistent" or "invalid" if
+            it has to be escalated
+    """
+    if compact_output():
+        response = expand_compact_response(response)
+    response = repair_response(response)
+
+    found = inconsistencies(response)
+    if found:
+        logging.info(f"Fast response is inconsistent: {found}")
+        return response, "inconsistent"
+
+    response = merge_prescored(response, settled)
+    if invalid_sections(response):
+        return response, "invalid"
+    return response, None
+
+
+def reask_messages(messages: list, response: str, sections: list) -> list:
+    """Builds the follow-up request for the invalid sections of a response. The response
+    is sent back as the assistant's answer and only the broken sections are asked for
+    again.
+
+    Args:
+        messages (list): Messages the response was generated from
+        response (str): Response with invalid sections
+        sections (list): Names of the invalid sections
+
+    Returns:
+        list: List of message objects
+    """
+    # The overall rating is recomputed locally once the categories are valid
+    asked = [s for s in sections if s != "Overall Rating"] or sections
+    if compact_output():
+        # Compact responses have no categories, ask for their criteria instead
+        asked = [
+            name
+            for section in asked
+            for name in (
+                IDEAL_VALUES[section] if section in IDEAL_VALUES else [section]
+            )
+        ]
+    return messages + [
+        {"role": "assistant", "content": response},
+        {"role": "user", "content": REASK.format(sections=", ".join(asked))},
+    ]
+
+
+def apply_patch(response: str, patch: str, settled: dict) -> str:
+    """Merges the re-requested sections into a response.
+
+    Args:
+        response (str): Response with invalid sections
+        patch (str): Response to the follow-up request
+        settled (dict): Ratings of the criteria settled locally
+
+    Returns:
+        str: Merged and repaired response
+    """
+    if compact_output():
+        patch = expand_compact_response(patch)
+    response = repair_response(merge_sections(response, repair_response(patch)))
+    return merge_prescored(response, settled)
+
+
+def record_result(
+    response_dict: dict,
+    percentages: list,
+    workflow: str,
+    cache_key: str,
+    slate_id: Optional[str] = None,
+    tokens: Optional[dict] = None,
+) -> list:
+    """Flattens a response for display and keeps it in the results store, together with
+    the inputs, latency and token usage of the current request.
+
+    Args:
+        response_dict (dict): Validated response
+        percentages (list): The 11 percentages as entered
+        workflow (str): Workflow Comment as entered
+        cache_key (str): Key of the slate, identifies it when no slate id is given
+        slate_id (Optional[str]): Identifier of the slate
+        tokens (Optional[dict]): Token counts to store instead of the ones of the request
+
+    Returns:
+        list: list of rating and analysis for each criteria of a given slate
+    """
+    output = structure_response(response_dict)
+    trace = metrics.current_trace() or {}
+
+    try:
+        get_results_store().add(
+            slate_id or cache_key[:16],
+            percentages,
+            workflow,
+            response_dict,
+            output,
+            # Responses settled locally or cached have no deployment of their own
+            model=trace.get("deployment") or get_settings().get("DEPLOYMENT"),
+            outcome=trace.get("outcome"),
+            seconds=round(time.time() - trace.get("started", time.time()), 3),
+            tokens=tokens if tokens is not None else trace.get("tokens"),
+        )
+    except sqlite3.Error:
+        logging.error("Failed to store the result", exc_info=True)
+
+    return output
+
+
+def predict_slate_health(
+    urm: str,
+    minority: str,
+    female: str,
+    ea: str,
+    so: str,
+    ce: str,
+    we: str,
+    fo: str,
+    prof: str,
+    aprof: str,
+    assisprof: str,
+    workflow: str,
+    tolerance: Optional[float] = None,
+    slate_id: Optional[str] = None,
+) -> list:
+    """Analyses the Slate Workflow comments and compares the diversity ratios using OpenAI.
+    Criteria within tolerance of their ideal value are rated locally, and the model is not
+    called at all when every criterion is within tolerance.
+
+    Args:
+        urm (str): URM %
+        minority (str): Minority %
+        female (str): Female %
+        ea (str): EA %
+        so (str): SO %
+        ce (str): CE %
+        we (str): WE %
+        fo (str): FO %
+        prof (str): Professor %
+        aprof (str): Associate Professor %
+        assisprof (str): Assistant Professor %
+        workflow (str): Workflow Comment
+        tolerance (Optional[float]): Allowed deviation in percentage points, defaults to
+            PRESCORE_TOLERANCE from .env
+        slate_id (Optional[str]): Identifier the result is stored under
+
+    Returns:
+        list: list of rating and analysis for each criteria of a given slate
+    """
+    percentages = [urm, minority, female, ea, so, ce, we, fo, prof, aprof, assisprof]
+
+    with metrics.request_trace("predict"), request_deadline():
+        ready, settled, deviant, cache_key = prepare_slate(
+            percentages, workflow, tolerance
+        )
+        if ready is not None:
+            return record_result(
+                json.loads(ready), percentages, workflow, cache_key, slate_id
+            )
+
+        messages = prepare_messages(percentages, workflow, settled, deviant)
+
+        response = cascade_analysis(messages, workflow, settled, deviant, cache_key)
+
+        return record_result(
+            json.loads(response), percentages, workflow, cache_key, slate_id
+        )
+
+
+def analyse_slate(
+    percentages: list,
+    workflow: str,
+    tolerance: Optional[float] = None,
+    slate_id: Optional[str] = None,
+) -> dict:
+    """Version of predict_slate_health for programmatic use, returning the structured
+    response instead of the list shown in gradio.
+
+    Args:
+        percentages (list): The 11 percentages in the order of CRITERIA
+        workflow (str): Workflow Comment
+        tolerance (Optional[float]): Allowed deviation in percentage points, defaults to
+            PRESCORE_TOLERANCE from .env
+        slate_id (Optional[str]): Identifier the result is stored under
+
+    Returns:
+        dict: Validated response with the ratings, averages and summary
+    """
+    with metrics.request_trace("analyse"), request_deadline():
+        ready, settled, deviant, cache_key = prepare_slate(
+            percentages, workflow, tolerance
+        )
+        if ready is None:
+            messages = prepare_messages(percentages, workflow, settled, deviant)
+
+            ready = cascade_analysis(messages, workflow, settled, deviant, cache_key)
+
+        response_dict = json.loads(ready)
+        record_result(response_dict, percentages, workflow, cache_key, slate_id)
+        return response_dict
+
+
+def record_shared_analysis(
+    response_dict: dict,
+    percentages: list,
+    workflow: str,
+    tolerance: Optional[float] = None,
+    slate_id: Optional[str] = None,
+):
+    """Stores an analysis made for an identical request under the slate id of this one,
+    e.g. when the JSON API shared one model call between concurrent requests.
+
+    Args:
+        response_dict (dict): Validated response of the identical request
+        percentages (list): The 11 percentages in the order of CRITERIA
+        workflow (str): Workflow Comment
+        tolerance (Optional[float]): Allowed deviation in percentage points, defaults to
+            PRESCORE_TOLERANCE from .env
+        slate_id (Optional[str]): Identifier the result is stored under
+    """
+    if tolerance is None:
+        tolerance = float(
+            get_settings().get("PRESCORE_TOLERANCE") or DEFAULT_PRESCORE_TOLERANCE
+        )
+    with metrics.request_trace("shared"):
+        metrics.set_outcome("coalesced")
+        record_result(
+            response_dict,
+            percentages,
+            workflow,
+            slate_key(percentages, workflow, tolerance),
+            slate_id,
+        )
+
+
+def analyse_pack(slates: list) -> list:
+    """Analyses several slates with one model call. Slates that are settled locally or
+    cached are answered without it, and every answer in the pack is validated on its own.
+    Answers that are missing or invalid are not asked again, those slates are left for
+    the caller to analyse alone.
+
+    Args:
+        slates (list): Slates as dicts with "percentages" and "workflow", and optionally
+            "tolerance" and "slate_id"
+
+    Returns:
+        list: Validated response of each slate in order, None where the slate still has to
+            be analysed alone
+    """
+    responses = [None] * len(slates)
+    packed = []
+
+    for index, slate in enumerate(slates):
+        percentages, workflow = slate["percentages"], slate["workflow"]
+        with metrics.request_trace("analyse"), request_deadline():
+            ready, settled, deviant, cache_key = prepare_slate(
+                percentages, workflow, slate.get("tolerance")
+            )
+            if ready is None:
+                metrics.set_outcome("packed")
+                document = condense_long_workflow(workflow, deviant)
+                packed.append((index, settled, deviant, cache_key, document))
+                continue
+            responses[index] = json.loads(ready)
+            record_result(
+                responses[index],
+                percentages,
+                workflow,
+                cache_key,
+                slate.get("slate_id"),
+            )
+
+    if not packed:
+        return responses
+
+    with metrics.request_trace("pack") as trace, request_deadline():
+        messages = build_packed_messages(
+            [
+                (slates[index]["percentages"], document, settled, deviant)
+                for index, settled, deviant, _, document in packed
+            ]
+        )
+        # Invalid answers are not asked again, their slates are analysed alone
+        problem = check_token_budget(messages, slates=len(packed), retries=0)
+        if problem:
+            logging.info(f"Analysing {len(packed)} slates alone, the pack {problem}")
+            metrics.PACKED_SLATES.inc(len(packed), outcome="unpacked")
+            metrics.set_outcome("over_budget")
+            return responses
+
+        answers = _load_json(get_analysis(messages)) or {}
+        # Every slate of the pack is stored with an equal share of its tokens
+        share = {k: round(v / len(packed)) for k, v in trace["tokens"].items()}
+
+        invalid = 0
+        for number, (index, settled, deviant, cache_key, _) in enumerate(
+            packed, start=1
+        ):
+            answer = answers.get(str(number))
+            if not isinstance(answer, dict):
+                invalid += 1
+                continue
+            response = json.dumps(answer)
+            if compact_output():
+                response = expand_compact_response(response)
+            response = merge_prescored(repair_response(response), settled)
+            if invalid_sections(response):
+                invalid += 1
+                continue
+
+            get_cache().set(cache_key, response)
+            slate = slates[index]
+            responses[index] = json.loads(response)
+            record_result(
+                responses[index],
+                slate["percentages"],
+                slate["workflow"],
+                cache_key,
+                slate.get("slate_id"),
+                tokens=share,
+            )
+
+        metrics.PACKED_SLATES.inc(len(packed) - invalid, outcome="valid")
+        if invalid:
+            logging.info(f"{invalid} of {len(packed)} packed slates need a single call")
+            metrics.PACKED_SLATES.inc(invalid, outcome="unpacked")
+            metrics.set_outcome("partial")
+
+    return responses
+
+
+def stream_slate_health(
+    urm: str,
+    minority: str,
+    female: str,
+    ea: str,
+    so: str,
+    ce: str,
+    we: str,
+    fo: str,
+    prof: str,
+    aprof: str,
+    assisprof: str,
+    workflow: str,
+    tolerance: Optional[float] = None,
+    slate_id: Optional[str] = None,
+) -> Iterator[list]:
+    """Streaming version of predict_slate_health for gradio. Each category is shown as soon
+    as the model has finished writing it, the summary arrives last.
+
+    Args:
+        urm (str): URM %
+        minority (str): Minority %
+        female (str): Female %
+        ea (str): EA %
+        so (str): SO %
+        ce (str): CE %
+        we (str): WE %
+        fo (str): FO %
+        prof (str): Professor %
+        aprof (str): Associate Professor %
+        assisprof (str): Assistant Professor %
+        workflow (str): Workflow Comment
+        tolerance (Optional[float]): Allowed deviation in percentage points, defaults to
+            PRESCORE_TOLERANCE from .env
+        slate_id (Optional[str]): Identifier the result is stored under
+
+    Yields:
+        list: list of rating and analysis for each criteria, empty where not known yet
+    """
+    percentages = [urm, minority, female, ea, so, ce, we, fo, prof, aprof, assisprof]
+
+    with metrics.request_trace("stream") as trace, request_deadline():
+        # Gradio can resume the generator from another context than the one it started
+        # in, so every step sets the trace and deadline of the request again
+        end = scheduler.current_deadline()
+        steps = _stream_slate(percentages, workflow, tolerance, slate_id)
+        with contextlib.closing(steps):
+            while True:
+                with metrics.restore_trace(trace), scheduler.restore_deadline(end):
+                    try:
+                        outputs = next(steps)
+                    except StopIteration:
+                        return
+                yield outputs
+
+
+def _stream_slate(
+    percentages: list,
+    workflow: str,
+    tolerance: Optional[float],
+    slate_id: Optional[str],
+) -> Iterator[list]:
+    ready, settled, deviant, cache_key = prepare_slate(percentages, workflow, tolerance)
+    if ready is not None:
+        yield record_result(
+            json.loads(ready), percentages, workflow, cache_key, slate_id
+        )
+        return
+
+    yield structure_partial({}, settled)
+
+    messages = prepare_messages(percentages, workflow, settled, deviant)
+    parser = IncrementalJSONParser()
+    partial = {}
+    chunks = []
+
+    for chunk in stream_analysis(messages, structured_output_schema(deviant)):
+        chunks.append(chunk)
+        completed = parser.feed(chunk)
+        if completed:
+            partial.update(completed)
+            if compact_output():
+                yield structure_partial(expand_compact(partial), settled)
+            else:
+                yield structure_partial(partial, settled)
+
+    response = "".join(chunks)
+    logging.info(f"Streamed response from OpenAI {response}")
+
+    response = finish_response(response, messages, settled, cache_key)
+
+    yield record_result(
+        json.loads(response), percentages, workflow, cache_key, slate_id
+    )
+
+
+async def apredict_slate_health(
+    urm: str,
+    minority: str,
+    female: str,
+    ea: str,
+    so: str,
+    ce: str,
+    we: str,
+    fo: str,
+    prof: str,
+    aprof: str,
+    assisprof: str,
+    workflow: str,
+    tolerance: Optional[float] = None,
+    slate_id: Optional[str] = None,
+) -> list:
+    """Async version of predict_slate_health, so many slates can be analysed concurrently
+    on one event loop.
+
+    Args:
+        urm (str): URM %
+        minority (str): Minority %
+        female (str): Female %
+        ea (str): EA %
+        so (str): SO %
+        ce (str): CE %
+        we (str): WE %
+        fo (str): FO %
+        prof (str): Professor %
+        aprof (str): Associate Professor %
+        assisprof (str): Assistant Professor %
+        workflow (str): Workflow Comment
+        tolerance (Optional[float]): Allowed deviation in percentage points, defaults to
+            PRESCORE_TOLERANCE from .env
+        slate_id (Optional[str]): Identifier the result is stored under
+
+    Returns:
+        list: list of rating and analysis for each criteria of a given slate
+    """
+    percentages = [urm, minority, female, ea, so, ce, we, fo, prof, aprof, assisprof]
+
+    with metrics.request_trace("apredict"), request_deadline():
+        # The cache, the near-duplicate index and the results store block on SQLite
+        # and the signature on hashing, they run in a thread to keep the loop free
+        ready, settled, deviant, cache_key = await asyncio.to_thread(
+            prepare_slate, percentages, workflow, tolerance
+        )
+        if ready is not None:
+            return await asyncio.to_thread(
+                record_result,
+                json.loads(ready),
+                percentages,
+                workflow,
+                cache_key,
+                slate_id,
+            )
+
+        messages = await aprepare_messages(percentages, workflow, settled, deviant)
+
+        response = await acascade_analysis(
+            messages, workflow, settled, deviant, cache_key
+        )
+
+        return await asyncio.to_thread(
+            record_result,
+            json.loads(response),
+            percentages,
+            workflow,
+            cache_key,
+            slate_id,
+        )
+
+
+async def astream_slate_health(
+    urm: str,
+    minority: str,
+    female: str,
+    ea: str,
+    so: str,
+    ce: str,
+    we: str,
+    fo: str,
+    prof: str,
+    aprof: str,
+    assisprof: str,
+    workflow: str,
+    tolerance: Optional[float] = None,
+    slate_id: Optional[str] = None,
+) -> AsyncIterator[list]:
+    """Async version of stream_slate_health, used by the gradio app.
+
+    Args:
+        urm (str): URM %
+        minority (str): Minority %
+        female (str): Female %
+        ea (str): EA %
+        so (str): SO %
+        ce (str): CE %
+        we (str): WE %
+        fo (str): FO %
+        prof (str): Professor %
+        aprof (str): Associate Professor %
+        assisprof (str): Assistant Professor %
+        workflow (str): Workflow Comment
+        tolerance (Optional[float]): Allowed deviation in percentage points, defaults to
+            PRESCORE_TOLERANCE from .env
+        slate_id (Optional[str]): Identifier the result is stored under
+
+    Yields:
+        list: list of rating and analysis for each criteria, empty where not known yet
+    """
+    percentages = [urm, minority, female, ea, so, ce, we, fo, prof, aprof, assisprof]
+
+    with metrics.request_trace("astream") as trace, request_deadline():
+        end = scheduler.current_deadline()
+        steps = _astream_slate(percentages, workflow, tolerance, slate_id)
+        try:
+            while True:
+                with metrics.restore_trace(trace), scheduler.restore_deadline(end):
+                    try:
+                        outputs = await steps.__anext__()
+                    except StopAsyncIteration:
+                        return
+                yield outputs
+        finally:
+            await steps.aclose()
+
+
+async def _astream_slate(
+    percentages: list,
+    workflow: str,
+    tolerance: Optional[float],
+    slate_id: Optional[str],
+) -> AsyncIterator[list]:
+    ready, settled, deviant, cache_key = await asyncio.to_thread(
+        prepare_slate, percentages, workflow, tolerance
+    )
+    if ready is not None:
+        yield await asyncio.to_thread(
+            record_result,
+            json.loads(ready),
+            percentages,
+            workflow,
+            cache_key,
+            slate_id,
+        )
+        return
+
+    yield structure_partial({}, settled)
+
+    messages = await aprepare_messages(percentages, workflow, settled, deviant)
+    parser = IncrementalJSONParser()
+    partial = {}
+    chunks = []
+
+    async for chunk in astream_analysis(messages, structured_output_schema(deviant)):
+        chunks.append(chunk)
+        completed = parser.feed(chunk)
+        if completed:
+            partial.update(completed)
+            if compact_output():
+                yield structure_partial(expand_compact(partial), settled)
+            else:
+                yield structure_partial(partial, settled)
+
+    response = "".join(chunks)
+    logging.info(f"Streamed response from OpenAI {response}")
+
+    response = await afinish_response(response, messages, settled, cache_key)
+
+    yield await asyncio.to_thread(
+        record_result, json.loads(response), percentages, workflow, cache_key, slate_id
+    )
 
 
-def add_key(key: str, deployment: str, endpoint: str) -> object:
+def add_key(key: str, deployment: str, endpoint: str) -> str:
     """Updates Environment variables from Gradio UI
 
     Args:
@@ -453,9 +2830,9 @@ def add_key(key: str, deployment: str, endpoint: str) -> object:
         endpoint (str): Azure OpenAI Endpoint url
 
     Returns:
-        _type_: Gradio Object??
+        str: Message telling whether the key was saved
     """
-    env_file = ".env"
+    env_file = ENV_FILE
     env_vars = dotenv_values(env_file)
     env_vars["AZURE_OPENAI_KEY"] = key
     env_vars["DEPLOYMENT"] = deployment
@@ -464,8 +2841,8 @@ def add_key(key: str, deployment: str, endpoint: str) -> object:
     try:
         for k, v in env_vars.items():
             set_key(env_file, k, v)
-        result = "Key added successfully."
-        return gr.Info(result)
+        reset_client()
+        return "Key added successfully."
     except Exception as e:
         logging.error("Failed to update environment variables", exc_info=True)
-        return gr.Info(str(e))
+        return str(e)
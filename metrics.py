@@ -0,0 +1,395 @@
+import json
+import time
+import asyncio
+import functools
+import bisect
+import logging
+import threading
+import contextvars
+from typing import Optional
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN_BUCKETS = (500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+# Stage timings and counts of the request being handled by the current thread or task
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Counter:
+    """Monotonic counter with optional labels, exposed in the Prometheus text format."""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histogram with cumulative buckets and optional labels, exposed in the Prometheus
+    text format.
+    """
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry = self._values[key]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = _labels(key + (("le", str(bucket)),))
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = _labels(key + (("le", "+Inf"),))
+                lines.append(f"{self.name}_bucket{le} {count}")
+                lines.append(f"{self.name}_sum{_labels(key)} {round(total, 6)}")
+                lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+def _labels(key: tuple) -> str:
+    if not key:
+        return ""
+    pairs = []
+    for name, value in key:
+        value = (
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+STAGE_SECONDS = Histogram(
+    "slate_stage_seconds", "Time spent in each stage of a slate analysis"
+)
+REQUEST_SECONDS = Histogram(
+    "slate_request_seconds", "End to end time of a slate analysis"
+)
+REQUESTS = Counter("slate_requests_total", "Slate analyses by outcome")
+RETRIES = Counter("slate_retries_total", "Follow-up requests for invalid sections")
+VALIDATION_FAILURES = Counter(
+    "slate_validation_failures_total", "Invalid sections of responses by reason"
+)
+TOKENS = Counter("slate_tokens_total", "Tokens used by kind")
+RATE_LIMITED = Counter(
+    "slate_rate_limited_total", "Calls rejected by the API with a rate limit"
+)
+COALESCED = Counter(
+    "slate_coalesced_requests_total",
+    "Requests answered by an identical request in flight",
+)
+HEDGES = Counter("slate_hedges_total", "Hedged calls by the copy that answered first")
+PROJECTED_TOKENS = Histogram(
+    "slate_projected_tokens",
+    "Tokens of requests counted before sending them, by kind",
+    buckets=TOKEN_BUCKETS,
+)
+CASCADE = Counter(
+    "slate_cascade_total", "Slates answered by each tier of the model cascade"
+)
+ESCALATIONS = Counter(
+    "slate_escalations_total", "Slates escalated from the fast deployment by reason"
+)
+PACKED_SLATES = Counter(
+    "slate_packed_total", "Slates sent in a pack by whether their answer was valid"
+)
+DEPLOYMENT_SECONDS = Histogram(
+    "slate_deployment_seconds", "Time to a response from each deployment"
+)
+DEPLOYMENT_REQUESTS = Counter(
+    "slate_deployment_requests_total", "Calls to each deployment by outcome"
+)
+DEPLOYMENT_EJECTIONS = Counter(
+    "slate_deployment_ejections_total",
+    "Times each deployment was taken out of rotation",
+)
+
+REGISTRY = [
+    STAGE_SECONDS,
+    REQUEST_SECONDS,
+    REQUESTS,
+    RETRIES,
+    VALIDATION_FAILURES,
+    TOKENS,
+    RATE_LIMITED,
+    COALESCED,
+    HEDGES,
+    PROJECTED_TOKENS,
+    CASCADE,
+    ESCALATIONS,
+    PACKED_SLATES,
+    DEPLOYMENT_SECONDS,
+    DEPLOYMENT_REQUESTS,
+    DEPLOYMENT_EJECTIONS,
+]
+
+
+@contextmanager
+def timer(stage: str):
+    """Times a stage of the current request.
+
+    Args:
+        stage (str): Name of the stage, e.g. "api_call"
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace["stages"][stage] = round(trace["stages"].get(stage, 0) + elapsed, 4)
+
+
+def timed(stage: str):
+    """Decorator timing every call of a function as a stage of the current request.
+
+    Args:
+        stage (str): Name of the stage, e.g. "flatten"
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def request_trace(kind: str):
+    """Collects the stage timings, tokens and retries of one request, records its end to
+    end latency and outcome, and logs them as one structured line.
+
+    Args:
+        kind (str): Entry point handling the request, e.g. "predict"
+
+    Yields:
+        dict: The trace, whose "outcome" can be set by the request
+    """
+    trace = {
+        "kind": kind,
+        "outcome": "ok",
+        "started": time.time(),
+        "stages": {},
+        "tokens": {},
+        "retries": 0,
+    }
+    token = _trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    except (GeneratorExit, asyncio.CancelledError):
+        trace["outcome"] = "cancelled"
+        raise
+    except TimeoutError:
+        trace["outcome"] = "timeout"
+        raise
+    except BaseException:
+        trace["outcome"] = "error"
+        raise
+    finally:
+        try:
+            _trace.reset(token)
+        except ValueError:
+            # Streaming requests can be resumed from another context than they started in
+            _trace.set(None)
+        trace["seconds"] = round(time.perf_counter() - start, 4)
+        REQUEST_SECONDS.observe(trace["seconds"], kind=kind)
+        REQUESTS.inc(kind=kind, outcome=trace["outcome"])
+        logging.info(f"Request metrics {json.dumps(trace)}")
+
+
+def current_trace() -> Optional[dict]:
+    """Returns the trace of the current request, None outside of request_trace."""
+    return _trace.get()
+
+
+@contextmanager
+def restore_trace(trace: Optional[dict]):
+    """Sets the trace of a request again inside the block, e.g. for a step of a streaming
+    request resumed from another context than the one it started in.
+
+    Args:
+        trace (Optional[dict]): Trace yielded by request_trace
+    """
+    token = _trace.set(trace)
+    try:
+        yield
+    finally:
+        _trace.reset(token)
+
+
+def set_outcome(outcome: str):
+    """Sets the outcome of the current request, e.g. "cached" or "invalid".
+
+    Args:
+        outcome (str): Outcome label
+    """
+    trace = _trace.get()
+    if trace is not None:
+        trace["outcome"] = outcome
+
+
+def record_retry():
+    """Counts a follow-up request of the current request."""
+    RETRIES.inc()
+    trace = _trace.get()
+    if trace is not None:
+        trace["retries"] += 1
+
+
+def record_validation_failure(section: str, reason: str):
+    """Counts an invalid section of a response.
+
+    Args:
+        section (str): Top level section of the response
+        reason (str): Pydantic error type, e.g. "missing"
+    """
+    VALIDATION_FAILURES.inc(section=section, reason=reason)
+
+
+def record_tokens(counts: dict):
+    """Adds the token counts of one call to the totals and to the current request.
+
+    Args:
+        counts (dict): Token counts by kind, e.g. {"prompt_tokens": 1500}
+    """
+    trace = _trace.get()
+    for kind, value in counts.items():
+        TOKENS.inc(value, kind=kind)
+        if trace is not None:
+            trace["tokens"][kind] = trace["tokens"].get(kind, 0) + value
+
+
+def record_tier(tier: str):
+    """Records which tier of the cascade answered the current request.
+
+    Args:
+        tier (str): "fast" or "main"
+    """
+    CASCADE.inc(tier=tier)
+    trace = _trace.get()
+    if trace is not None:
+        trace["tier"] = tier
+
+
+def record_deployment(name: str):
+    """Records the deployment that answered the last call of the current request.
+
+    Args:
+        name (str): Name of the deployment, e.g. "gpt-4o"
+    """
+    trace = _trace.get()
+    if trace is not None:
+        trace["deployment"] = name
+
+
+def record_escalation(reason: str):
+    """Records why the current request was escalated to the main deployment.
+
+    Args:
+        reason (str): e.g. "invalid" or "inconsistent"
+    """
+    ESCALATIONS.inc(reason=reason)
+    trace = _trace.get()
+    if trace is not None:
+        trace["escalation"] = reason
+
+
+def record_preflight(plan: dict):
+    """Records the token counts of a request taken before sending it.
+
+    Args:
+        plan (dict): Projected tokens by kind, e.g. {"prompt_tokens": 1500}
+    """
+    for kind, value in plan.items():
+        PROJECTED_TOKENS.observe(value, kind=kind)
+    trace = _trace.get()
+    if trace is not None:
+        trace["preflight"] = plan
+
+
+def render() -> str:
+    """Renders every metric in the Prometheus text format.
+
+    Returns:
+        str: Metrics exposition
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serves the metrics on http://host:port/metrics from a background thread.
+
+    Args:
+        port (int): Port to listen on
+        host (str): Interface to listen on
+
+    Returns:
+        ThreadingHTTPServer: The running server
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,40 @@
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+
+class ActionRating(BaseModel):
+    plan_of_action: Optional[str] = Field(alias="plan of action")
+    sentiment: Optional[str] = Field(alias="sentiment")
+    rating: float | None = Field(alias="rating")
+
+
+class DemographicDiversity(BaseModel):
+    URM: ActionRating
+    Minority: ActionRating
+    Female: ActionRating
+    Average_Rating: float | None = Field(alias="Average Rating")
+
+
+class GeographicDiversity(BaseModel):
+    EA: ActionRating
+    SO: ActionRating
+    CE: ActionRating
+    WE: ActionRating
+    FO: ActionRating
+    Average_Rating: float | None = Field(alias="Average Rating")
+
+
+class SeniorityCareerPhase(BaseModel):
+    professor: ActionRating = Field(alias="professor")
+    associate_professor: ActionRating = Field(alias="associate professor")
+    assistant_professor: ActionRating = Field(alias="assistant professor")
+    Average_Rating: float | None = Field(alias="Average Rating")
+
+
+class ResponseModel(BaseModel):
+    Demographic_Diversity: DemographicDiversity = Field(alias="Demographic Diversity")
+    Geographic_Diversity: GeographicDiversity = Field(alias="Geographic Diversity")
+    Seniority_Career_Phase: SeniorityCareerPhase = Field(alias="Seniority/Career Phase")
+    Overall_Rating: float | None = Field(alias="Overall Rating")
+    Summary: Optional[str] = Field(alias="Summary")
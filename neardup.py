@@ -0,0 +1,181 @@
+import re
+import json
+import random
+import struct
+import sqlite3
+import hashlib
+import threading
+
+# Mersenne prime larger than every 32 bit shingle hash
+_PRIME = (1 << 61) - 1
+
+
+def shingles(text: str, size: int = 5) -> set:
+    """Splits a text into overlapping word n-grams, ignoring case, punctuation and numbers,
+    so boilerplate that differs only in dates or counts yields the same shingles.
+
+    Args:
+        text (str): Workflow Comment
+        size (int): Words per shingle
+
+    Returns:
+        set: 32 bit hashes of the shingles
+    """
+    words = re.sub(r"\d+", "0", text.lower())
+    words = re.findall(r"[a-z0]+", words)
+    if len(words) < size:
+        words = words + [""] * (size - len(words))
+    return {
+        struct.unpack(
+            "<I", hashlib.blake2b(" ".join(gram).encode(), digest_size=4).digest()
+        )[0]
+        for gram in zip(*(words[i:] for i in range(size)))
+    }
+
+
+class NearDuplicateIndex:
+    """MinHash index of analysed workflows, with locality sensitive hashing over bands of
+    the signature so a lookup only compares a handful of candidates. Entries are grouped
+    by the rest of the request (percentages, deployment, prompt version), and only
+    workflows of the same group are compared.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        threshold: float = 0.9,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 5,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        # Fixed seed, signatures stored on disk have to stay comparable
+        generator = random.Random(1)
+        self._permutations = [
+            (generator.randrange(1, _PRIME), generator.randrange(0, _PRIME))
+            for _ in range(num_perm)
+        ]
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS near_duplicates (
+                key TEXT PRIMARY KEY,
+                signature TEXT NOT NULL
+            )"""
+        )
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS near_duplicate_bands (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL
+            )"""
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS near_duplicate_buckets "
+            "ON near_duplicate_bands (bucket)"
+        )
+        if not self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'near_duplicate_band_keys'"
+        ).fetchone():
+            # Files written before the unique index may hold repeated band rows
+            self._db.execute(
+                """DELETE FROM near_duplicate_bands WHERE rowid NOT IN (
+                    SELECT MIN(rowid) FROM near_duplicate_bands GROUP BY key, bucket
+                )"""
+            )
+            self._db.execute(
+                "CREATE UNIQUE INDEX near_duplicate_band_keys "
+                "ON near_duplicate_bands (key, bucket)"
+            )
+        self._db.commit()
+
+    def signature(self, workflow: str) -> list:
+        """Computes the MinHash signature of a workflow.
+
+        Args:
+            workflow (str): Workflow Comment
+
+        Returns:
+            list: Minimum hash under each permutation
+        """
+        hashes = shingles(workflow, self.shingle_size)
+        return [
+            min((a * h + b) % _PRIME for h in hashes) for a, b in self._permutations
+        ]
+
+    def add(self, key: str, group: str, signature: list):
+        """Indexes an analysed workflow.
+
+        Args:
+            key (str): Key the analysis is cached under
+            group (str): Key of everything else the analysis depends on
+            signature (list): Signature of the workflow
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO near_duplicates VALUES (?, ?)",
+                (key, json.dumps(signature)),
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO near_duplicate_bands VALUES (?, ?)",
+                [(bucket, key) for bucket in self._buckets(group, signature)],
+            )
+            self._db.commit()
+
+    def remove(self, keys: list):
+        """Drops workflows from the index, e.g. once their analysis left the cache.
+
+        Args:
+            keys (list): Keys the analyses were cached under
+        """
+        with self._lock:
+            for table in ("near_duplicates", "near_duplicate_bands"):
+                self._db.executemany(
+                    f"DELETE FROM {table} WHERE key = ?", [(key,) for key in keys]
+                )
+            self._db.commit()
+
+    def find(self, group: str, signature: list) -> list:
+        """Finds indexed workflows of the same group similar to a signature.
+
+        Args:
+            group (str): Key of everything else the analysis depends on
+            signature (list): Signature of the workflow
+
+        Returns:
+            list: (estimated similarity, key) pairs at or above the threshold, most
+                similar first
+        """
+        buckets = self._buckets(group, signature)
+        with self._lock:
+            rows = self._db.execute(
+                f"""SELECT DISTINCT n.key, n.signature
+                FROM near_duplicate_bands b JOIN near_duplicates n ON n.key = b.key
+                WHERE b.bucket IN ({",".join("?" * len(buckets))})""",
+                buckets,
+            ).fetchall()
+
+        matches = []
+        for key, stored in rows:
+            stored = json.loads(stored)
+            similarity = sum(x == y for x, y in zip(signature, stored)) / self.num_perm
+            if similarity >= self.threshold:
+                matches.append((similarity, key))
+        return sorted(matches, reverse=True)
+
+    def _buckets(self, group: str, signature: list) -> list:
+        return [
+            hashlib.sha256(
+                json.dumps(
+                    [group, band, signature[band * self.rows : (band + 1) * self.rows]]
+                ).encode("utf-8")
+            ).hexdigest()
+            for band in range(self.bands)
+        ]
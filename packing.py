@@ -0,0 +1,71 @@
+import threading
+from typing import Iterable, Iterator
+
+from scheduler import estimate_tokens
+
+# Tokens of a slate's percentages and tags, on top of its workflow
+SLATE_PROMPT_TOKENS = 200
+
+
+class PackSizer:
+    """Groups slates into packs sharing one model call. A pack is closed when it reaches
+    the size limit or when one more slate would exceed the prompt or completion token
+    budget. The size limit halves after a pack with invalid answers, which is usually a
+    truncated or muddled response, and grows by one after a pack that was fully valid.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 4,
+        prompt_budget: int = 12000,
+        completion_budget: int = 4000,
+        completion_tokens: int = 900,
+    ):
+        self.max_size = max_size
+        self.size = max_size
+        self.prompt_budget = prompt_budget
+        self.completion_budget = completion_budget
+        self.completion_tokens = completion_tokens
+        self._lock = threading.Lock()
+
+    def packs(self, slates: Iterable[dict]) -> Iterator[list]:
+        """Groups slates into packs lazily, so the size limit of each pack reflects the
+        packs that finished before it was formed.
+
+        Args:
+            slates (Iterable[dict]): Slates with a "workflow"
+
+        Yields:
+            list: Slates of one pack
+        """
+        pack, prompt, completion = [], 0, 0
+        for slate in slates:
+            tokens = (
+                estimate_tokens([{"content": slate["workflow"]}], 0)
+                + SLATE_PROMPT_TOKENS
+            )
+            if pack and (
+                len(pack) >= self.size
+                or prompt + tokens > self.prompt_budget
+                or completion + self.completion_tokens > self.completion_budget
+            ):
+                yield pack
+                pack, prompt, completion = [], 0, 0
+            pack.append(slate)
+            prompt += tokens
+            completion += self.completion_tokens
+        if pack:
+            yield pack
+
+    def record(self, size: int, invalid: int):
+        """Adjusts the size limit to the outcome of a pack.
+
+        Args:
+            size (int): Slates in the pack
+            invalid (int): Slates whose answer was missing or invalid
+        """
+        with self._lock:
+            if invalid:
+                self.size = max(1, min(self.size, size) // 2)
+            elif size >= self.size:
+                self.size = min(self.max_size, self.size + 1)
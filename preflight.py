@@ -0,0 +1,88 @@
+import logging
+from functools import lru_cache
+
+# Tokens each message adds to its content for the role and separators
+MESSAGE_TOKENS = 4
+# Tokens priming the assistant's answer
+REPLY_TOKENS = 3
+
+
+class TokenBudgetExceeded(ValueError):
+    """Raised when a request doesn't fit the token budget, even with its workflow
+    condensed.
+    """
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    # tiktoken is imported on first use like the other heavy modules. Its encoding is
+    # downloaded on first use, without network access tokens are estimated instead
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        logging.warning(
+            "Failed to load the tokenizer, estimating tokens from characters",
+            exc_info=True,
+        )
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Counts the tokens of a text with the tokenizer of the GPT-4o models, or estimates
+    them at four characters per token if the tokenizer can't be loaded.
+
+    Args:
+        text (str): Text to count
+
+    Returns:
+        int: Number of tokens
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list) -> int:
+    """Counts the prompt tokens of a chat completion request.
+
+    Args:
+        messages (list): List of message objects
+
+    Returns:
+        int: Number of prompt tokens
+    """
+    return (
+        sum(count_tokens(message["content"]) + MESSAGE_TOKENS for message in messages)
+        + REPLY_TOKENS
+    )
+
+
+def plan_request(
+    messages: list, completion_tokens: int, retries: int, retry_tokens: int
+) -> dict:
+    """Projects the tokens of a request and of the follow-ups it may need. A follow-up
+    resends the prompt with the response and a message asking for its invalid sections.
+
+    Args:
+        messages (list): List of message objects
+        completion_tokens (int): Expected length of the response
+        retries (int): Most follow-up requests
+        retry_tokens (int): Prompt tokens a follow-up adds to the prompt
+
+    Returns:
+        dict: Prompt and completion tokens of the first call, tokens of the largest
+            single call and of all calls together
+    """
+    prompt = count_message_tokens(messages)
+    largest = prompt + (retry_tokens if retries else 0) + completion_tokens
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion_tokens,
+        "largest_call_tokens": largest,
+        "projected_tokens": prompt
+        + completion_tokens
+        + retries * (prompt + retry_tokens + completion_tokens),
+    }
@@ -0,0 +1,191 @@
+import json
+import time
+import sqlite3
+import threading
+from typing import Optional
+
+CATEGORY_COLUMNS = {
+    "Demographic Diversity": "demographic",
+    "Geographic Diversity": "geographic",
+    "Seniority/Career Phase": "seniority",
+}
+
+
+class ResultsStore:
+    """SQLite store of every slate analysis: inputs, flattened output, model, latency and
+    token usage. Results are indexed by slate id and time, and by the overall and category
+    ratings so they can be filtered by rating range.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY,
+                slate_id TEXT NOT NULL,
+                created REAL NOT NULL,
+                percentages TEXT NOT NULL,
+                workflow TEXT NOT NULL,
+                output TEXT NOT NULL,
+                model TEXT,
+                outcome TEXT,
+                seconds REAL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                overall REAL,
+                demographic REAL,
+                geographic REAL,
+                seniority REAL
+            )"""
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_slate ON results (slate_id, created)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_created ON results (created)"
+        )
+        for column in ["overall", *CATEGORY_COLUMNS.values()]:
+            self._db.execute(
+                f"CREATE INDEX IF NOT EXISTS results_{column} ON results ({column})"
+            )
+        self._db.commit()
+
+    def add(
+        self,
+        slate_id: str,
+        percentages: list,
+        workflow: str,
+        response_dict: dict,
+        output: list,
+        model: Optional[str] = None,
+        outcome: Optional[str] = None,
+        seconds: Optional[float] = None,
+        tokens: Optional[dict] = None,
+    ) -> int:
+        """Stores one analysis.
+
+        Args:
+            slate_id (str): Identifier of the slate
+            percentages (list): The 11 percentages as entered
+            workflow (str): Workflow Comment
+            response_dict (dict): Validated response, used for the rating columns
+            output (list): Flattened output from structure_response
+            model (Optional[str]): Deployment that produced the analysis
+            outcome (Optional[str]): Outcome of the request, e.g. "ok" or "cached"
+            seconds (Optional[float]): End to end latency
+            tokens (Optional[dict]): Token counts of the request
+
+        Returns:
+            int: Row id of the stored result
+        """
+        tokens = tokens or {}
+        ratings = {
+            column: _rating(response_dict.get(category, {}).get("Average Rating"))
+            for category, column in CATEGORY_COLUMNS.items()
+        }
+
+        with self._lock:
+            cursor = self._db.execute(
+                """INSERT INTO results (
+                    slate_id, created, percentages, workflow, output, model, outcome,
+                    seconds, prompt_tokens, completion_tokens, overall, demographic,
+                    geographic, seniority
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    slate_id,
+                    time.time(),
+                    json.dumps(percentages),
+                    workflow,
+                    json.dumps(output),
+                    model,
+                    outcome,
+                    seconds,
+                    tokens.get("prompt_tokens"),
+                    tokens.get("completion_tokens"),
+                    _rating(response_dict.get("Overall Rating")),
+                    ratings["demographic"],
+                    ratings["geographic"],
+                    ratings["seniority"],
+                ),
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def search(
+        self,
+        slate_id: Optional[str] = None,
+        min_overall: Optional[float] = None,
+        max_overall: Optional[float] = None,
+        category: Optional[str] = None,
+        min_rating: Optional[float] = None,
+        max_rating: Optional[float] = None,
+        since: Optional[float] = None,
+        limit: int = 100,
+    ) -> list:
+        """Finds stored analyses, newest first.
+
+        Args:
+            slate_id (Optional[str]): Only results of this slate
+            min_overall (Optional[float]): Lowest overall rating
+            max_overall (Optional[float]): Highest overall rating
+            category (Optional[str]): Category the rating range applies to, e.g.
+                "Geographic Diversity"
+            min_rating (Optional[float]): Lowest average rating of the category
+            max_rating (Optional[float]): Highest average rating of the category
+            since (Optional[float]): Only results stored after this unix time
+            limit (int): Maximum number of results
+
+        Returns:
+            list: Results as dicts, with the percentages and output decoded
+        """
+        conditions, parameters = [], []
+        filters = [
+            ("slate_id = ?", slate_id),
+            ("overall >= ?", min_overall),
+            ("overall <= ?", max_overall),
+            ("created >= ?", since),
+        ]
+        if category:
+            column = CATEGORY_COLUMNS[category]
+            filters += [(f"{column} >= ?", min_rating), (f"{column} <= ?", max_rating)]
+        for condition, value in filters:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        query = "SELECT * FROM results"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created DESC LIMIT ?"
+
+        with self._lock:
+            rows = self._db.execute(query, parameters + [limit]).fetchall()
+
+        results = []
+        for row in rows:
+            result = dict(row)
+            result["percentages"] = json.loads(result["percentages"])
+            result["output"] = json.loads(result["output"])
+            results.append(result)
+        return results
+
+    def latest(self, slate_id: str) -> Optional[dict]:
+        """Returns the most recent analysis of a slate.
+
+        Args:
+            slate_id (str): Identifier of the slate
+
+        Returns:
+            Optional[dict]: Latest result, None if the slate was never analysed
+        """
+        results = self.search(slate_id=slate_id, limit=1)
+        return results[0] if results else None
+
+
+def _rating(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
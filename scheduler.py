@@ -0,0 +1,373 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+import functools
+import itertools
+import threading
+import contextvars
+from typing import Awaitable, Callable, Optional
+from contextlib import contextmanager
+from concurrent.futures import CancelledError
+
+import metrics
+
+INTERACTIVE = 0
+BATCH = 1
+
+# Priority of the requests made by the current thread or task
+_priority = contextvars.ContextVar("priority", default=INTERACTIVE)
+# Monotonic time by which the request of the current thread or task has to be done
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a request runs out of time before the API answered."""
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    """Returns the OpenAI errors worth retrying, importing openai on first use.
+
+    Returns:
+        tuple: Rate limit, connection, timeout and server errors
+    """
+    from openai import (
+        APIConnectionError,
+        APITimeoutError,
+        InternalServerError,
+        RateLimitError,
+    )
+
+    return (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+@contextmanager
+def priority(level: int):
+    """Sets the priority of the requests made inside the block.
+
+    Args:
+        level (int): INTERACTIVE or BATCH
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """Gives the calls made inside the block a time budget. Every call and retry only gets
+    the time that is left, and a nested deadline can only shorten the budget.
+
+    Args:
+        seconds (Optional[float]): Time budget, None for no deadline
+    """
+    current = _deadline.get()
+    if seconds is None:
+        yield
+        return
+    end = time.monotonic() + seconds
+    token = _deadline.set(end if current is None else min(current, end))
+    try:
+        yield
+    finally:
+        try:
+            _deadline.reset(token)
+        except ValueError:
+            # Streaming requests can be resumed from another context than they started in
+            _deadline.set(current)
+
+
+def remaining() -> Optional[float]:
+    """Returns the seconds left until the deadline of the current request, None if it has
+    no deadline.
+    """
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+def current_deadline() -> Optional[float]:
+    """Returns the monotonic time by which the current request has to be done, None if it
+    has no deadline.
+    """
+    return _deadline.get()
+
+
+@contextmanager
+def restore_deadline(end: Optional[float]):
+    """Sets the deadline of a request again inside the block, e.g. for a step of a
+    streaming request resumed from another context than the one it started in.
+
+    Args:
+        end (Optional[float]): Deadline from current_deadline
+    """
+    token = _deadline.set(end)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def check_deadline():
+    """Raises DeadlineExceeded if the deadline of the current request has passed."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("The request did not finish before its deadline")
+
+
+def estimate_tokens(messages: list, completion_tokens: int = 1000) -> int:
+    """Estimates the tokens a request will use, at about four characters per token.
+
+    Args:
+        messages (list): List of message objects
+        completion_tokens (int): Expected length of the response
+
+    Returns:
+        int: Estimated prompt and completion tokens
+    """
+    return sum(len(message["content"]) for message in messages) // 4 + completion_tokens
+
+
+class TokenBucket:
+    """Bucket refilled continuously at a per minute rate, holding at most one minute of
+    budget. A rate of 0 means unlimited.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken, 0 if it can be taken now."""
+        if not self.per_minute:
+            return 0.0
+        self._refill()
+        # Requests larger than the whole budget only wait for a full bucket
+        amount = min(amount, self.per_minute)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / self.per_minute
+
+    def take(self, amount: float):
+        if self.per_minute:
+            self._refill()
+            self.level -= min(amount, self.per_minute)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(
+            self.per_minute, self.level + (now - self.updated) * self.per_minute / 60
+        )
+        self.updated = now
+
+
+class RequestScheduler:
+    """Paces API calls against requests per minute and tokens per minute budgets. Waiting
+    calls are admitted by priority, so interactive requests overtake batch jobs, and rate
+    limit responses are retried after their Retry-After time with jittered backoff.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.paused_until = 0.0
+
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def call(
+        self,
+        request: Callable,
+        tokens: int,
+        dropped: Optional[threading.Event] = None,
+    ):
+        """Makes an API call once the budgets allow it, retrying rate limit and transient
+        errors.
+
+        Args:
+            request (Callable): Function making the API call
+            tokens (int): Estimated tokens of the call
+            dropped (Optional[threading.Event]): Set once the result is no longer needed,
+                e.g. when the other copy of a hedged call answered. No further attempt is
+                made after that
+
+        Returns:
+            The result of the call
+
+        Raises:
+            DeadlineExceeded: If the deadline passes before a call succeeded
+            CancelledError: If the call was dropped before it succeeded
+        """
+        for attempt in range(self.max_retries + 1):
+            if dropped is not None and dropped.is_set():
+                raise CancelledError("The call was dropped")
+            self.acquire(tokens)
+            try:
+                return request()
+            except retryable_errors() as e:
+                if attempt == self.max_retries or (dropped and dropped.is_set()):
+                    raise
+                time.sleep(self._retry_delay(e, attempt))
+
+    async def acall(self, request: Callable[[], Awaitable], tokens: int):
+        """Async version of call.
+
+        Args:
+            request (Callable[[], Awaitable]): Function returning the API call coroutine
+            tokens (int): Estimated tokens of the call
+
+        Returns:
+            The result of the call
+
+        Raises:
+            DeadlineExceeded: If the deadline passes before a call succeeded
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(tokens)
+            try:
+                return await request()
+            except retryable_errors() as e:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(e, attempt))
+
+    def acquire(self, tokens: int):
+        """Blocks until the call may be made and takes its share of the budgets.
+
+        Args:
+            tokens (int): Estimated tokens of the call
+        """
+        ticket = self._enqueue()
+        with metrics.timer("queue"), self._condition:
+            while True:
+                wait = self._try_admit(ticket, tokens)
+                if wait == 0:
+                    self._condition.notify_all()
+                    return
+                self._check_wait(ticket, wait)
+                self._condition.wait(wait)
+
+    async def aacquire(self, tokens: int):
+        """Async version of acquire.
+
+        Args:
+            tokens (int): Estimated tokens of the call
+        """
+        ticket = self._enqueue()
+        with metrics.timer("queue"):
+            while True:
+                with self._condition:
+                    wait = self._try_admit(ticket, tokens)
+                    if wait == 0:
+                        self._condition.notify_all()
+                        return
+                    self._check_wait(ticket, wait)
+                try:
+                    await asyncio.sleep(wait)
+                except asyncio.CancelledError:
+                    # A cancelled call must not keep its place at the head of the queue
+                    with self._condition:
+                        self._leave(ticket)
+                    raise
+
+    def pause(self, seconds: float):
+        """Stops admitting calls for a while, e.g. after the API asked to retry later.
+
+        Args:
+            seconds (float): Time to pause for
+        """
+        with self._condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _enqueue(self) -> tuple:
+        ticket = (_priority.get(), next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _try_admit(self, ticket: tuple, tokens: int) -> float:
+        # Only the highest priority waiter may take budget, the others poll
+        if self._waiting[0] != ticket:
+            return 0.05
+        wait = max(
+            self.paused_until - time.monotonic(),
+            self.requests.wait_time(1),
+            self.tokens.wait_time(tokens),
+        )
+        if wait > 0:
+            return wait
+        heapq.heappop(self._waiting)
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        return 0
+
+    def _check_wait(self, ticket: tuple, wait: float):
+        # Gives up the place in the queue if the call can't be admitted in time
+        left = remaining()
+        if left is not None and wait > left:
+            self._leave(ticket)
+            raise DeadlineExceeded(
+                "The request did not get its turn before its deadline"
+            )
+
+    def _leave(self, ticket: tuple):
+        self._waiting.remove(ticket)
+        heapq.heapify(self._waiting)
+        self._condition.notify_all()
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2**attempt)
+        requested = retry_after(error)
+        if requested is not None:
+            delay = requested
+        # Jitter spreads the retries of callers that were limited at the same time
+        delay *= random.uniform(1.0, 1.5)
+
+        if getattr(error, "status_code", None) == 429:
+            metrics.RATE_LIMITED.inc()
+            self.pause(delay)
+
+        left = remaining()
+        if left is not None and delay >= left:
+            raise DeadlineExceeded(
+                "The request did not finish before its deadline"
+            ) from error
+        logging.warning(f"{type(error).__name__} from OpenAI, retrying in {delay:.1f}s")
+        return delay
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Reads how long the API asked to wait before retrying.
+
+    Args:
+        error (Exception): Error raised by the OpenAI client
+
+    Returns:
+        Optional[float]: Seconds to wait, None if the response doesn't say
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        return None
+    return None
@@ -0,0 +1,250 @@
+import json
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+from batch import SLATE_FIELDS
+from main import (
+    analyse_slate,
+    configure_logging,
+    get_settings,
+    record_shared_analysis,
+)
+from preflight import TokenBudgetExceeded
+from scheduler import BATCH, DeadlineExceeded, priority
+
+# Largest request body accepted, bulk requests included
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+
+def parse_slate(slate: dict) -> tuple:
+    """Reads the inputs of a slate from a request.
+
+    Args:
+        slate (dict): Slate with the fields of SLATE_FIELDS, and optionally slate_id and
+            tolerance
+
+    Returns:
+        tuple: Percentages, workflow, tolerance and slate id
+
+    Raises:
+        ValueError: If the slate is not an object, misses a field or has a bad tolerance
+    """
+    if not isinstance(slate, dict):
+        raise ValueError("Slate must be a json object")
+    missing = [field for field in SLATE_FIELDS if field not in slate]
+    if missing:
+        raise ValueError(f"Missing fields {', '.join(missing)}")
+
+    tolerance = slate.get("tolerance")
+    slate_id = slate.get("slate_id")
+    return (
+        [str(slate[field]) for field in SLATE_FIELDS[:-1]],
+        str(slate["workflow"]),
+        float(tolerance) if tolerance is not None else None,
+        str(slate_id) if slate_id is not None else None,
+    )
+
+
+class RequestCoalescer:
+    """Runs identical concurrent requests once. Callers arriving while a request with the
+    same key is in flight wait for its result instead of starting their own.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: str, function, *args, **kwargs):
+        """Returns the result of function(*args, **kwargs), shared with every concurrent
+        call using the same key. Exceptions are shared the same way.
+
+        Args:
+            key (str): Identity of the request
+            function (Callable): Function computing the result
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.coalesced += 1
+                metrics.COALESCED.inc()
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(function(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+
+class ScoringService(ThreadingHTTPServer):
+    """JSON API over the scoring pipeline.
+
+    POST /score with a slate object returns its structured analysis, POST /score/bulk with
+    {"slates": [...]} analyses the slates over a worker pool, GET /metrics exposes the
+    metrics and GET /health answers once the service is up.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8000, workers: int = 8):
+        super().__init__((host, port), ScoringHandler)
+        self.coalescer = RequestCoalescer()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def score(self, slate: dict) -> dict:
+        """Analyses one slate, sharing the model call with identical requests in flight.
+
+        Args:
+            slate (dict): Slate with the fields of SLATE_FIELDS, and optionally slate_id
+                and tolerance
+
+        Returns:
+            dict: Slate id and structured analysis
+        """
+        percentages, workflow, tolerance, slate_id = parse_slate(slate)
+        key = hashlib.sha256(
+            json.dumps([percentages, workflow, tolerance]).encode("utf-8")
+        ).hexdigest()
+
+        def analyse() -> tuple:
+            return slate_id, analyse_slate(percentages, workflow, tolerance, slate_id)
+
+        analysed_as, result = self.coalescer.run(key, analyse)
+        if analysed_as != slate_id:
+            # The shared call only stored its result under the first request's slate id
+            record_shared_analysis(result, percentages, workflow, tolerance, slate_id)
+        return {"slate_id": slate_id, "result": result}
+
+    def score_bulk(self, slates: list) -> list:
+        """Analyses many slates concurrently, behind interactive requests.
+
+        Args:
+            slates (list): Slates as accepted by score
+
+        Returns:
+            list: Status and either the analysis or the error of each slate, in order
+        """
+
+        def score_one(slate) -> dict:
+            try:
+                with priority(BATCH):
+                    return {"status": "ok", **self.score(slate)}
+            except Exception as e:
+                logging.error("Failed to score slate in bulk request", exc_info=True)
+                slate_id = slate.get("slate_id") if isinstance(slate, dict) else None
+                return {"status": "error", "slate_id": slate_id, "error": str(e)}
+
+        return list(self.pool.map(score_one, slates))
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    server: ScoringService
+
+    def log_message(self, format, *args):
+        logging.info(f"Service {self.address_string()} {format % args}")
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif path == "/metrics":
+            data = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path not in ("/score", "/score/bulk"):
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY_BYTES:
+                self._send_json(413, {"error": "Request body too large"})
+                return
+            body = json.loads(self.rfile.read(length) or b"null")
+        except ValueError:
+            self._send_json(400, {"error": "Request body must be json"})
+            return
+
+        if path == "/score/bulk":
+            if not isinstance(body, dict) or not isinstance(body.get("slates"), list):
+                self._send_json(400, {"error": 'Expected {"slates": [...]}'})
+                return
+            self._send_json(200, {"results": self.server.score_bulk(body["slates"])})
+            return
+
+        try:
+            parse_slate(body)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            self._send_json(200, self.server.score(body))
+        except TokenBudgetExceeded as e:
+            self._send_json(422, {"error": str(e)})
+        except DeadlineExceeded as e:
+            self._send_json(504, {"error": str(e)})
+        except Exception as e:
+            logging.error("Failed to score slate", exc_info=True)
+            self._send_json(502, {"error": str(e)})
+
+    def _send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the slate analysis as a JSON API"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=int(get_settings().get("SERVICE_PORT") or 8000)
+    )
+    parser.add_argument("--workers", type=int, default=8, help="Bulk request workers")
+    args = parser.parse_args()
+
+    configure_logging()
+    server = ScoringService(args.host, args.port, args.workers)
+    logging.info(f"Serving slate analysis on http://{args.host}:{args.port}")
+    print(f"Serving slate analysis on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
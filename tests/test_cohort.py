@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+import pytest
+
+from cohort import UNKNOWN_DEVIATION, Cohort
+from main import CRITERIA, IDEAL_VALUES
+
+IDEAL = [str(ideal) for values in IDEAL_VALUES.values() for ideal in values.values()]
+
+
+def slate(**changes) -> list:
+    """Ideal percentages as text, with some criteria changed."""
+    percentages = list(IDEAL)
+    for criterion, value in changes.items():
+        percentages[CRITERIA.index(criterion)] = value
+    return percentages
+
+
+def test_from_rows_parses_percentages():
+    cohort = Cohort.from_rows([("a", slate(URM="25%")), ("b", slate(URM="n/a"))])
+
+    assert len(cohort) == 2
+    assert cohort.percentages.shape == (2, len(CRITERIA))
+    assert cohort.percentages[0, 0] == 25.0
+    assert np.isnan(cohort.percentages[1, 0])
+
+
+def test_deviations_are_signed_distances_from_the_ideal():
+    cohort = Cohort.from_rows([("a", slate(URM="25", Female="4"))])
+
+    deviations = cohort.deviations()[0]
+    assert deviations[CRITERIA.index("URM")] == 5.0
+    assert deviations[CRITERIA.index("Female")] == -6.0
+    assert deviations[CRITERIA.index("EA")] == 0.0
+
+
+def test_excess_subtracts_the_tolerance():
+    cohort = Cohort.from_rows([("a", slate(URM="25", Female="4", EA="x"))])
+
+    excess = cohort.excess(tolerance=2)[0]
+    assert excess[CRITERIA.index("URM")] == 3.0
+    assert excess[CRITERIA.index("Female")] == 4.0
+    assert excess[CRITERIA.index("Minority")] == 0.0
+    # A percentage that can't be parsed needs the model whatever the tolerance
+    assert excess[CRITERIA.index("EA")] == UNKNOWN_DEVIATION
+
+
+def test_categories_weigh_the_same_whatever_their_size():
+    # 6 points off in the 3 criteria category, 10 points off in the 5 criteria one
+    cohort = Cohort.from_rows([("a", slate(URM="26", EA="40"))])
+
+    scores = cohort.category_scores()[0]
+    assert scores.tolist() == [2.0, 2.0, 0.0]
+    assert cohort.expected_deviation()[0] == pytest.approx(4 / 3)
+
+
+def test_compliant_slates_are_within_tolerance_everywhere():
+    cohort = Cohort.from_rows(
+        [("ideal", slate()), ("close", slate(URM="21")), ("far", slate(URM="30"))]
+    )
+
+    assert cohort.compliant().tolist() == [True, False, False]
+    assert cohort.compliant(tolerance=1).tolist() == [True, True, False]
+
+
+def test_ranking_skips_compliant_slates_and_keeps_ties_in_order():
+    cohort = Cohort.from_rows(
+        [
+            ("ideal", slate()),
+            ("small", slate(URM="23")),
+            ("large", slate(URM="40")),
+            ("small again", slate(Female="13")),
+        ]
+    )
+
+    ranked = [cohort.slate_ids[row] for row in cohort.ranking()]
+    assert ranked == ["large", "small", "small again"]
+    assert [cohort.slate_ids[row] for row in cohort.ranking(tolerance=5)] == ["large"]
+
+
+def test_outliers_stand_out_from_their_criterion():
+    rows = [(f"s{i}", slate(URM=str(18 + i % 5))) for i in range(20)]
+    rows.append(("odd", slate(URM="90")))
+    cohort = Cohort.from_rows(rows)
+
+    outliers = cohort.outliers()
+    assert [(o["slate_id"], o["criterion"]) for o in outliers] == [("odd", "URM")]
+    assert outliers[0]["percentage"] == 90.0
+    assert outliers[0]["z_score"] > 3.5
+
+
+def test_outliers_ignore_criteria_without_spread():
+    # Every slate has the same percentages but one, the spread of each criterion is 0
+    cohort = Cohort.from_rows(
+        [("a", slate()), ("b", slate()), ("c", slate()), ("d", slate(EA="?"))]
+    )
+
+    assert cohort.outliers() == []
+
+
+def test_summary_is_json_serializable():
+    cohort = Cohort.from_rows(
+        [("a", slate()), ("b", slate(URM="30")), ("c", slate(FO="?"))]
+    )
+
+    summary = json.loads(json.dumps(cohort.summary(tolerance=1, top=1)))
+    assert summary["slates"] == 3
+    assert summary["compliant"] == 1
+    assert set(summary["criteria"]) == set(CRITERIA)
+    assert set(summary["categories"]) == set(IDEAL_VALUES)
+    assert summary["criteria"]["URM"]["mean_deviation"] == pytest.approx(10 / 3, 1e-3)
+    assert summary["criteria"]["FO"]["unparsed"] == 1
+    assert [row["slate_id"] for row in summary["most_deviant"]] == ["c"]
+
+
+def test_empty_cohort():
+    cohort = Cohort.from_rows([])
+
+    summary = cohort.summary()
+    assert summary["slates"] == 0
+    assert summary["criteria"] == {}
+    assert summary["outliers"] == []
+    assert summary["most_deviant"] == []
@@ -0,0 +1,34 @@
+import openai
+import pytest
+
+import scheduler
+from deployments import Deployment, DeploymentPool
+
+
+def timeout_error() -> openai.APITimeoutError:
+    # The request is only stored on the error, no need for the HTTP library's own type
+    return openai.APITimeoutError(request=None)
+
+
+@pytest.fixture
+def pool():
+    deployment = Deployment("gpt-4o", "https://example.openai.azure.com", "key", "v1")
+    return DeploymentPool([deployment], eject_after=1)
+
+
+def test_upstream_timeout_counts_against_the_deployment(pool):
+    deployment = pool.deployments[0]
+    with pytest.raises(openai.APITimeoutError), pool.track(deployment):
+        raise timeout_error()
+    assert deployment.errors == 1
+    assert not deployment.healthy(deployment.ejected_until - 1)
+
+
+def test_timeout_at_the_deadline_is_the_callers_not_the_deployments(pool):
+    deployment = pool.deployments[0]
+    with scheduler.deadline(0):
+        with pytest.raises(scheduler.DeadlineExceeded), pool.track(deployment):
+            raise timeout_error()
+    assert deployment.errors == 0
+    assert deployment.ejections == 0
+    assert deployment.in_flight == 0
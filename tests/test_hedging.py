@@ -0,0 +1,73 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from hedging import Hedger
+
+
+def primed(latency: float, **kwargs) -> Hedger:
+    hedger = Hedger(min_samples=10, **kwargs)
+    for _ in range(10):
+        hedger.observe(latency)
+    return hedger
+
+
+def test_calls_run_unhedged_until_enough_samples():
+    hedger = Hedger(min_samples=10)
+    assert hedger.delay() is None
+    assert hedger.call(lambda: "primary", lambda: "backup") == "primary"
+    assert hedger.stats()["hedges"] == 0
+
+
+def test_slow_primary_is_hedged():
+    hedger = primed(0.05, max_share=1.0)
+
+    def primary():
+        time.sleep(1)
+        return "primary"
+
+    assert hedger.call(primary, lambda: "backup") == "backup"
+    assert hedger.stats()["hedge_wins"] == 1
+
+
+def test_hedges_are_capped():
+    hedger = primed(0.01, max_share=0.0)
+
+    def primary():
+        time.sleep(0.05)
+        return "primary"
+
+    assert hedger.call(primary, lambda: "backup") == "primary"
+    assert hedger.stats()["hedges"] == 0
+
+
+def test_concurrent_calls_are_not_hedged_for_waiting():
+    # More concurrent calls than a fixed pool of workers would run at once, none of
+    # them slower than the trigger
+    hedger = primed(0.15, max_share=1.0)
+
+    def primary():
+        time.sleep(0.1)
+        return "primary"
+
+    with ThreadPoolExecutor(max_workers=96) as callers:
+        results = list(
+            callers.map(lambda _: hedger.call(primary, lambda: "backup"), range(96))
+        )
+    assert results == ["primary"] * 96
+    assert hedger.stats()["hedges"] == 0
+
+
+def test_error_of_both_copies_is_raised():
+    hedger = primed(0.01, max_share=1.0)
+
+    def primary():
+        time.sleep(0.05)
+        raise ValueError("primary")
+
+    def backup():
+        raise KeyError("backup")
+
+    with pytest.raises((ValueError, KeyError)):
+        hedger.call(primary, backup)
@@ -0,0 +1,126 @@
+import pytest
+
+from cache import ResponseCache
+from neardup import NearDuplicateIndex, shingles
+
+WORKFLOW = (
+    "The committee reviewed 42 applications on 3 May and invited the shortlisted "
+    "candidates to interview. Every panel member declared conflicts of interest "
+    "before the scoring started, and the chair recorded the gender balance of the "
+    "shortlist against the targets of the faculty."
+)
+OTHER = (
+    "Nominations were collected from department heads without an open call, and the "
+    "selection was made in a single meeting. No record was kept of how candidates "
+    "from other regions were considered."
+)
+
+
+@pytest.fixture
+def index(tmp_path):
+    return NearDuplicateIndex(str(tmp_path / "neardup.db"), threshold=0.8)
+
+
+def test_shingles_ignore_case_punctuation_and_numbers():
+    assert shingles("Reviewed 42 applications, on 3 May!") == shingles(
+        "reviewed 17 applications on 28 may"
+    )
+    assert shingles("reviewed applications on may") != shingles(
+        "reviewed candidates on may"
+    )
+
+
+def test_shingles_of_a_short_text():
+    assert len(shingles("two words")) == 1
+    assert shingles("") == shingles("   ")
+
+
+def test_signature_estimates_similarity(index):
+    signature = index.signature(WORKFLOW)
+
+    assert len(signature) == index.num_perm
+    assert index.signature(WORKFLOW.replace("42", "57")) == signature
+    different = index.signature(OTHER)
+    assert sum(x == y for x, y in zip(signature, different)) < index.num_perm // 4
+
+
+def test_find_returns_similar_workflows_of_the_same_group(index):
+    index.add("original", "group", index.signature(WORKFLOW))
+    index.add("other", "group", index.signature(OTHER))
+
+    near = index.signature(WORKFLOW + " Minutes attached.")
+    matches = index.find("group", near)
+    assert [key for _, key in matches] == ["original"]
+    assert matches[0][0] >= 0.8
+
+    assert index.find("another group", near) == []
+
+
+def test_find_orders_by_similarity(index):
+    index.add("exact", "group", index.signature(WORKFLOW))
+    index.add("edited", "group", index.signature(WORKFLOW + " It was approved."))
+
+    matches = index.find("group", index.signature(WORKFLOW))
+    assert [key for _, key in matches] == ["exact", "edited"]
+    assert matches[0][0] == 1.0
+
+
+def test_adding_again_keeps_one_row_per_band(index):
+    signature = index.signature(WORKFLOW)
+    index.add("original", "group", signature)
+    index.add("original", "group", signature)
+
+    rows = index._db.execute("SELECT COUNT(*) FROM near_duplicate_bands").fetchone()
+    assert rows[0] == index.bands
+    assert len(index.find("group", signature)) == 1
+
+
+def test_remove_drops_the_workflow(index):
+    signature = index.signature(WORKFLOW)
+    index.add("original", "group", signature)
+    index.remove(["original"])
+
+    assert index.find("group", signature) == []
+    rows = index._db.execute("SELECT COUNT(*) FROM near_duplicate_bands").fetchone()
+    assert rows[0] == 0
+
+
+def test_existing_file_with_repeated_rows_is_deduplicated(tmp_path):
+    path = str(tmp_path / "neardup.db")
+    index = NearDuplicateIndex(path)
+    index._db.execute("DROP INDEX near_duplicate_band_keys")
+    signature = index.signature(WORKFLOW)
+    for _ in range(2):
+        index._db.executemany(
+            "INSERT INTO near_duplicate_bands VALUES (?, ?)",
+            [(bucket, "original") for bucket in index._buckets("group", signature)],
+        )
+    index._db.commit()
+
+    reopened = NearDuplicateIndex(path)
+    rows = reopened._db.execute("SELECT COUNT(*) FROM near_duplicate_bands").fetchone()
+    assert rows[0] == reopened.bands
+
+
+def test_num_perm_must_split_into_bands(tmp_path):
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(str(tmp_path / "neardup.db"), num_perm=64, bands=10)
+
+
+def test_cache_evictions_prune_the_index(tmp_path, index):
+    cache = ResponseCache(
+        str(tmp_path / "cache.db"),
+        max_memory_entries=1,
+        max_disk_entries=1,
+        on_evict=index.remove,
+    )
+    signature = index.signature(WORKFLOW)
+    cache.set("first", "{}")
+    index.add("first", "group", signature)
+    cache.set("second", "{}")
+    index.add("second", "group", signature)
+
+    assert [key for _, key in index.find("group", signature)] == ["second"]
+
+    cache.clear()
+    assert index.find("group", signature) == []
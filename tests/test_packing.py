@@ -0,0 +1,196 @@
+import json
+
+import pytest
+
+import batch
+import main
+from packing import PackSizer, SLATE_PROMPT_TOKENS
+
+
+def slate(slate_id: str, workflow: str = "The committee discussed the slate.") -> dict:
+    values = {field: "0" for field in batch.SLATE_FIELDS[:-1]}
+    return {**values, "workflow": workflow, "slate_id": slate_id}
+
+
+def valid_analysis() -> dict:
+    response = {
+        category: {
+            criterion: {
+                "plan of action": f"Plan for {criterion}",
+                "sentiment": "Positive",
+                "rating": main.SENTIMENT_RATINGS["Positive"],
+            }
+            for criterion in values
+        }
+        for category, values in main.IDEAL_VALUES.items()
+    }
+    response["Summary"] = "Summary of the slate."
+    return main.compute_averages(response)
+
+
+def test_packs_are_closed_at_the_size_limit():
+    sizer = PackSizer(max_size=3)
+    packs = list(sizer.packs(slate(str(n)) for n in range(7)))
+    assert [len(pack) for pack in packs] == [3, 3, 1]
+
+
+def test_packs_are_closed_before_the_prompt_budget():
+    # Each slate takes its workflow estimate plus SLATE_PROMPT_TOKENS
+    sizer = PackSizer(max_size=10, prompt_budget=3 * SLATE_PROMPT_TOKENS + 10)
+    packs = list(sizer.packs(slate(str(n), workflow="") for n in range(5)))
+    assert [len(pack) for pack in packs] == [3, 2]
+
+
+def test_packs_are_closed_before_the_completion_budget():
+    sizer = PackSizer(max_size=10, completion_budget=2000, completion_tokens=900)
+    packs = list(sizer.packs(slate(str(n)) for n in range(5)))
+    assert [len(pack) for pack in packs] == [2, 2, 1]
+
+
+def test_a_slate_over_the_budget_gets_a_pack_of_its_own():
+    sizer = PackSizer(max_size=4, prompt_budget=10)
+    packs = list(sizer.packs(slate(str(n)) for n in range(2)))
+    assert [len(pack) for pack in packs] == [1, 1]
+
+
+def test_size_halves_after_an_invalid_pack():
+    sizer = PackSizer(max_size=8)
+    sizer.record(8, invalid=1)
+    assert sizer.size == 4
+    sizer.record(4, invalid=4)
+    assert sizer.size == 2
+    sizer.record(2, invalid=1)
+    sizer.record(1, invalid=1)
+    assert sizer.size == 1
+
+
+def test_size_halves_from_the_failed_pack_when_it_was_smaller():
+    sizer = PackSizer(max_size=8)
+    sizer.record(3, invalid=1)
+    assert sizer.size == 1
+
+
+def test_size_grows_by_one_after_a_full_valid_pack():
+    sizer = PackSizer(max_size=4)
+    sizer.record(4, invalid=1)
+    assert sizer.size == 2
+    sizer.record(2, invalid=0)
+    assert sizer.size == 3
+    sizer.record(3, invalid=0)
+    sizer.record(4, invalid=0)
+    assert sizer.size == 4
+
+
+def test_size_does_not_grow_after_a_short_pack():
+    sizer = PackSizer(max_size=4)
+    sizer.record(4, invalid=2)
+    sizer.record(1, invalid=0)
+    assert sizer.size == 2
+
+
+def test_packs_follow_the_size_recorded_between_them():
+    sizer = PackSizer(max_size=4)
+    packs = sizer.packs(slate(str(n)) for n in range(10))
+    first = next(packs)
+    sizer.record(len(first), invalid=1)
+    assert len(next(packs)) == 2
+
+
+def test_score_pack_scores_only_the_missing_slates_alone(monkeypatch):
+    slates = [slate("a"), slate("b"), slate("c")]
+    analysis = valid_analysis()
+    alone = []
+
+    monkeypatch.setattr(
+        batch, "analyse_pack", lambda packed: [analysis, None, analysis]
+    )
+    monkeypatch.setattr(
+        batch,
+        "score_slate",
+        lambda s: alone.append(s["slate_id"]) or {"slate_id": s["slate_id"]},
+    )
+    sizer = PackSizer(max_size=3)
+
+    results = batch.score_pack(slates, sizer)
+
+    assert alone == ["b"]
+    assert [r["slate_id"] for r in results] == ["a", "b", "c"]
+    assert results[0]["status"] == "ok"
+    assert results[0]["result"]["summary"] == "Summary of the slate."
+    assert sizer.size == 1
+
+
+def test_score_pack_scores_every_slate_alone_when_the_call_fails(monkeypatch):
+    def fail(packed):
+        raise RuntimeError("API down")
+
+    alone = []
+    monkeypatch.setattr(batch, "analyse_pack", fail)
+    monkeypatch.setattr(
+        batch,
+        "score_slate",
+        lambda s: alone.append(s["slate_id"]) or {"slate_id": s["slate_id"]},
+    )
+
+    batch.score_pack([slate("a"), slate("b")], PackSizer(max_size=2))
+
+    assert alone == ["a", "b"]
+
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    # Settings and stores of a test run, with the model calls answered by each test
+    monkeypatch.setattr(
+        main,
+        "_settings",
+        {
+            "DEPLOYMENT": "test",
+            "PRESCORE_TOLERANCE": "0",
+            "RESPONSE_CACHE_PATH": str(tmp_path / "cache.sqlite3"),
+            "RESULTS_STORE_PATH": str(tmp_path / "results.sqlite3"),
+        },
+    )
+    monkeypatch.setattr(main, "_cache", None)
+    monkeypatch.setattr(main, "_results", None)
+    monkeypatch.setattr(main, "_near_duplicates", None)
+
+
+def test_analyse_pack_splits_the_answer_by_slate(pipeline, monkeypatch):
+    analysis = valid_analysis()
+    broken = valid_analysis()
+    del broken["Demographic Diversity"]
+    answers = {"1": analysis, "2": broken}
+    prompts = []
+
+    def answer(messages, schema=None, pool=None):
+        prompts.append(messages[-1]["content"])
+        return json.dumps(answers)
+
+    monkeypatch.setattr(main, "get_analysis", answer)
+    slates = [
+        {"percentages": ["0"] * 11, "workflow": f"Workflow {n}", "slate_id": str(n)}
+        for n in range(3)
+    ]
+
+    responses = main.analyse_pack(slates)
+
+    assert len(prompts) == 1
+    assert all(f'<slate id="{n}">' in prompts[0] for n in (1, 2, 3))
+    assert responses[0]["Summary"] == "Summary of the slate."
+    # An invalid answer and a missing one are left to be analysed alone
+    assert responses[1] is None
+    assert responses[2] is None
+
+
+def test_analyse_pack_answers_compliant_slates_without_a_call(pipeline, monkeypatch):
+    def answer(messages, schema=None, pool=None):
+        raise AssertionError("No call expected")
+
+    monkeypatch.setattr(main, "get_analysis", answer)
+    ideal = [
+        str(value) for values in main.IDEAL_VALUES.values() for value in values.values()
+    ]
+
+    responses = main.analyse_pack([{"percentages": ideal, "workflow": "Workflow"}])
+
+    assert responses[0]["Summary"] == "All criteria match the ideal percentages."
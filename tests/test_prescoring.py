@@ -0,0 +1,67 @@
+import json
+
+import main
+
+IDEAL = {
+    criterion: str(ideal)
+    for values in main.IDEAL_VALUES.values()
+    for criterion, ideal in values.items()
+}
+
+
+def answer(criteria: list, rating=2) -> str:
+    """Model response covering the given criteria."""
+    response = {"Summary": "Summary of the slate."}
+    for category, values in main.IDEAL_VALUES.items():
+        entries = {
+            criterion: {
+                "plan of action": "Recruit more widely.",
+                "sentiment": "Positive",
+                "rating": rating,
+            }
+            for criterion in values
+            if criterion in criteria
+        }
+        if entries:
+            response[category] = entries
+    return json.dumps(response)
+
+
+def test_prescore_settles_criteria_within_tolerance():
+    settled, deviant = main.prescore_slate({**IDEAL, "URM": "26", "EA": "x"}, 5)
+
+    assert deviant == ["URM", "EA"]
+    assert settled["Female"] == main.SATISFIED
+    assert len(settled) == len(main.CRITERIA) - 2
+
+
+def test_merge_completes_the_response():
+    settled, deviant = main.prescore_slate({**IDEAL, "URM": "40"}, 5)
+
+    response = main.merge_prescored(answer(deviant), settled)
+
+    assert main.invalid_sections(response) == []
+    merged = json.loads(response)
+    assert merged["Demographic Diversity"]["Average Rating"] == round(8 / 3, 2)
+    assert merged["Geographic Diversity"]["Average Rating"] == 3.0
+
+
+def test_merge_with_a_null_rating_is_invalid():
+    settled, deviant = main.prescore_slate({**IDEAL, "URM": "40"}, 5)
+
+    response = main.merge_prescored(answer(deviant, rating=None), settled)
+
+    merged = json.loads(response)
+    # The settled criteria are kept, only the category that can't be averaged is
+    # asked for again
+    assert merged["Demographic Diversity"]["Female"] == main.SATISFIED
+    assert main.invalid_sections(response) == [
+        "Demographic Diversity",
+        "Overall Rating",
+    ]
+
+
+def test_merge_keeps_a_response_that_isnt_json():
+    settled, _ = main.prescore_slate({**IDEAL, "URM": "40"}, 5)
+
+    assert main.merge_prescored("not json", settled) == "not json"
@@ -0,0 +1,27 @@
+import json
+
+import main
+
+
+def test_full_schema_allows_no_nulls():
+    schema = main._full_response_schema()
+
+    assert "null" not in json.dumps(schema)
+    entry = schema["$defs"]["ActionRating"]["properties"]
+    assert entry["sentiment"]["enum"] == list(main.SENTIMENT_RATINGS)
+    assert entry["rating"] == {"type": "number"}
+    assert schema["properties"]["Overall Rating"] == {"type": "number"}
+
+
+def test_schema_of_some_criteria_keeps_the_strict_fields():
+    schema = main.response_schema(("URM", "EA"))
+
+    assert set(schema["properties"]) == {
+        "Demographic Diversity",
+        "Geographic Diversity",
+        "Overall Rating",
+        "Summary",
+    }
+    demographic = schema["$defs"]["DemographicDiversity"]
+    assert demographic["required"] == ["URM", "Average Rating"]
+    assert demographic["properties"]["Average Rating"] == {"type": "number"}
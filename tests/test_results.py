@@ -0,0 +1,36 @@
+import pytest
+
+from results import CATEGORY_COLUMNS, ResultsStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ResultsStore(str(tmp_path / "results.sqlite3"))
+
+
+def add(store: ResultsStore, slate_id: str, geographic: float, overall: float):
+    response = {
+        "Demographic Diversity": {"Average Rating": 3},
+        "Geographic Diversity": {"Average Rating": geographic},
+        "Seniority/Career Phase": {"Average Rating": 3},
+        "Overall Rating": overall,
+    }
+    store.add(slate_id, ["20"] * 11, "Workflow", response, [], model="gpt-4o")
+
+
+def test_search_filters_by_category_rating(store):
+    add(store, "a", 1.0, 2.3)
+    add(store, "b", 2.5, 2.8)
+    add(store, "c", 3.0, 3.0)
+
+    found = store.search(category="Geographic Diversity", min_rating=2, max_rating=2.9)
+    assert [result["slate_id"] for result in found] == ["b"]
+    assert [r["slate_id"] for r in store.search(min_overall=2.5)] == ["c", "b"]
+
+
+@pytest.mark.parametrize("column", ["overall", *CATEGORY_COLUMNS.values()])
+def test_rating_filters_use_an_index(store, column):
+    plan = store._db.execute(
+        f"EXPLAIN QUERY PLAN SELECT * FROM results WHERE {column} >= ?", (2,)
+    ).fetchall()
+    assert any(f"INDEX results_{column}" in row["detail"] for row in plan)
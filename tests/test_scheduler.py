@@ -0,0 +1,180 @@
+import time
+import asyncio
+import threading
+
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+import scheduler
+from scheduler import BATCH, INTERACTIVE, RequestScheduler, TokenBucket
+
+
+def rate_limit_error(retry_after_ms: str = "1") -> openai.RateLimitError:
+    # Only the parts of a response the error and retry_after read, so the tests don't
+    # depend on the HTTP library of the installed openai version
+    response = SimpleNamespace(
+        request=None, status_code=429, headers={"retry-after-ms": retry_after_ms}
+    )
+    return openai.RateLimitError("Rate limit", response=response, body=None)
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(0)
+    bucket.take(10**9)
+    assert bucket.wait_time(10**9) == 0
+
+
+def test_bucket_starts_full_and_refills_at_its_rate():
+    bucket = TokenBucket(60)
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    # One unit per second
+    assert bucket.wait_time(2) == pytest.approx(2, abs=0.05)
+
+
+def test_request_larger_than_the_budget_waits_for_a_full_bucket():
+    bucket = TokenBucket(60)
+    bucket.take(30)
+    assert bucket.wait_time(600) == pytest.approx(30, abs=0.05)
+
+
+def test_estimate_tokens_counts_four_characters_per_token():
+    messages = [{"content": "a" * 400}, {"content": "b" * 40}]
+    assert scheduler.estimate_tokens(messages, completion_tokens=100) == 210
+
+
+def test_call_retries_rate_limits_and_pauses_other_calls():
+    limiter = RequestScheduler(max_retries=3)
+    attempts = []
+
+    def request():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise rate_limit_error("20")
+        return "ok"
+
+    assert limiter.call(request, tokens=10) == "ok"
+    assert len(attempts) == 3
+    # Retry-After of 20ms, stretched by up to half for jitter
+    assert attempts[1] - attempts[0] >= 0.02
+    assert limiter.paused_until > 0
+
+
+def test_call_gives_up_after_max_retries():
+    limiter = RequestScheduler(max_retries=2)
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise rate_limit_error()
+
+    with pytest.raises(openai.RateLimitError):
+        limiter.call(request, tokens=10)
+    assert len(attempts) == 3
+
+
+def test_call_does_not_retry_other_errors():
+    limiter = RequestScheduler(max_retries=3)
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        limiter.call(request, tokens=10)
+    assert len(attempts) == 1
+
+
+def test_interactive_calls_overtake_waiting_batch_calls():
+    limiter = RequestScheduler(requests_per_minute=600)
+    limiter.requests.take(600)
+    admitted = []
+
+    def acquire(level: int):
+        with scheduler.priority(level):
+            limiter.acquire(1)
+        admitted.append(level)
+
+    batch = threading.Thread(target=acquire, args=(BATCH,))
+    batch.start()
+    time.sleep(0.02)
+    interactive = threading.Thread(target=acquire, args=(INTERACTIVE,))
+    interactive.start()
+    batch.join(2)
+    interactive.join(2)
+
+    assert admitted == [INTERACTIVE, BATCH]
+    assert limiter._waiting == []
+
+
+def test_async_call_retries_rate_limits():
+    limiter = RequestScheduler(max_retries=2)
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        if len(attempts) < 2:
+            raise rate_limit_error()
+        return "ok"
+
+    assert asyncio.run(limiter.acall(request, tokens=10)) == "ok"
+    assert len(attempts) == 2
+
+
+def test_deadline_limits_the_time_left():
+    assert scheduler.remaining() is None
+    with scheduler.deadline(10):
+        assert 9 < scheduler.remaining() <= 10
+        # A nested deadline can only shorten the budget
+        with scheduler.deadline(60):
+            assert scheduler.remaining() <= 10
+        with scheduler.deadline(1):
+            assert scheduler.remaining() <= 1
+    assert scheduler.remaining() is None
+
+
+def test_no_deadline_leaves_the_budget_open():
+    with scheduler.deadline(None):
+        assert scheduler.remaining() is None
+        scheduler.check_deadline()
+
+
+def test_check_deadline_raises_once_the_time_is_up():
+    with scheduler.deadline(0.01):
+        scheduler.check_deadline()
+        time.sleep(0.02)
+        with pytest.raises(scheduler.DeadlineExceeded):
+            scheduler.check_deadline()
+
+
+def test_restore_deadline_sets_the_same_end_again():
+    with scheduler.deadline(10):
+        end = scheduler.current_deadline()
+    with scheduler.restore_deadline(end):
+        assert scheduler.current_deadline() == end
+    assert scheduler.current_deadline() is None
+
+
+def test_retry_after_the_deadline_is_not_attempted():
+    limiter = RequestScheduler(max_retries=3)
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise rate_limit_error("5000")
+
+    with scheduler.deadline(1), pytest.raises(scheduler.DeadlineExceeded):
+        limiter.call(request, tokens=10)
+    assert len(attempts) == 1
+
+
+def test_call_that_cannot_get_its_turn_in_time_leaves_the_queue():
+    limiter = RequestScheduler(requests_per_minute=6)
+    limiter.requests.take(6)
+
+    with scheduler.deadline(1), pytest.raises(scheduler.DeadlineExceeded):
+        limiter.acquire(1)
+    assert limiter._waiting == []
@@ -0,0 +1,64 @@
+import json
+
+from main import IncrementalJSONParser
+
+RESPONSE = {
+    "Demographic Diversity": {
+        "URM": {"plan of action": 'Say "more", {not} [less], ok', "rating": 2},
+        "Female": {"plan of action": "Back\\slash and é", "rating": 3},
+    },
+    "Geographic Diversity": {"EA": {"plan of action": "", "rating": 1}},
+    "Summary": "Done, with commas, and } braces ].",
+}
+
+
+def feed_all(chunks) -> tuple[dict, list]:
+    parser = IncrementalJSONParser()
+    merged, steps = {}, []
+    for chunk in chunks:
+        completed = parser.feed(chunk)
+        steps.append(completed)
+        merged.update(completed)
+    return merged, steps
+
+
+def test_whole_response_in_one_chunk():
+    merged, _ = feed_all([json.dumps(RESPONSE, indent=2)])
+    assert merged == RESPONSE
+
+
+def test_any_split_into_two_chunks_gives_the_same_members():
+    text = json.dumps(RESPONSE)
+    for cut in range(len(text) + 1):
+        merged, _ = feed_all([text[:cut], text[cut:]])
+        assert merged == RESPONSE, cut
+
+
+def test_character_by_character():
+    merged, steps = feed_all(json.dumps(RESPONSE, indent=2))
+    assert merged == RESPONSE
+    # Each member is reported once, as soon as it is complete
+    assert [key for step in steps for key in step] == list(RESPONSE)
+
+
+def test_member_is_reported_when_it_closes():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"Summary": "a, b') == {}
+    assert parser.feed('", "Other": {"x": [1, 2') == {"Summary": "a, b"}
+    assert parser.feed("]}}") == {"Other": {"x": [1, 2]}}
+
+
+def test_text_around_the_object_is_ignored():
+    merged, _ = feed_all(["```json\n", json.dumps(RESPONSE), "\n```"])
+    assert merged == RESPONSE
+
+
+def test_invalid_member_is_skipped():
+    merged, _ = feed_all(['{"Bad": {"x": 1,,}, "Summary": "ok"}'])
+    assert merged == {"Summary": "ok"}
+
+
+def test_truncated_response_keeps_the_completed_members():
+    text = json.dumps(RESPONSE)
+    merged, _ = feed_all([text[: text.index('"Summary"')]])
+    assert list(merged) == ["Demographic Diversity", "Geographic Diversity"]